@@ -1,11 +1,46 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import chain, groupby, islice
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from operator import itemgetter
+import heapq
+import asyncio
+from array import array
+import argparse
+import atexit
+import contextlib
+import cProfile
+import csv
+import functools
+import gc
+import hashlib
+import inspect
+import io
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import pstats
+import random
 import re
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qsl, quote, urlsplit
+#NumPy is only needed by the circulation analytics, everything else works without it
+try: import numpy as np
+except ImportError: np = None
 
 #Class to represent mail datatype and handle mail validation
 class MailAddress:
+    PATTERN = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+
     @classmethod
     def valid(self, mail):
-        if re.fullmatch(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', mail): return True
+        if self.PATTERN.fullmatch(mail): return True
         return False
 
 
@@ -14,76 +49,298 @@ def handleInput(text:str, display:str = "", expected = None, optional = False, e
     """
     text: The user's input text
     display: what to display when there is an error with input
-    expected: Expected nature of the answer, list of strings, for alternate values, or it can be the names of the datatypes to be expected
+    expected: Expected nature of the answer, list of strings, for alternate values, a range or set of the accepted values,
+        a Rule, or it can be the names of the datatypes to be expected
     optional: to make the input optional, it will allow empty values
     errorCount: Highest number of allowed user mistakes before the program terminates itself.
     """
-    if text == "":
-        if optional: return
+    #Each retry goes round the loop and uses up one of the allowed mistakes
+    while True:
+        if text == "":
+            if optional: return
+            failure, retry = "Error: Invalid input/argument. You typed/inserted nothing. exiting program.", "Error: Input can't be empty, retype: "
+        else:
+            value, failure, retry = acceptInput(text, display, expected)
+            if failure is None: return value
         if errorCount == 0:
-            print("Error: Invalid input/argument. You typed/inserted nothing. exiting program.")
+            print(failure)
             exit()
-        text = input("Error: Input can't be empty, retype: ")
-        return handleInput(text, display, expected, errorCount=errorCount-1)
-    if expected:
-        if isinstance(expected, list):
-            if text.lower() in expected: return text
-            else: 
-                if errorCount == 0:
-                    print("Error: You gave an invalid input. exiting program")
-                    exit()
-                text = input(display)
-                return handleInput(text, display, expected, errorCount=errorCount-1)
-        elif expected is int:
-            if not isinstance(text, str): text = str(text)
-            if text.isnumeric(): return int(text)
-            else: 
-                if errorCount == 0:
-                    print("Error: That's not an integer. exiting program")
-                    exit()
-                text = input(display)
-                return handleInput(text, display, expected, errorCount=errorCount-1)
-        elif expected is float:
-            try: return float(text)
-            except ValueError:
-                if errorCount == 0:
-                    print("Error: That's not a floating number. exiting program")
-                    exit()
-                text = input(display)
-                return handleInput(text, display, expected, errorCount=errorCount-1)
-        elif expected is list:
-            if isinstance(text, list): return text
-            if "," in text: return list(filter(lambda x: x, map(lambda x: x.strip(), text.split(",")))) #This cleans the input, removing empy values and stripping off whitespaces
-            else: return [text]
-        elif expected is datetime:
-            try:
-                dateTime = datetime.strptime(text, '%Y, %m, %d')
-                return dateTime
-            except ValueError:
-                if errorCount == 0:
-                    print("Error: Date not in format '2020, 02, 23' (Year, Month, Day)")
-                    exit()
-                text = input("Re-enter date in format of Year, Month, Day e.g 2020, 02, 23: ")
-                return handleInput(text, display, expected, errorCount=errorCount-1)
-        elif expected is MailAddress:
-            if MailAddress.valid(text): return text
-            else:
-                if errorCount == 0:
-                    print("Error: mail address not in valid format, retype: ")
-                    exit()
-                text = input(display)
-                return handleInput(text, display, expected, errorCount=errorCount-1)
-    return text
+        text = input(retry)
+        errorCount -= 1
+
+#Checks one answer for handleInput. Returns (value, None, None) when it is accepted, otherwise (None, the message
+#printed when there are no retries left, the prompt asking for another answer)
+def acceptInput(text, display, expected):
+    if not expected: return text, None, None
+    if isinstance(expected, (list, set, frozenset)):
+        if text.lower() in expected: return text, None, None
+        return None, "Error: You gave an invalid input. exiting program", display
+    if isinstance(expected, range):
+        if text.isdecimal() and int(text) in expected: return str(int(text)), None, None
+        return None, "Error: You gave an invalid input. exiting program", display
+    if isinstance(expected, Rule):
+        value, error = expected(text)
+        if error is None: return value, None, None
+        return None, "Error: You gave an invalid input, " + error + ". exiting program", display
+    if expected is int:
+        if not isinstance(text, str): text = str(text)
+        if text.isdecimal(): return int(text), None, None
+        return None, "Error: That's not an integer. exiting program", display
+    if expected is float:
+        try: return float(text), None, None
+        except ValueError: return None, "Error: That's not a floating number. exiting program", display
+    if expected is list:
+        if isinstance(text, list): return text, None, None
+        if "," in text: return list(filter(lambda x: x, map(lambda x: x.strip(), text.split(",")))), None, None #This cleans the input, removing empy values and stripping off whitespaces
+        return [text], None, None
+    if expected is datetime:
+        value, error = DATE_RULE(text)
+        if error is None: return value, None, None
+        return None, "Error: Date not in format '2020, 02, 23' (Year, Month, Day)", "Re-enter date in format of Year, Month, Day e.g 2020, 02, 23: "
+    if expected is MailAddress:
+        if MailAddress.valid(text): return text, None, None
+        return None, "Error: mail address not in valid format, retype: ", display
+    return text, None, None
+
+#A check of one value, made once and used for any number of values. Calling it returns (value, error), error being
+#None when the value is valid, and it never asks for input or exits. Empty values (None, "" or []) are only valid when
+#optional, as None. Subclasses override check, the base class accepts any value as text
+class Rule:
+    def __init__(self, optional=False):
+        self.optional = optional
+
+    def __call__(self, value):
+        if value is None or value == "" or value == []:
+            if self.optional: return None, None
+            return None, "value is empty"
+        return self.check(value)
+
+    def check(self, value):
+        return str(value), None
+
+#Any value, as text
+TextRule = Rule
+
+#Whole numbers, as ints or digit strings, optionally between low and high (inclusive)
+class IntRule(Rule):
+    def __init__(self, low=None, high=None, optional=False):
+        Rule.__init__(self, optional)
+        self.low = low
+        self.high = high
+
+    def check(self, value):
+        text = value if isinstance(value, str) else str(value)
+        if not text.isdecimal(): return None, "not an integer: " + repr(value)
+        number = int(text)
+        if (self.low is not None and number < self.low) or (self.high is not None and number > self.high):
+            return None, "not between " + str(self.low) + " and " + str(self.high) + ": " + repr(value)
+        return number, None
+
+#One of a fixed set of answers, given as ranges of numbers and as strings (matched ignoring case). Checking an answer
+#costs the same however many choices there are, e.g picking one of a million books. Returns the choice as text,
+#numbers without leading zeros and strings in lower case
+class ChoiceRule(Rule):
+    def __init__(self, *choices, optional=False):
+        Rule.__init__(self, optional)
+        self.ranges = [choice for choice in choices if isinstance(choice, range)]
+        self.words = frozenset(choice.lower() for choice in choices if not isinstance(choice, range))
+
+    def check(self, value):
+        text = str(value).strip()
+        if text.isdecimal():
+            number = int(text)
+            for numbers in self.ranges:
+                if number in numbers: return str(number), None
+        elif text.lower() in self.words: return text.lower(), None
+        return None, "not one of the choices: " + repr(value)
+
+#Lists of text, as lists or comma separated text. Blank entries are dropped
+class ListRule(Rule):
+    def check(self, value):
+        if isinstance(value, list): values = [str(x).strip() for x in value]
+        else: values = [x.strip() for x in str(value).split(",")]
+        values = [x for x in values if x]
+        if not values: return None, "value is empty"
+        return values, None
+
+#Dates in the '2020, 02, 23' format handleInput asks for, or datetimes. The same dates strptime would accept, but
+#matched with a regex compiled once and built directly, which is several times faster than strptime. The same dates
+#come up again and again in a catalogue, so the last few thousand parsed are remembered (datetimes can be shared)
+class DateRule(Rule):
+    PATTERN = re.compile(r"(\d{4}),\s+(\d{1,2}),\s+(\d{1,2})")
+    REMEMBERED = 4096
+
+    def __init__(self, optional=False):
+        Rule.__init__(self, optional)
+        self._parsed = {}
+
+    def check(self, value):
+        if isinstance(value, datetime): return value, None
+        date = self._parsed.get(value) if isinstance(value, str) else None
+        if date is not None: return date, None
+        match = self.PATTERN.fullmatch(value) if isinstance(value, str) else None
+        if match is not None:
+            try: date = datetime(int(match[1]), int(match[2]), int(match[3]))
+            except ValueError: date = None
+            if date is not None:
+                if len(self._parsed) >= self.REMEMBERED: self._parsed.clear()
+                self._parsed[value] = date
+                return date, None
+        return None, "date not in format '2020, 02, 23' (Year, Month, Day): " + repr(value)
+
+class EmailRule(Rule):
+    def check(self, value):
+        if isinstance(value, str) and MailAddress.valid(value): return value, None
+        return None, "mail address not in valid format: " + repr(value)
+
+DATE_RULE = DateRule()
+
+#The rules of the datatypes handleInput understands, for checkInput
+INPUT_RULES = {(None, False): TextRule(), (None, True): TextRule(True), (int, False): IntRule(), (int, True): IntRule(optional=True),
+    (list, False): ListRule(), (list, True): ListRule(True), (datetime, False): DateRule(), (datetime, True): DateRule(True),
+    (MailAddress, False): EmailRule(), (MailAddress, True): EmailRule(True)}
+
+#Checks a value with the same rules as handleInput, but never asks for input or exits. expected may also be a Rule.
+#Returns (value, error), error is None when the value is valid
+def checkInput(text, expected = None, optional = False):
+    rule = expected if isinstance(expected, Rule) else INPUT_RULES[(expected, optional)]
+    return rule(text)
+
+#The fields of a kind of record with their rules, checked together. The schema is built once and checks any number
+#of records, one at a time or a batch at a time, without asking for input
+class RecordSchema:
+    def __init__(self, fields):
+        """
+        fields: [(field name, Rule)] in the order the values are returned
+        """
+        self.fields = fields
+        self.names = [name for name, rule in fields]
+
+    #Returns (values, errors): the checked values in field order and [(field, message)] for the invalid ones
+    def validate(self, record):
+        if not isinstance(record, dict): return None, [(None, "not a record: " + str(record))]
+        values, errors = [], []
+        for name, rule in self.fields:
+            value, error = rule(record.get(name))
+            if error is not None: errors.append((name, error))
+            values.append(value)
+        return values, errors
+
+    #Checks every record of a batch. Returns (valid, errors): [(position, values)] for the valid records and
+    #[(position, field, message)] for each invalid field, positions counting from 0 in the batch
+    def validate_many(self, records):
+        valid, errors = [], []
+        for position, record in enumerate(records):
+            values, recordErrors = self.validate(record)
+            if recordErrors: errors.extend((position, name, error) for name, error in recordErrors)
+            else: valid.append((position, values))
+        return valid, errors
+
+#What the constructors ask for, used to check books and users that come from files or the API
+BOOK_SCHEMA = RecordSchema([("title", TextRule()), ("authors", ListRule()), ("year", IntRule()), ("publisher", TextRule()), ("copies", IntRule()),
+    ("pubdate", DateRule())])
+USER_SCHEMA = RecordSchema([("username", TextRule()), ("firstname", TextRule()), ("surname", TextRule()), ("houseNumber", IntRule()),
+    ("streetname", TextRule()), ("postcode", TextRule()), ("email", EmailRule()), ("dateOfBirth", DateRule())])
+
+#Asks whether to show the next page of a long listing, anything but q shows it. The end of the input stops the listing
+def askForMore():
+    try: answer = input("-- Press Enter for more, q to stop: ")
+    except EOFError: return False
+    return answer.strip().lower() != "q"
+
+#Shows the items a page at a time and asks for the index of one, moving between pages with n and p. Items are only
+#taken from the iterable as the pages are shown. Returns the item picked, or None when there are no items
+def pickFromPages(items, describe, noun, pageSize=20):
+    """
+    items: iterable of the items to pick from
+    describe: function giving the text shown for an item
+    noun: what the items are, e.g book
+    pageSize: number of items shown at a time
+    """
+    items = iter(items)
+    shown = []
+    start = 0
+    while True:
+        #One more than the page is taken to know whether there is a next page
+        shown.extend(islice(items, max(0, start + pageSize + 1 - len(shown))))
+        if not shown: return None
+        page = shown[start:start + pageSize]
+        print()
+        print("---------------PICK A " + noun.upper() + "------------------")
+        for i, item in enumerate(page): print(str(start+i+1)+". "+describe(item))
+        choices = [range(start+1, start+len(page)+1)]
+        prompt = "\nEnter the index of the " + noun + " to pick"
+        if len(shown) > start + pageSize:
+            choices.append("n")
+            prompt += ", n for the next page"
+        if start > 0:
+            choices.append("p")
+            prompt += ", p for the previous page"
+        choice = handleInput(input(prompt + ": "), "Error: Enter between "+str(start+1)+" and "+str(start+len(page))+" or a page letter: ", ChoiceRule(*choices))
+        if choice == "n": start += pageSize
+        elif choice == "p": start -= pageSize
+        else: return shown[int(choice)-1]
+
+#Base class for objects that want to follow the changes made to a book list, user list or loans.
+#They are registered with add_observer and every method is a no-op unless overridden
+class LibraryObserver:
+    def book_added(self, book): pass
+    def book_removed(self, book): pass
+    def book_changed(self, book, field, oldValue): pass
+    def user_added(self, user): pass
+    def user_removed(self, user): pass
+    def user_changed(self, user, field, oldValue): pass
+    def loan_added(self, book, user, borrowedAt, dueAt): pass
+    def loan_removed(self, book, user): pass
 
 
-# Please note Most objects in this code are identified by thier hash values
+# Please note Most objects in this code are identified by a unique integer id
 # This is done to make it easier searching for a particular object.
 
+#Gives out the ids of new books and users in sequence: 1, 2, 3... Books and users share the ids, so an id names one
+#record. The ids of records read back from a storage or journal are reserved as they are loaded (see from_record).
+#The storages and the journal's snapshots also keep the largest id given out so far (the high-water mark, see
+#max_record_id), which is reserved when they are attached, so a restarted library carries on after every id it ever
+#gave out, those of deleted records included, and never gives one out twice. Ids were hash(self) at first, which a
+#later record could be given once one was freed
+class IDAllocator:
+    def __init__(self, start=1):
+        self._next = start
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            id = self._next
+            self._next += 1
+            return id
+
+    #Makes sure the id is never given to a new record
+    def reserve(self, id):
+        if id is None or id < self._next: return
+        with self._lock: self._next = max(self._next, id + 1)
+
+    def get_next(self):
+        return self._next
+
+    #The largest id given out (or reserved) so far, 0 when there is none
+    def get_highest(self):
+        return self._next - 1
+
+recordIDs = IDAllocator()
+
 #The book class
 class Book:
+    #Books have no per instance __dict__, this saves memory when there are millions of them
+    __slots__ = ("_id_key", "_watchers", "_title", "_authors", "_year", "_publisher", "_copies", "_noOfAvailCopies", "_pubdate")
+    #The attribute each field is kept in
+    FIELDS = {"title": "_title", "authors": "_authors", "year": "_year", "publisher": "_publisher", "copies": "_copies",
+        "availableCopies": "_noOfAvailCopies", "pubdate": "_pubdate"}
+
     #The constructor validates all the inputs and asks for inputs if there were none given
     def __init__(self, title="", authors="", year="", publisher="", noOfCopies="", pubdate=""):
-        self._id_key = hash(self)
+        self._id_key = recordIDs.allocate()
+        #Objects (e.g book lists) that are told when a field of this book changes
+        self._watchers = []
         self._title = handleInput(input("Enter title (bookID = "+str(self._id_key)+"): "), "Error: Enter a valid title (bookID = "+str(self._id_key)+"): ") if title == "" else handleInput(title, "Error: Enter a valid title (bookID = "+str(self._id_key)+"): ")
         self._authors = handleInput(input("Enter authors(s) separate multiple with a comma (bookID = "+str(self._id_key)+") :"), "Error: Enter an Author name, separate with commas to add multiple authors (bookID = "+str(self._id_key)+"): ", list) if authors == "" else handleInput(authors, "Error: Enter an Author name, separate with commas to add multiple authors (bookID = "+str(self._id_key)+"): ", list)
         self._year = handleInput(input("Enter year (bookID = "+str(self._id_key)+"): "), "Error: Enter a valid year number (bookID = "+str(self._id_key)+"): ", int) if year == "" else handleInput(year, "Error: Enter a valid year number (bookID = "+str(self._id_key)+"): ", int)
@@ -92,47 +349,102 @@ class Book:
         self._noOfAvailCopies = self._copies
         self._pubdate = handleInput(input("Enter publication date Year, Month, Day. E.g 2020, 02, 23 (bookID = "+str(self._id_key)+"): "), "", datetime) if pubdate == "" else handleInput(pubdate, "", datetime)
 
+    #Builds a book from values that are already valid, e.g a row loaded from storage, without asking for input
+    #A new book gets a new id like one made by the constructor when id is None
+    @classmethod
+    def from_record(self, id, title, authors, year, publisher, copies, availableCopies, pubdate):
+        book = self.__new__(self)
+        if id is None: id = recordIDs.allocate()
+        else: recordIDs.reserve(id)
+        book._id_key = id
+        book._watchers = []
+        book._title = title
+        book._authors = list(authors)
+        book._year = year
+        book._publisher = publisher
+        book._copies = copies
+        book._noOfAvailCopies = availableCopies
+        book._pubdate = pubdate
+        return book
+
     def get_id(self):
         return self._id_key
 
+    #Tells the watchers that a field changed, passing along its previous value
+    def _notify(self, field, oldValue):
+        for watcher in self._watchers: watcher.book_changed(self, field, oldValue)
+
+    #Sets a field to a value that is already valid (e.g worked out by the loans or replayed from the journal) and tells
+    #the watchers. The setters check the value first and end the program when it is invalid
+    def _set_field(self, field, value):
+        attribute = self.FIELDS[field]
+        oldValue = getattr(self, attribute)
+        setattr(self, attribute, value)
+        self._notify(field, oldValue)
+
     def get_title(self):
         return self._title
     def set_title(self, title):
+        oldTitle = self._title
         self._title = handleInput(title, errorCount=0)
+        self._notify("title", oldTitle)
     
     def get_authors(self):
         return self._authors
     def add_author(self, name):
+        oldAuthors = list(self._authors)
         self._authors.append(handleInput(name, errorCount=0))
+        self._notify("authors", oldAuthors)
     def clear_authors(self):
+        oldAuthors = self._authors
         self._authors = []
+        self._notify("authors", oldAuthors)
     
     def get_year(self):
         return self._year
     def set_year(self, year):
-        self._year = handleInput(year, errorCount=0)
+        oldYear = self._year
+        self._year = handleInput(year, errorCount=0, expected=int)
+        self._notify("year", oldYear)
 
     def get_publisher(self):
         return self._publisher
     def set_publisher(self, publisher):
+        oldPublisher = self._publisher
         self._publisher = handleInput(publisher, errorCount=0)
+        self._notify("publisher", oldPublisher)
 
     def get_copies(self):
         return self._copies
+    #The copies on loan stay on loan, the available copies go up or down by as many copies as are added or taken away.
+    #The book can't have fewer copies than are on loan, nothing is changed then. Returns None when the copies were set,
+    #otherwise the reason they were not. While the book can be lent use Loans.set_copies, which holds the book's lock
     def set_copies(self, copies):
-        self._copies = handleInput(copies, errorCount=0, expected=int)
-        #When setting the copies, the available copies is updated correctly taking into consideration the current number of books borrowed
-        self._noOfAvailCopies = abs(self._copies - self.get_availableCopies())
+        return self._set_copies(handleInput(copies, errorCount=0, expected=int))
+
+    #set_copies for a number of copies that is already checked
+    def _set_copies(self, copies):
+        onLoan = self.get_copies() - self.get_availableCopies()
+        if copies < onLoan: return str(onLoan) + " copies of the book are on loan, it can't have fewer copies than that"
+        oldCopies = self._copies
+        self._copies = copies
+        self._noOfAvailCopies = copies - onLoan
+        self._notify("copies", oldCopies)
+        return None
 
     def get_availableCopies(self):
         return int(self._noOfAvailCopies)
     def set_availableCopies(self, noOfAvailableCopies):
+        oldAvailableCopies = self._noOfAvailCopies
         self._noOfAvailCopies = handleInput(noOfAvailableCopies, errorCount=0, expected=int)
+        self._notify("availableCopies", oldAvailableCopies)
 
     def get_publicationDate(self):
         return self._pubdate
     def set_publicationDate(self, pubdate):
+        oldPubdate = self._pubdate
         self._pubdate = handleInput(pubdate, errorCount=0, expected=datetime)
+        self._notify("pubdate", oldPubdate)
 
     def print_details(self):
         details = """
@@ -146,87 +458,651 @@ class Book:
         details = details.format(self.get_title(), ", ".join(self.get_authors()), self.get_year(), self.get_publisher(), self.get_availableCopies(), self.get_publicationDate())
         print(details)
 
+#Edit distance counting insertions, deletions, substitutions and swaps of neighbouring letters.
+#Gives up and returns limit+1 as soon as the distance is known to be over limit
+def editDistance(a, b, limit):
+    if abs(len(a) - len(b)) > limit: return limit + 1
+    beforePrevious, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i]
+        for j in range(1, len(b) + 1):
+            cost = min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (a[i-1] != b[j-1]))
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]: cost = min(cost, beforePrevious[j-2] + 1)
+            current.append(cost)
+        if min(current) > limit: return limit + 1
+        beforePrevious, previous = previous, current
+    return previous[-1]
+
+#Full text index over the words in the titles, authors and publishers of books.
+#Every word points to the books containing it (an inverted index), and words are broken into
+#trigrams so partially typed or misspelled words can still find their books
+class BookSearchIndex:
+    #A word found in the title counts more than one in the authors, and that more than one in the publisher
+    FIELD_WEIGHTS = {"title": 3.0, "authors": 2.0, "publisher": 1.0}
+    #How much a word matched by prefix or with typos counts compared to an exact word match
+    PREFIX_WEIGHT = 0.8
+    FUZZY_WEIGHT = 0.6
+    #The most vocabulary words a single prefix or misspelled query word may expand into
+    MAX_EXPANSIONS = 50
+    #Words up to this length are too short for trigrams to catch their typos, they are looked up by deletions instead
+    SHORT_WORD = 6
+    _WORD = re.compile(r"\w+")
+
+    def __init__(self):
+        #word -> {weight: set of bookIDs}. Books are grouped by the weight of the word in them
+        #so the best books for a word can be read off without looking at the rest
+        self._postings = {}
+        #word -> number of books containing it
+        self._counts = {}
+        #bookID -> {word: weight}, used to score candidates and to remove a book without rescanning it.
+        #Only ids are kept, so the books of a storage can be indexed without being held in memory
+        self._bookWords = {}
+        #trigram -> set of words containing it
+        self._grams = {}
+        #short word with one letter deleted -> set of short words, catches typos in short words
+        self._deletions = {}
+        #Sorted list of all indexed words, prefix lookups are a bisect into it
+        self._vocabulary = []
+
+    @classmethod
+    def tokenize(self, text):
+        return self._WORD.findall(text.casefold())
+
+    @classmethod
+    def _trigrams(self, word):
+        padded = "$" + word + "$"
+        return {padded[i:i+3] for i in range(max(1, len(padded) - 2))}
+
+    @classmethod
+    def _deletes(self, word):
+        return {word[:i] + word[i+1:] for i in range(len(word))}
+
+    def __len__(self): return len(self._bookWords)
+
+    def add(self, book):
+        self._add(book, None)
+
+    #Adds many books, the new words are sorted into the vocabulary once at the end instead of one by one
+    def add_many(self, books):
+        newWords = []
+        for book in books: self._add(book, newWords)
+        if newWords:
+            self._vocabulary.extend(newWords)
+            self._vocabulary.sort()
+
+    #newWords collects the words seen for the first time, when it is None they are sorted into the vocabulary right away.
+    #A book already indexed is left as it is, update indexes a changed book again
+    def _add(self, book, newWords):
+        bookID = book.get_id()
+        if bookID in self._bookWords: return
+        words = {}
+        for field, weight in self.FIELD_WEIGHTS.items():
+            if field == "title": text = book.get_title()
+            elif field == "authors": text = " ".join(book.get_authors())
+            else: text = book.get_publisher()
+            #A word repeated within a field counts once, field values are too short for repeats to mean much
+            for word in set(self.tokenize(text)): words[word] = words.get(word, 0) + weight
+        self._bookWords[bookID] = words
+        for word, weight in words.items():
+            if word in self._postings:
+                buckets = self._postings[word]
+                if weight in buckets: buckets[weight].add(bookID)
+                else: buckets[weight] = {bookID}
+                self._counts[word] += 1
+            else:
+                self._postings[word] = {weight: {bookID}}
+                self._counts[word] = 1
+                if newWords is None: insort(self._vocabulary, word)
+                else: newWords.append(word)
+                for gram in self._trigrams(word):
+                    if gram in self._grams: self._grams[gram].add(word)
+                    else: self._grams[gram] = {word}
+                if len(word) <= self.SHORT_WORD:
+                    for variant in self._deletes(word):
+                        if variant in self._deletions: self._deletions[variant].add(word)
+                        else: self._deletions[variant] = {word}
+
+    def remove(self, book):
+        self._remove(book, None)
+
+    #Removes many books, the words no longer used are taken out of the vocabulary in one pass at the end
+    def remove_many(self, books):
+        goneWords = set()
+        for book in books: self._remove(book, goneWords)
+        if goneWords: self._vocabulary = [word for word in self._vocabulary if word not in goneWords]
+
+    #goneWords collects the words no longer in any book, when it is None they are taken out of the vocabulary right away
+    def _remove(self, book, goneWords):
+        bookID = book.get_id()
+        for word, weight in self._bookWords.pop(bookID, {}).items():
+            buckets = self._postings[word]
+            buckets[weight].discard(bookID)
+            if not buckets[weight]: del buckets[weight]
+            self._counts[word] -= 1
+            if buckets: continue
+            del self._postings[word]
+            del self._counts[word]
+            if goneWords is None: del self._vocabulary[bisect_left(self._vocabulary, word)]
+            else: goneWords.add(word)
+            for gram in self._trigrams(word):
+                self._grams[gram].discard(word)
+                if not self._grams[gram]: del self._grams[gram]
+            if len(word) <= self.SHORT_WORD:
+                for variant in self._deletes(word):
+                    self._deletions[variant].discard(word)
+                    if not self._deletions[variant]: del self._deletions[variant]
+
+    def update(self, book):
+        self.remove(book)
+        self.add(book)
+
+    #Returns [(word, weight)], the vocabulary words a query word stands for
+    def _expand(self, word, prefix):
+        if word in self._postings: expansions = [(word, 1.0)]
+        else: expansions = []
+        if prefix:
+            start = bisect_left(self._vocabulary, word)
+            for candidate in self._vocabulary[start:start + self.MAX_EXPANSIONS + 1]:
+                if not candidate.startswith(word): break
+                if candidate != word: expansions.append((candidate, self.PREFIX_WEIGHT))
+        if expansions: return expansions
+        #No exact or prefix match, look for words within one or two typos.
+        #Each typo breaks at most 4 trigrams, so a close word has to share one of any
+        #4*limit + 1 trigrams of the query word, the rarest ones are used to find candidates
+        limit = 1 if len(word) <= 8 else 2
+        grams = sorted(self._trigrams(word), key=lambda gram: len(self._grams.get(gram, ())))
+        needed = len(grams) - 4*limit
+        candidates = set()
+        for gram in grams[:4*limit + 1]:
+            candidates.update(self._grams.get(gram, ()))
+        if len(word) <= self.SHORT_WORD + 1:
+            #One typo away means both words are equal after deleting at most one letter from each
+            for variant in self._deletes(word) | {word}:
+                candidates.update(self._deletions.get(variant, ()))
+                if variant in self._postings: candidates.add(variant)
+        distances = []
+        for candidate in candidates:
+            if abs(len(candidate) - len(word)) > limit: continue
+            if needed > 0 and sum(1 for gram in grams if candidate in self._grams.get(gram, ())) < needed: continue
+            distance = editDistance(word, candidate, limit)
+            if distance <= limit: distances.append((distance, candidate))
+        for distance, candidate in heapq.nsmallest(self.MAX_EXPANSIONS, distances):
+            expansions.append((candidate, self.FUZZY_WEIGHT / distance))
+        return expansions
+
+    #Returns a {word: weight} for each query word, the vocabulary words it stands for (empty when it matches nothing)
+    def expand_query(self, query, prefix=True):
+        words = self.tokenize(query)
+        return [dict(self._expand(word, prefix and i == len(words) - 1)) for i, word in enumerate(words)]
+
+    #Returns {word: number of books containing it} for the words this index has
+    def word_counts(self, words):
+        return {word: self._counts[word] for word in words if word in self._counts}
+
+    #Combines the expand_query results of several indexes (e.g the shards of a catalogue) for one query into the
+    #expansions _expand would have picked from all their words together. Each index returns its first words in
+    #vocabulary or distance order, so the first ones overall are among them
+    @classmethod
+    def merge_expansions(self, expansionLists):
+        merged = []
+        for expansionsOfWord in zip(*expansionLists):
+            words = {}
+            for expansions in expansionsOfWord: words.update(expansions)
+            exact = [word for word, weight in words.items() if weight == 1.0]
+            prefixed = sorted(word for word, weight in words.items() if weight == self.PREFIX_WEIGHT)
+            if exact or prefixed:
+                expansions = {word: 1.0 for word in exact}
+                expansions.update((word, self.PREFIX_WEIGHT) for word in prefixed[:self.MAX_EXPANSIONS + 1 - len(exact)])
+            else:
+                close = heapq.nsmallest(self.MAX_EXPANSIONS, ((round(self.FUZZY_WEIGHT / weight), word) for word, weight in words.items()))
+                expansions = {word: self.FUZZY_WEIGHT / distance for distance, word in close}
+            merged.append(expansions)
+        return merged
+
+    def search(self, query, limit=10, prefix=True, expansions=None, stats=None):
+        """
+        query: free text, words may be partial (the last one is treated as a prefix) or misspelled
+        limit: the number of best results to return
+        prefix: allow the last query word to match longer words
+        expansions: expand_query result used instead of expanding the query against this index
+        stats: (number of books, {word: books containing it}) the words are weighed by instead of this index's counts,
+        a shard is given the figures of the whole catalogue so its scores are those of an unsharded search
+        Returns [(score, bookID)] best first. Every query word that matches anything must match the book.
+        """
+        if expansions is None: expansions = self.expand_query(query, prefix)
+        books, counts = (len(self._bookWords), self._counts) if stats is None else stats
+        groups = []
+        for wordExpansions in expansions:
+            if not wordExpansions: continue
+            group = {word: weight * math.log(1 + books / counts[word]) for word, weight in wordExpansions.items() if word in self._postings}
+            #The query word matches books elsewhere, but none of the books here
+            if not group: return []
+            groups.append(group)
+        if not groups: return []
+        #The rarest query word drives the search, the others only score the books it finds
+        groups.sort(key=lambda group: sum(self._counts[word] for word in group))
+        driver, others = groups[0], groups[1:]
+        #The most the other query words can add to any book's score, nudged up so float rounding can't hide a tie
+        othersBound = sum(max(max(self._postings[word]) * wordWeight for word, wordWeight in group.items()) for group in others) - 1e-9
+        #Walking the driver's buckets from the best down, the first time a book is seen gives its final
+        #driver score. Once the worst of the top results beats anything left, the search stops
+        buckets = sorted(((weight * wordWeight, bookIDs) for word, wordWeight in driver.items() for weight, bookIDs in self._postings[word].items()), key=lambda x: x[0], reverse=True)
+        best, seen = [], set()
+        for score, bookIDs in buckets:
+            if len(best) == limit and best[0][0] >= score + othersBound: break
+            for bookID in bookIDs:
+                if bookID in seen: continue
+                seen.add(bookID)
+                total = score
+                bookWords = self._bookWords[bookID]
+                for group in others:
+                    matched = max((weight * group[word] for word, weight in bookWords.items() if word in group), default=0)
+                    if not matched: break
+                    total += matched
+                else:
+                    if len(best) < limit: heapq.heappush(best, (total, bookID))
+                    elif total > best[0][0]: heapq.heapreplace(best, (total, bookID))
+                    if len(best) == limit and best[0][0] >= score + othersBound: break
+        best.sort(reverse=True)
+        return best
+
+#Keeps books sorted by one field so ranges of values can be found with a binary search
+class SortedIndex:
+    def __init__(self):
+        #Sorted list of the distinct keys, and the books having each key {key: {bookID: book}}
+        self._keys = []
+        self._books = {}
+        self._size = 0
+
+    def __len__(self): return self._size
+
+    def add(self, key, book):
+        if key in self._books: self._books[key][book.get_id()] = book
+        else:
+            insort(self._keys, key)
+            self._books[key] = {book.get_id(): book}
+        self._size += 1
+
+    def add_many(self, pairs):
+        for key, book in pairs: self.add(key, book)
+
+    def remove(self, key, book):
+        books = self._books.get(key)
+        if books is None or books.pop(book.get_id(), None) is None: return
+        self._size -= 1
+        if not books:
+            del self._books[key]
+            del self._keys[bisect_left(self._keys, key)]
+
+    #Removes many (key, book) pairs, the keys left without books are dropped from the sorted list in one pass
+    def remove_many(self, pairs):
+        emptied = False
+        for key, book in pairs:
+            books = self._books.get(key)
+            if books is None or books.pop(book.get_id(), None) is None: continue
+            self._size -= 1
+            if not books:
+                del self._books[key]
+                emptied = True
+        if emptied: self._keys = [key for key in self._keys if key in self._books]
+
+    #Yields the books with low <= key <= high in key order, either bound can be None for an open range
+    def range(self, low=None, high=None):
+        start = 0 if low is None else bisect_left(self._keys, low)
+        end = len(self._keys) if high is None else bisect_right(self._keys, high)
+        for i in range(start, end): yield from self._books[self._keys[i]].values()
+
+#Bounded LRU cache of search results, each entry maps a normalized query (field, key) to the matching books. The book list drops exactly the entries whose key a change touches, so cached results are never stale
+class SearchCache:
+    def __init__(self, capacity=1024):
+        self._capacity = capacity
+        self._entries = OrderedDict()
+        #Bumped by every invalidation, a result worked out while the books changed is not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    #Returns (results, generation). results is None on a miss, the generation is then handed back to put
+    def get(self, key):
+        with self._lock:
+            results = self._entries.get(key)
+            if results is None: self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+            return results, self._generation
+
+    def put(self, key, results, generation):
+        if self._capacity <= 0: return
+        with self._lock:
+            if generation != self._generation: return
+            self._entries[key] = results
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, keys):
+        with self._lock:
+            self._generation += 1
+            if not self._entries: return
+            for key in keys:
+                if self._entries.pop(key, None) is not None: self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, "evictions": self._evictions, "invalidations": self._invalidations,
+                "entries": len(self._entries), "capacity": self._capacity}
+
 class BookList():
+    #Number of searches whose results are kept, and the most matches a kept result may have. Bigger results are
+    #read from the indexes as they are taken, like without the cache
+    SEARCH_CACHE_SIZE = 1024
+    SEARCH_CACHE_RESULTS = 1000
+
     def __init__(self):
         #container to hold the books
         self._books = []
+        #Maps book ids to book objects, kept in sync with _books for constant time lookups
+        self._index = {}
+        #Case folded secondary indexes used by the searches, each one maps {key: {bookID: book}}
+        self._fieldIndexes = {"title": {}, "authors": {}, "publisher": {}, "pubdate": {}}
+        #Word index used by the keyword search. With a storage that can't run keyword searches itself it is built from
+        #all the stored books the first time one is made (see _keyword_index), until then it isn't complete
+        self._searchIndex = BookSearchIndex()
+        self._searchIndexComplete = True
+        #Sorted indexes used by the range searches
+        self._rangeIndexes = {"year": SortedIndex(), "pubdate": SortedIndex()}
+        #LibraryObservers told about every change made to the list and its books
+        self._observers = []
+        #Objects (e.g loans) asked which books are still in use before any are deleted, see delete_books
+        self._guards = []
+        #Results of the field searches, see iter_books_by
+        self._searchCache = SearchCache(self.SEARCH_CACHE_SIZE)
+        #When set, the books live in this storage and only the ones used so far are kept in memory
+        self._storage = None
     
     #This makes the class iterable
-    def __iter__(self): return (t for t in self._books)
+    def __iter__(self):
+        if self._storage is not None: return (self.get_book_by_id(id) for id in self._storage.iter_book_ids())
+        return (t for t in self._books)
     
-    #Function to display books and asks user to pick one, returns a book object
-    def print_and_get_books(self, get_object = True):
-        if self._books:
-            print()
-            print("---------------PICK A BOOK------------------")
-            for i, book in enumerate(self._books): print(str(i+1)+". "+book.get_title())
-            index = handleInput(input("\nEnter the index of the book to pick: "), "Error: Enter between 1 and "+str(len(self._books))+": ", list(map(lambda x: str(x), range(1, len(self._books)+1))))
-            if get_object: return self._books[int(index)-1]
-            return self._books[int(index)-1].get_id()
-        else: print("You have no books in the book list")
+    #Function to display books a page at a time and asks user to pick one, returns a book object
+    def print_and_get_books(self, get_object = True, pageSize = 20):
+        book = pickFromPages(self, lambda book: book.get_title(), "book", pageSize)
+        if book is None:
+            print("You have no books in the book list")
+            return None
+        if get_object: return book
+        return book.get_id()
+
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
+    #A guard has books_in_use(bookIDs), returning the ids that must not be deleted, release_books(books), and
+    #books_deleted(books) which is told the books once they are deleted
+    def add_guard(self, guard):
+        self._guards.append(guard)
+
+    #Keeps the books in storage. With preload all of them are read into memory now, otherwise
+    #lookups and searches are answered by the storage and books are only loaded when they are used
+    def attach_storage(self, storage, preload=False):
+        self._searchCache.clear()
+        recordIDs.reserve(storage.max_record_id())
+        for book in self._books: storage.book_added(book)
+        if preload:
+            for book in storage.iter_books():
+                if book.get_id() not in self._index: self._insert_book(book)
+        else:
+            self._storage = storage
+            self._searchIndexComplete = False
+        self.add_observer(storage)
 
     def get_total_books(self):
+        if self._storage is not None: return self._storage.count_books()
         return len(self._books)
     def get_books(self):
         return self._books
     def add_book(self, book):
-        # We map the book objects to their hash ids here.
-        if book.get_id() in map(lambda x: x.get_id(), self.get_books()):
+        # We map the book objects to their ids here.
+        if self.has_book(book):
             print ("Error: Book already in the library.")
         else:
-            self._books.append(book)
+            self._insert_book(book)
+            for observer in self._observers: observer.book_added(book)
+            self._forget_searches(book)
             print("Book added.")
+    #Adds many books at once without printing, the books already in the list are skipped (and put in skipped as
+    #(book, reason) when a list is given). Returns the number added.
+    #With a storage attached the books are only handed to it, they are loaded back when used
+    def add_books(self, books, skipped=None):
+        new, seen = [], set()
+        for book in books:
+            if book.get_id() in seen or self.has_book(book):
+                if skipped is not None: skipped.append((book, "book already in the library"))
+                continue
+            seen.add(book.get_id())
+            new.append(book)
+        if self._storage is not None:
+            if self._searchIndexComplete: self._searchIndex.add_many(new)
+            for book in new:
+                for observer in self._observers: observer.book_added(book)
+                self._forget_searches(book)
+            return len(new)
+        for book in new:
+            self._books.append(book)
+            self._index[book.get_id()] = book
+            for field in self._fieldIndexes: self._index_add(field, self._field_value(book, field), book)
+            book._watchers.append(self)
+        for field, index in self._rangeIndexes.items(): index.add_many([(self._field_value(book, field), book) for book in new])
+        self._searchIndex.add_many(new)
+        for book in new:
+            for observer in self._observers: observer.book_added(book)
+            self._forget_searches(book)
+        return len(new)
     def has_book(self, book):
-        if book.get_id() in map(lambda x: x.get_id(), self.get_books()):
-            return True
-        else:
-            return False
+        if book.get_id() in self._index: return True
+        return self._storage is not None and self._storage.has_book(book.get_id())
+    #Returns the book with the given id, or None if it is not in the list
+    def get_book_by_id(self, id):
+        book = self._index.get(id)
+        if book is None and self._storage is not None:
+            book = self._storage.load_book(id)
+            if book is not None: self._insert_book(book)
+        return book
+
+    #Adds the book to the container and indexes without telling the observers
+    def _insert_book(self, book):
+        self._books.append(book)
+        self._index[book.get_id()] = book
+        self._index_book(book)
+        book._watchers.append(self)
     
-    def search_by_title(self, title):
-        details = """
-        Books with title: """
+    #Returns the index keys of a field value, strings are case folded so searches ignore case
+    def _field_keys(self, field, value):
+        if field == "authors": return {author.casefold() for author in value}
+        if field == "pubdate": return [value]
+        return [value.casefold()]
+
+    def _field_value(self, book, field):
+        if field == "title": return book.get_title()
+        if field == "authors": return book.get_authors()
+        if field == "publisher": return book.get_publisher()
+        if field == "pubdate": return book.get_publicationDate()
+        if field == "year": return book.get_year()
+
+    def _index_add(self, field, value, book):
+        index = self._fieldIndexes[field]
+        for key in self._field_keys(field, value):
+            if key in index: index[key][book.get_id()] = book
+            else: index[key] = {book.get_id(): book}
+
+    def _index_remove(self, field, value, book):
+        index = self._fieldIndexes[field]
+        for key in self._field_keys(field, value):
+            matches = index.get(key)
+            if matches is None: continue
+            matches.pop(book.get_id(), None)
+            if not matches: del index[key]
+
+    def _index_book(self, book):
+        for field in self._fieldIndexes: self._index_add(field, self._field_value(book, field), book)
+        for field, index in self._rangeIndexes.items(): index.add(self._field_value(book, field), book)
+        self._searchIndex.add(book)
+
+    def _unindex_book(self, book):
+        for field in self._fieldIndexes: self._index_remove(field, self._field_value(book, field), book)
+        for field, index in self._rangeIndexes.items(): index.remove(self._field_value(book, field), book)
+        self._searchIndex.remove(book)
+
+    def _unindex_books(self, books):
+        for book in books:
+            for field in self._fieldIndexes: self._index_remove(field, self._field_value(book, field), book)
+        for field, index in self._rangeIndexes.items(): index.remove_many([(self._field_value(book, field), book) for book in books])
+        self._searchIndex.remove_many(books)
+
+    #Called by a book in this list whenever one of its fields is modified
+    def book_changed(self, book, field, oldValue):
+        if field in self._fieldIndexes:
+            self._index_remove(field, oldValue, book)
+            self._index_add(field, self._field_value(book, field), book)
+        if field in self._rangeIndexes:
+            self._rangeIndexes[field].remove(oldValue, book)
+            self._rangeIndexes[field].add(self._field_value(book, field), book)
+        if field in BookSearchIndex.FIELD_WEIGHTS: self._searchIndex.update(book)
+        for observer in self._observers: observer.book_changed(book, field, oldValue)
+        if field in self._fieldIndexes:
+            self._searchCache.invalidate([(field, key) for value in (oldValue, self._field_value(book, field)) for key in self._field_keys(field, value)])
+
+    #Drops the cached searches the book matches, called when it is added, removed or changed
+    def _forget_searches(self, book):
+        self._searchCache.invalidate([(field, key) for field in self._fieldIndexes for key in self._field_keys(field, self._field_value(book, field))])
+
+    def get_search_cache_stats(self):
+        return self._searchCache.get_stats()
+
+    #Yields the books whose field (title, authors, publisher or pubdate) matches the value ignoring case, skipping
+    #offset matches and stopping after limit. The matches are cached by the normalized query. Results too
+    #big to cache are read from the indexes as they are taken, so the first page of a broad search costs little more
+    #than that page. The list shouldn't be changed while the books are being taken
+    def iter_books_by(self, field, value, offset=0, limit=None):
+        if self._storage is not None:
+            books = self._storage.find_books(field, value, None if limit is None else offset + limit)
+            if books is not None: return islice(self._stored_books(books), offset, None)
+        key = (field, value if field == "pubdate" else value.casefold())
+        books, generation = self._searchCache.get(key)
+        if books is None:
+            if self._storage is not None: matches = (self.get_book_by_id(id) for id in self._storage.find_book_ids(field, value))
+            else:
+                index = self._fieldIndexes[field]
+                matches = (book for key in self._field_keys(field, [value] if field == "authors" else value) for book in index.get(key, {}).values())
+            books = tuple(islice(matches, self.SEARCH_CACHE_RESULTS + 1))
+            if len(books) <= self.SEARCH_CACHE_RESULTS: self._searchCache.put(key, books, generation)
+            else: books = chain(books, matches)
+        return islice(books, offset, None if limit is None else offset + limit)
+
+    #Yields the books with start <= field <= end, field is year or pubdate, ordered by the field. Paged like iter_books_by
+    def iter_books_in_range(self, field, start, end, offset=0, limit=None):
+        if self._storage is not None:
+            books = self._storage.books_in_range(field, start, end, None if limit is None else offset + limit)
+            if books is not None: return islice(self._stored_books(books), offset, None)
+            books = (self.get_book_by_id(id) for id in self._storage.book_ids_in_range(field, start, end))
+        else: books = self._rangeIndexes[field].range(start, end)
+        return islice(books, offset, None if limit is None else offset + limit)
+
+    #The books a storage returned for a search, built from its rows. A book already loaded is given instead of its copy
+    #and the others are loaded like get_book_by_id loads them, so a book changed or lent from a search result is the
+    #list's own and the change is stored
+    def _stored_books(self, books):
+        found = []
+        for book in books:
+            loaded = self._index.get(book.get_id())
+            if loaded is None:
+                self._insert_book(book)
+                loaded = book
+            found.append(loaded)
+        return found
+
+    #Yields the best matches of a keyword search from offset, at most limit of them. Ranking needs the best
+    #offset + limit matches to be found first, the search stops as soon as they are known. A storage that
+    #can't run keyword searches returns None, the word index of this list is searched then
+    def iter_keyword_matches(self, query, offset=0, limit=10):
+        books = self._storage.keyword_matches(query, offset + limit) if self._storage is not None else None
+        if books is not None: return islice(self._stored_books(books), offset, None)
+        matches = self._keyword_index().search(query, offset + limit)
+        return islice((self.get_book_by_id(id) for score, id in matches), offset, None)
+
+    #Returns the word index of all the books. A storage's books are indexed from its rows the first time, only their
+    #words are kept so the books aren't held in memory, and the books added since are indexed as they come
+    def _keyword_index(self):
+        if not self._searchIndexComplete:
+            self._searchIndex.add_many(self._storage.iter_books())
+            self._searchIndexComplete = True
+        return self._searchIndex
+
+    #Returns the books whose field matches the value, using the secondary indexes
+    def _find_by(self, field, value):
+        return list(self.iter_books_by(field, value))
+
+    #Prints the books of a search as they are taken, a page at a time, asking before each further page.
+    #With pageSize None every book is printed without asking
+    def _print_books(self, details, books, pageSize):
         print(details)
-        books = [x for x in self.get_books() if x.get_title().lower() == title.lower()]
-        if books:
-            for book in books: book.print_details()
-        else:
+        shown = 0
+        stopped = False
+        books = iter(books)
+        book = next(books, None)
+        while book is not None:
+            book.print_details()
+            shown += 1
+            book = next(books, None)
+            if book is not None and pageSize and shown % pageSize == 0 and not askForMore():
+                stopped = True
+                break
+        if shown == 0:
             details += "<No matching books>"
             print(details)
-        text = """
-        Number of books found: {0}""".format(len(books))
+        if stopped: text = """
+        Number of books shown: {0} (there are more)""".format(shown)
+        else: text = """
+        Number of books found: {0}""".format(shown)
         print(text)
+
+    def search_by_title(self, title, pageSize=10):
+        details = """
+        Books with title: """
+        self._print_books(details, self.iter_books_by("title", title), pageSize)
     
-    def search_by_author_name(self, name):
+    def search_by_author_name(self, name, pageSize=10):
         details = """
         Books by author """
-        print(details)
         # We map books to their author names
-        books = list(filter(lambda x: name in x.get_authors(), self.get_books()))
-        if books:
-            for book in books: book.print_details()
-        else:
-            details += "<No matching books>"
-            print(details)
-        text = """
-        Number of books found: {0}""".format(len(books))
-        print(text)
+        self._print_books(details, self.iter_books_by("authors", name), pageSize)
     
-    def search_by_publisher(self, publisher):
+    def search_by_publisher(self, publisher, pageSize=10):
         details = """
         Books by publisher """
-        print(details)
         # We map books to their publisher
-        books = list(filter(lambda x: x.get_publisher().lower() == publisher.lower(), self.get_books()))
-        if books:
-            for book in books: book.print_details()
-        else:
-            details += "<No matching books>"
-            print(details)
-        text = """
-        Number of books found: {0}""".format(len(books))
-        print(text)
+        self._print_books(details, self.iter_books_by("publisher", publisher), pageSize)
     
-    def search_by_publication_date(self, publication_date):
+    #Ranked search over the words of the titles, authors and publishers, returns the best matching books
+    def search(self, query, limit=10):
+        return list(self.iter_keyword_matches(query, 0, limit))
+
+    def search_by_keywords(self, query, limit=10, pageSize=10):
+        details = """
+        Best matches for """ + query
+        self._print_books(details, self.iter_keyword_matches(query, 0, limit), pageSize)
+
+    def search_by_publication_date(self, publication_date, pageSize=10):
         if not isinstance(publication_date, datetime):
             try: publication_date = datetime.strptime(publication_date, '%Y, %m, %d')
             except ValueError:
@@ -234,37 +1110,104 @@ class BookList():
                 exit()
         details = """
         Books by publication date"""
-        print(details)
         # We map books to their publication date
-        books = list(filter(lambda x: x.get_publicationDate() == publication_date, self.get_books()))
+        self._print_books(details, self.iter_books_by("pubdate", publication_date), pageSize)
+
+    #Returns the books published between the two years (inclusive), ordered by year
+    def get_books_by_year_range(self, start, end):
+        return list(self.iter_books_in_range("year", start, end))
+
+    #Returns the dates as datetimes, or None after printing an error if one isn't in the '2020, 02, 23' format
+    def _range_dates(self, start, end):
+        dates = []
+        for date in (start, end):
+            if not isinstance(date, datetime):
+                try: date = datetime.strptime(date, '%Y, %m, %d')
+                except ValueError:
+                    print("The date format given is not in correct format")
+                    return None
+            dates.append(date)
+        return dates
+
+    #Returns the books published between the two dates (inclusive), ordered by publication date
+    def get_books_by_publication_date_range(self, start, end):
+        dates = self._range_dates(start, end)
+        if dates is None: return []
+        return list(self.iter_books_in_range("pubdate", dates[0], dates[1]))
+
+    def search_by_year_range(self, start, end, pageSize=10):
+        details = """
+        Books published from {0} to {1}""".format(start, end)
+        self._print_books(details, self.iter_books_in_range("year", start, end), pageSize)
+
+    def search_by_publication_date_range(self, start, end, pageSize=10):
+        details = """
+        Books by publication date range"""
+        dates = self._range_dates(start, end)
+        self._print_books(details, self.iter_books_in_range("pubdate", dates[0], dates[1]) if dates else [], pageSize)
+
+    #Takes the book out of the container and indexes and tells the observers, the guards are not asked
+    def _remove_book(self, book):
+        self._remove_books([book])
+
+    #Takes the books out of the container and indexes and tells the observers. The container is filtered once
+    #however many books go, instead of being searched and shifted for each of them
+    def _remove_books(self, books):
+        if not books: return
+        bookIDs = {book.get_id() for book in books}
+        self._books[:] = [book for book in self._books if book.get_id() not in bookIDs]
+        for book in books:
+            del self._index[book.get_id()]
+            book._watchers.remove(self)
+        self._unindex_books(books)
+        for book in books:
+            for observer in self._observers: observer.book_removed(book)
+            self._forget_searches(book)
+
+    def delete_books(self, ids=None, predicate=None, returnLoans=False):
+        """
+        ids: ids of the books to delete, the ones not in the list are ignored
+        predicate: function given each book, the books it returns True for are deleted (with ids, only those books are tried)
+        returnLoans: end the outstanding loans of the books and delete them, instead of keeping the books that are on loan
+        Returns (deleted, kept), the books deleted and the books kept because they are on loan
+        """
+        if ids is not None: books = [book for book in {id: self.get_book_by_id(id) for id in ids}.values() if book is not None]
+        else: books = list(self)
+        if predicate is not None: books = [book for book in books if predicate(book)]
+        kept = []
+        if returnLoans:
+            for guard in self._guards: guard.release_books(books)
+        elif books and self._guards:
+            inUse = set()
+            for guard in self._guards: inUse.update(guard.books_in_use([book.get_id() for book in books]))
+            if inUse:
+                kept = [book for book in books if book.get_id() in inUse]
+                books = [book for book in books if book.get_id() not in inUse]
+        self._remove_books(books)
         if books:
-            for book in books: book.print_details()
-        else:
-            details += "<No matching books>"
-            print(details)
-        text = """
-        Number of books found: {0}""".format(len(books))
-        print(text)
+            for guard in self._guards: guard.books_deleted(books)
+        return books, kept
 
     def delete_book_by_title(self, title):
-        books = [x for x in self.get_books() if x.get_title().lower() == title.lower()]
+        books = self._find_by("title", title)
         if books:
-            for book in books:
-                index = 0
-                book_id = book.get_id()
-                for each_book in self.get_books():
-                    if book_id == each_book.get_id():
-                        break
-                    index += 1
-                self._books.pop(index)
-            print("Book(s) deleted.")
+            books, kept = self.delete_books([book.get_id() for book in books])
+            if books: print("Book(s) deleted.")
+            if kept: print(len(kept), "book(s) on loan were not deleted")
         else:
             print("<No matching book to delete>")
 
 #The user class
 class User:
+    __slots__ = ("_id_key", "_watchers", "_username", "_firstname", "_surname", "_houseNumber", "_streetname", "_postcode", "_email", "_dateOfBirth")
+    #The attribute each field that can be changed is kept in
+    FIELDS = {"firstname": "_firstname", "surname": "_surname", "houseNumber": "_houseNumber", "streetname": "_streetname",
+        "postcode": "_postcode", "email": "_email", "dateOfBirth": "_dateOfBirth"}
+
     def __init__(self, username="", firstname="", surname="", houseNumber="", streetname="", postcode="", email="", dateOfBirth=""):
-        self._id_key = hash(self)
+        self._id_key = recordIDs.allocate()
+        #Objects (e.g user lists) that are told when a field of this user changes
+        self._watchers = []
         self._username = handleInput(input("Enter a username (userID="+str(self._id_key)+"): "), "Error: Enter a valid username: (userID="+str(self._id_key)+"): ") if username == "" else handleInput(username, "Error: Enter a valid username: (userID="+str(self._id_key)+"): ")
         self._firstname = handleInput(input("Enter a firstname (userID="+str(self._id_key)+"): "), "Error: Enter a valid firstname: (userID="+str(self._id_key)+"): ") if firstname == "" else handleInput(firstname, "Error: Enter a valid firstname: (userID="+str(self._id_key)+"): ")
         self._surname = handleInput(input("Enter a surname (userID="+str(self._id_key)+"): "), "Error: Enter a valid surname: (userID="+str(self._id_key)+"): ") if surname == "" else handleInput(surname, "Error: Enter a valid surname: (userID="+str(self._id_key)+"): ")
@@ -274,44 +1217,88 @@ class User:
         self._email = handleInput(input("Enter an email (userID="+str(self._id_key)+"): "), "Error: Enter a valid email address: (userID="+str(self._id_key)+"): ", MailAddress) if email == "" else handleInput(email, "Error: Enter a valid email address: (userID="+str(self._id_key)+"): ", MailAddress)
         self._dateOfBirth = handleInput(input("Enter Date of Birth: Year, Month, Day. E.g 2020, 02, 23 (userID="+str(self._id_key)+"): "), "", datetime) if dateOfBirth == "" else handleInput(dateOfBirth, "", datetime)
     
+    #Builds a user from values that are already valid, e.g a row loaded from storage, without asking for input
+    #A new user gets a new id like one made by the constructor when id is None
+    @classmethod
+    def from_record(self, id, username, firstname, surname, houseNumber, streetname, postcode, email, dateOfBirth):
+        user = self.__new__(self)
+        if id is None: id = recordIDs.allocate()
+        else: recordIDs.reserve(id)
+        user._id_key = id
+        user._watchers = []
+        user._username = username
+        user._firstname = firstname
+        user._surname = surname
+        user._houseNumber = houseNumber
+        user._streetname = streetname
+        user._postcode = postcode
+        user._email = email
+        user._dateOfBirth = dateOfBirth
+        return user
+
     def get_id(self):
         return self._id_key
     def get_username(self):
         return self._username
+
+    #Tells the watchers that a field changed, passing along its previous value
+    def _notify(self, field, oldValue):
+        for watcher in self._watchers: watcher.user_changed(self, field, oldValue)
+
+    #Sets a field to a value that is already valid (e.g replayed from the journal) and tells the watchers, like Book._set_field
+    def _set_field(self, field, value):
+        attribute = self.FIELDS[field]
+        oldValue = getattr(self, attribute)
+        setattr(self, attribute, value)
+        self._notify(field, oldValue)
     
     def get_firstname(self):
         return self._firstname
     def set_firstname(self, firstname):
+        oldFirstname = self._firstname
         self._firstname = handleInput(firstname, errorCount=0)
+        self._notify("firstname", oldFirstname)
 
     def get_surname(self):
         return self._surname
     def set_surname(self, surname):
+        oldSurname = self._surname
         self._surname = handleInput(surname, errorCount=0)
+        self._notify("surname", oldSurname)
     
     
     def get_houseNumber(self):
         return self._houseNumber
     def set_houseNumber(self, number):
+        oldHouseNumber = self._houseNumber
         self._houseNumber = handleInput(number, "", int, errorCount=0)
+        self._notify("houseNumber", oldHouseNumber)
     def get_streetname(self):
         return self._streetname
     def set_streetname(self, streetname):
+        oldStreetname = self._streetname
         self._streetname = handleInput(streetname, errorCount=0)
+        self._notify("streetname", oldStreetname)
     def get_postcode(self):
         return self._postcode
     def set_postcode(self, postcode):
+        oldPostcode = self._postcode
         self._postcode = handleInput(postcode, errorCount=0)
+        self._notify("postcode", oldPostcode)
 
     def get_email(self):
         return self._email
     def set_email(self, email):
+        oldEmail = self._email
         self._email = handleInput(email, errorCount=0, expected=MailAddress)
+        self._notify("email", oldEmail)
 
     def get_dateOfBirth(self):
         return self._dateOfBirth
     def set_dateOfBirth(self, dateOfBirth):
+        oldDateOfBirth = self._dateOfBirth
         self._dateOfBirth = handleInput(dateOfBirth, errorCount=0, expected=datetime)
+        self._notify("dateOfBirth", oldDateOfBirth)
     def print_details(self):
         details = """
         Username: {0}
@@ -329,158 +1316,2941 @@ class User:
 class UserList:
     def __init__(self):
         self._users = []
+        #Maps user ids to user objects, kept in sync with _users for constant time lookups
+        self._index = {}
+        #Maps case folded usernames to the users in memory. Usernames are unique, they name a user like the id does
+        self._usernames = {}
+        #LibraryObservers told about every change made to the list and its users
+        self._observers = []
+        #Objects (e.g loans) asked which users are still in use before any are deleted, see delete_users
+        self._guards = []
+        #When set, the users live in this storage and only the ones used so far are kept in memory
+        self._storage = None
 
-    #Function to display users and asks user to pick one, returns a user object
-    def print_and_get_users(self, get_object = True):
-        if self._users:
-            print()
-            print("---------------PICK A USER------------------")
-            for i, user in enumerate(self._users): print(str(i+1)+". "+user.get_firstname(), user.get_surname())
-            index = handleInput(input("\nEnter the index of the user to pick: "), "Error: Enter between 1 and "+str(len(self._users))+": ", list(map(lambda x: str(x), range(1, len(self._users)+1))))
-            if get_object: return self._users[int(index)-1]
-            return self._users[int(index)-1].get_id()
-        else: print("You have no users in the user list")
+    #Function to display users a page at a time and asks user to pick one, returns a user object
+    def print_and_get_users(self, get_object = True, pageSize = 20):
+        user = pickFromPages(self, lambda user: user.get_firstname() + " " + user.get_surname(), "user", pageSize)
+        if user is None:
+            print("You have no users in the user list")
+            return None
+        if get_object: return user
+        return user.get_id()
+
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
+    #A guard has users_in_use(userIDs), returning the ids that must not be deleted, release_users(users), and
+    #users_deleted(users) which is told the users once they are deleted
+    def add_guard(self, guard):
+        self._guards.append(guard)
+
+    #Keeps the users in storage. With preload all of them are read into memory now, otherwise
+    #lookups are answered by the storage and users are only loaded when they are used
+    def attach_storage(self, storage, preload=False):
+        recordIDs.reserve(storage.max_record_id())
+        for user in self._users: storage.user_added(user)
+        if preload:
+            for user in storage.iter_users():
+                if user.get_id() not in self._index: self._insert_user(user)
+        else: self._storage = storage
+        self.add_observer(storage)
 
     def get_total_users(self):
+        if self._storage is not None: return self._storage.count_users()
         return len(self._users)
     def get_users(self):
         return self._users
     def add_user(self, user):
-        # We map the user objects to their hash ids here.
-        if user.get_id() in map(lambda x: x.get_id(), self.get_users()):
+        # We map the user objects to their ids here.
+        if self.has_user(user):
             print ("Error: User already in the user list.")
+        elif self.get_user_by_username(user.get_username()) is not None:
+            print ("Error: Username " + user.get_username() + " is already taken.")
         else:
-            self._users.append(user)
+            self._insert_user(user)
+            for observer in self._observers: observer.user_added(user)
             print("User added.")
 
+    #Adds many users at once without printing, the users already in the list or whose username is taken are skipped
+    #(and put in skipped as (user, reason) when a list is given). Returns the number added.
+    #With a storage attached the users are only handed to it, they are loaded back when used
+    #The whole batch is checked first, with one lookup of its ids and usernames in the storage, then added. Checking
+    #each user after adding the one before makes a database write every user before it can be looked up
+    def add_users(self, users, skipped=None):
+        users = list(users)
+        storedIDs, storedUsernames = set(), set()
+        if self._storage is not None:
+            storedIDs, storedUsernames = self._storage.find_users([user.get_id() for user in users], [user.get_username() for user in users])
+        new, seenIDs, seenUsernames = [], set(), set()
+        for user in users:
+            username = user.get_username().casefold()
+            if user.get_id() in seenIDs or user.get_id() in self._index or user.get_id() in storedIDs: reason = "user already in the user list"
+            elif username in seenUsernames or username in self._usernames or username in storedUsernames: reason = "username already taken"
+            else:
+                seenIDs.add(user.get_id())
+                seenUsernames.add(username)
+                new.append(user)
+                continue
+            if skipped is not None: skipped.append((user, reason))
+        for user in new:
+            if self._storage is None: self._insert_user(user)
+            for observer in self._observers: observer.user_added(user)
+        return len(new)
+
     def has_user(self, user):
-        if user.get_id() in map(lambda x: x.get_id(), self.get_users()):
-            return True
-        else:
-            return False
+        if user.get_id() in self._index: return True
+        return self._storage is not None and self._storage.has_user(user.get_id())
+    #Returns the user with the given id, or None if it is not in the list
+    def get_user_by_id(self, id):
+        user = self._index.get(id)
+        if user is None and self._storage is not None:
+            user = self._storage.load_user(id)
+            if user is not None: self._insert_user(user)
+        return user
+
+    #Returns the user with the username (ignoring case), or None if there is none in the list
+    def get_user_by_username(self, username):
+        user = self._usernames.get(username.casefold())
+        if user is None and self._storage is not None:
+            ids = self._storage.find_user_ids("username", username)
+            if ids: user = self.get_user_by_id(ids[0])
+        return user
+
+    #Adds the user to the container and indexes without telling the observers
+    def _insert_user(self, user):
+        self._users.append(user)
+        self._index[user.get_id()] = user
+        self._usernames[user.get_username().casefold()] = user
+        user._watchers.append(self)
+
+    #Takes the user out of the container and index and tells the observers, the guards are not asked
+    def _remove_user(self, user):
+        self._remove_users([user])
+
+    #Takes the users out of the container and index and tells the observers, the container is filtered once
+    def _remove_users(self, users):
+        if not users: return
+        userIDs = {user.get_id() for user in users}
+        self._users[:] = [user for user in self._users if user.get_id() not in userIDs]
+        for user in users:
+            del self._index[user.get_id()]
+            if self._usernames.get(user.get_username().casefold()) is user: del self._usernames[user.get_username().casefold()]
+            user._watchers.remove(self)
+        for user in users:
+            for observer in self._observers: observer.user_removed(user)
+
+    def delete_users(self, ids=None, predicate=None, returnLoans=False):
+        """
+        ids: ids of the users to delete, the ones not in the list are ignored
+        predicate: function given each user, the users it returns True for are deleted (with ids, only those users are tried)
+        returnLoans: take back the books the users borrowed and delete them, instead of keeping the users that have books on loan
+        Returns (deleted, kept), the users deleted and the users kept because they have books on loan
+        """
+        if ids is not None: users = [user for user in {id: self.get_user_by_id(id) for id in ids}.values() if user is not None]
+        else: users = list(self)
+        if predicate is not None: users = [user for user in users if predicate(user)]
+        kept = []
+        if returnLoans:
+            for guard in self._guards: guard.release_users(users)
+        elif users and self._guards:
+            inUse = set()
+            for guard in self._guards: inUse.update(guard.users_in_use([user.get_id() for user in users]))
+            if inUse:
+                kept = [user for user in users if user.get_id() in inUse]
+                users = [user for user in users if user.get_id() not in inUse]
+        self._remove_users(users)
+        if users:
+            for guard in self._guards: guard.users_deleted(users)
+        return users, kept
+
+    #Called by a user in this list whenever one of its fields is modified
+    def user_changed(self, user, field, oldValue):
+        for observer in self._observers: observer.user_changed(user, field, oldValue)
 
     def remove_user_by_firstname(self, firstname):
-        users = [x for x in self.get_users() if x.get_firstname().lower() == firstname.lower()]
+        if self._storage is not None: users = [self.get_user_by_id(id) for id in self._storage.find_user_ids("firstname", firstname)]
+        else: users = [x for x in self.get_users() if x.get_firstname().lower() == firstname.lower()]
         if users:
             if len(users) > 1:
                 print("There are", len(users), "users with this firstname")
                 for i, user in enumerate(users): print(str(i+1)+". "+user.get_firstname(), user.get_surname())
-                index = handleInput(input("\nEnter the index of the user to delete: "), "Error: Enter between 1 and "+str(len(users))+": ", list(map(lambda x: str(x), range(1, len(users)+1))))
-                user_id = users[int(index)-1].get_id()
-                index = 0
-                for each_user in self.get_users():
-                    if user_id == each_user.get_id():
-                        break
-                    index += 1
-                self._users.pop(index)
+                index = handleInput(input("\nEnter the index of the user to delete: "), "Error: Enter between 1 and "+str(len(users))+": ", range(1, len(users)+1))
+                user = users[int(index)-1]
             else:
-                index = 0
-                user_id = users[0].get_id()
-                for each_user in self.get_users():
-                    if user_id == each_user.get_id():
-                        break
-                    index += 1
-                self._users.pop(index)
-            print("user deleted")
+                user = users[0]
+            if self.delete_users([user.get_id()])[0]: print("user deleted")
+            else: print("The user has books on loan and was not deleted")
         else:
-            details += "<No user to remove>"
+            print("<No user to remove>")
 
     #Makes this userlist iterable
-    def __iter__(self): return (t for t in self._users)
+    def __iter__(self):
+        if self._storage is not None: return (self.get_user_by_id(id) for id in self._storage.iter_user_ids())
+        return (t for t in self._users)
 
 #The loan class
 class Loans:
-    def __init__(self, books, users):
+    #Number of locks the books are spread over, two books only wait for each other when they share a lock
+    LOCK_STRIPES = 64
+    #Results of the books given to borrow_many and return_many
+    OK = "ok"
+    NO_SUCH_BOOK = "no such book"
+    NO_SUCH_USER = "no such user"
+    GIVEN_TWICE = "book given more than once"
+    NO_COPIES = "no copies available"
+    ALREADY_BORROWED = "already borrowed by the user"
+    NOT_BORROWED = "not borrowed by the user"
+    NOT_DONE = "not done, another book failed"
+
+    def __init__(self, books, users, loanPeriod = 14, pickupPeriod = 7):
+        """
+        books: the BookList loans are made from
+        users: the UserList of the borrowers
+        loanPeriod: number of days a book may be kept before it is overdue
+        pickupPeriod: number of days a copy returned for a hold is kept for the holder before it goes to the next one
+        """
         self._books = books
         self._users = users
+        self._loanPeriod = timedelta(days=loanPeriod)
         #The structure the holds loaning of books to user is dictionary that maps book to many users
         self.borrowedBooks = {}
+        #The reverse of borrowedBooks, maps a user to the books they borrowed. Both are updated together
+        self.loanedUsers = {}
+        #Maps (bookID, userID) to (borrowedAt, dueAt, loan number) for every outstanding loan
+        self.loanDates = {}
+        #Min-heap of (dueAt, loan number, bookID, userID). Returned loans are left in it and skipped,
+        #an entry is only current while loanDates holds the same loan number
+        self._dueHeap = []
+        self._staleEntries = 0
+        self._loanCount = 0
+        #Holds on books with no copies left, served first come first served as copies are returned.
+        #Maps bookID to a deque of (hold number, userID), a cancelled hold is left in its deque and skipped
+        #like the due dates, an entry is only current while waitingHolds holds the same hold number
+        self._pickupPeriod = timedelta(days=pickupPeriod)
+        self._holdQueues = {}
+        self.waitingHolds = {}
+        #Maps (bookID, userID) to (expiresAt, hold number) for the holds a returned copy is kept for. The copies
+        #stay counted in availableCopies (they are on the shelf) and setAside counts them per book so no one else
+        #borrows them. Min-heap of (expiresAt, hold number, bookID, userID) like _dueHeap
+        self.readyHolds = {}
+        self.setAside = {}
+        self._pickupHeap = []
+        self._stalePickups = 0
+        self._holdCount = 0
+        #Maps userID to the ids of the books they have holds on, waiting or ready
+        self.userHolds = {}
+        #Borrowing and returning check and update a book under its lock, so several threads (e.g checkout
+        #terminals) can lend different books at once without ever handing out more copies than there are.
+        #The user index and due dates are shared by all books, they have their own lock held only briefly
+        self._bookLocks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._indexLock = threading.Lock()
+        #LibraryObservers told about every loan and return
+        self._observers = []
+        #Books and users on loan can't be deleted from the lists unless their loans are ended first
+        books.add_guard(self)
+        users.add_guard(self)
+
+    def _book_lock(self, bookID):
+        return self._bookLocks[hash(bookID) % self.LOCK_STRIPES]
+
+    #Takes every book lock and then the index lock, in the order the other methods take them, so no loan, return or
+    #hold changes until _unlock_all. Used to read all the loans as of one moment, e.g for a snapshot
+    def _lock_all(self):
+        for lock in self._bookLocks: lock.acquire()
+        self._indexLock.acquire()
+
+    def _unlock_all(self):
+        self._indexLock.release()
+        for lock in self._bookLocks: lock.release()
+
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
+    #Keeps the loans in storage, the loans already stored are read back into memory
+    def attach_storage(self, storage):
+        for bookID, userIDs in self.borrowedBooks.items():
+            for userID in userIDs:
+                borrowedAt, dueAt, _ = self.loanDates[(bookID, userID)]
+                storage.loan_added(self._books.get_book_by_id(bookID), self._users.get_user_by_id(userID), borrowedAt, dueAt)
+        for bookID, userID, borrowedAt, dueAt in storage.iter_loans(): self._restore_loan(bookID, userID, borrowedAt, dueAt)
+        self.add_observer(storage)
+
+    #Puts back a loan read from storage or a snapshot, the book's copies already account for it.
+    #Loans saved before due dates were kept count as borrowed now
+    def _restore_loan(self, bookID, userID, borrowedAt = None, dueAt = None):
+        if userID in self.borrowedBooks.get(bookID, []): return
+        self.borrowedBooks.setdefault(bookID, []).append(userID)
+        with self._indexLock:
+            self.loanedUsers.setdefault(userID, []).append(bookID)
+            self._add_due_date(bookID, userID, borrowedAt, dueAt)
+
+    #Records when the loan was made and is due back, and returns both. The caller holds _indexLock
+    def _add_due_date(self, bookID, userID, borrowedAt, dueAt):
+        if borrowedAt is None: borrowedAt = datetime.now()
+        if dueAt is None: dueAt = borrowedAt + self._loanPeriod
+        self._loanCount += 1
+        self.loanDates[(bookID, userID)] = (borrowedAt, dueAt, self._loanCount)
+        heapq.heappush(self._dueHeap, (dueAt, self._loanCount, bookID, userID))
+        return borrowedAt, dueAt
+
+    #The caller holds _indexLock
+    def _remove_due_date(self, bookID, userID):
+        del self.loanDates[(bookID, userID)]
+        self._staleEntries += 1
+        #Once most of the heap is returned loans it is rebuilt from the outstanding ones
+        if self._staleEntries > len(self.loanDates) + 64:
+            self._dueHeap = [(dueAt, number, bookID, userID) for (bookID, userID), (_, dueAt, number) in self.loanDates.items()]
+            heapq.heapify(self._dueHeap)
+            self._staleEntries = 0
+
+    #Yields (dueAt, bookID, userID) for the outstanding loans due up to limit, earliest first.
+    #The heap is walked from the root keeping the frontier in a second heap, so getting k loans
+    #costs O(k log k) and the loans due later are never looked at. The caller holds _indexLock.
+    #heap and dates can be _pickupHeap and readyHolds to walk the holds by when their copies stop being kept
+    def _iter_due(self, limit, heap = None, dates = None):
+        if heap is None: heap, dates = self._dueHeap, self.loanDates
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier:
+            entry, i = heapq.heappop(frontier)
+            dueAt, number, bookID, userID = entry
+            if dueAt > limit: continue
+            for child in (2*i + 1, 2*i + 2):
+                if child < len(heap): heapq.heappush(frontier, (heap[child], child))
+            current = dates.get((bookID, userID))
+            if current is not None and current[-1] == number: yield dueAt, bookID, userID
+
+    #Returns (borrowedAt, dueAt) of an outstanding loan, or None
+    def get_loan_dates(self, book, user):
+        dates = self.loanDates.get((book.get_id(), user.get_id()))
+        return dates[:2] if dates is not None else None
+
+    #Yields (bookID, userID, borrowedAt, dueAt) for every outstanding loan, like the storages do
+    def iter_loans(self):
+        with self._indexLock: loans = list(self.loanDates.items())
+        for (bookID, userID), (borrowedAt, dueAt, _) in loans: yield bookID, userID, borrowedAt, dueAt
+
+    #Yields (dueAt, book, user) for every loan overdue at now (default the current time), the most overdue first
+    def iter_overdue_loans(self, now = None):
+        if now is None: now = datetime.now()
+        #Only the ids are gathered under the lock, the records are looked up as the loans are consumed
+        with self._indexLock: overdue = [entry for entry in self._iter_due(now) if entry[0] < now]
+        for dueAt, bookID, userID in overdue:
+            yield dueAt, self._books.get_book_by_id(bookID), self._users.get_user_by_id(userID)
+
+    def get_overdue_loans(self, now = None):
+        return list(self.iter_overdue_loans(now))
+
+    #Returns [(dueAt, book, user)] for the loans not yet overdue that are due within the given number of days, earliest first
+    def get_loans_due_within(self, days, now = None):
+        if now is None: now = datetime.now()
+        with self._indexLock: due = [entry for entry in self._iter_due(now + timedelta(days=days)) if entry[0] >= now]
+        return [(dueAt, self._books.get_book_by_id(bookID), self._users.get_user_by_id(userID)) for dueAt, bookID, userID in due]
     
     #traslates the book to users to user to books
     def translateBooksToUsers(self):
-        loanedUsers = {}
-        for bookID, userIDs in self.borrowedBooks.items():
-            for userID in userIDs:
-                if userID in loanedUsers: loanedUsers[userID].append(bookID)
-                else: loanedUsers[userID] = [bookID]
-        return loanedUsers
+        return {userID: list(bookIDs) for userID, bookIDs in self.loanedUsers.items()}
     
     #Given an ID returns the object
     def IDtoObject(self, id):
-        for obj in self._books:
-            if id == obj.get_id(): return obj
-        for obj in self._users:
-            if id == obj.get_id(): return obj
+        obj = self._books.get_book_by_id(id)
+        if obj is None: obj = self._users.get_user_by_id(id)
+        return obj
 
+    #Returns the ids of the users currently borrowing the book
+    def get_borrowers_of_book(self, book):
+        return list(self.borrowedBooks.get(book.get_id(), []))
 
-    def borrow_a_book(self, book:Book, user:User):
+    #Returns the ids of the books currently borrowed by the user
+    def get_books_borrowed_by_user(self, user):
+        return list(self.loanedUsers.get(user.get_id(), []))
+
+
+    #Records the loan once it has been checked, updates the copies and tells the observers.
+    #borrowedAt defaults to now and dueAt to the loan period after it. The caller holds the book's lock
+    def _lend(self, book, user, borrowedAt = None, dueAt = None):
         userID = user.get_id()
         bookID = book.get_id()
-        if self._books.has_book(book):
-            if self._users.has_user(user):
-                if book.get_availableCopies() > 0:
-                    if bookID in self.borrowedBooks:
-                        if userID in self.borrowedBooks[bookID]:
-                            #User already boorrowed the book. Can we allow multiple borrowings?
-                            print("User already borrowed this book. We don't allow a single user to take hold of all our collection. Let others read!")
-                            return
-                        else: self.borrowedBooks[bookID].append(userID)
-                    else: self.borrowedBooks[bookID] = [userID]
-                    book.set_availableCopies(book.get_availableCopies() - 1)
-                    print("Book borrowed by user")
-                else:
-                    print("there are no more availble copies of the book")
-            else:
-                print("user has not been added to the userlist")
+        self.borrowedBooks.setdefault(bookID, []).append(userID)
+        with self._indexLock:
+            self.loanedUsers.setdefault(userID, []).append(bookID)
+            borrowedAt, dueAt = self._add_due_date(bookID, userID, borrowedAt, dueAt)
+        #The user's hold on the book, if any, is done with. A copy kept for them is the one they take
+        self._end_hold(bookID, userID)
+        book._set_field("availableCopies", book.get_availableCopies() - 1)
+        for observer in self._observers: observer.loan_added(book, user, borrowedAt, dueAt)
+
+    #Undoes _lend for a loan that is known to exist. The caller holds the book's lock
+    def _take_back(self, book, user):
+        userID = user.get_id()
+        bookID = book.get_id()
+        self.borrowedBooks[bookID].remove(userID) #Removes only one UserID if there are multiple of them
+        if not self.borrowedBooks[bookID]: del self.borrowedBooks[bookID]
+        with self._indexLock:
+            self.loanedUsers[userID].remove(bookID)
+            if not self.loanedUsers[userID]: del self.loanedUsers[userID]
+            self._remove_due_date(bookID, userID)
+        book._set_field("availableCopies", book.get_availableCopies() + 1)
+        for observer in self._observers: observer.loan_removed(book, user)
+        self._serve_next_hold(bookID)
+
+    #Returns the copies of the book free to be borrowed, the ones kept for holds left out. The caller holds the book's lock
+    def _free_copies(self, book):
+        return book.get_availableCopies() - self.setAside.get(book.get_id(), 0)
+
+    #Ends the user's hold on the book, waiting or ready. Returns True when a copy was kept for it, the copy is then
+    #free again and the caller lends it or serves the next hold with it. The caller holds the book's lock
+    def _end_hold(self, bookID, userID):
+        ready = self.readyHolds.pop((bookID, userID), None) is not None
+        if ready:
+            self.setAside[bookID] -= 1
+            if not self.setAside[bookID]: del self.setAside[bookID]
+        elif self.waitingHolds.pop((bookID, userID), None) is None: return False
         else:
-            print("book has not been added to the booklist")
-    
-    def return_a_book(self, book, user):
+            #Holds are usually cancelled or picked up at either end of the queue, the stale entries there are dropped now
+            queue = self._holdQueues[bookID]
+            while queue and self.waitingHolds.get((bookID, queue[-1][1])) != queue[-1][0]: queue.pop()
+            while queue and self.waitingHolds.get((bookID, queue[0][1])) != queue[0][0]: queue.popleft()
+            if not queue: del self._holdQueues[bookID]
+        with self._indexLock:
+            self.userHolds[userID].discard(bookID)
+            if not self.userHolds[userID]: del self.userHolds[userID]
+            if ready:
+                self._stalePickups += 1
+                if self._stalePickups > len(self.readyHolds) + 64:
+                    self._pickupHeap = [(expiresAt, number, bookID, userID) for (bookID, userID), (expiresAt, number) in self.readyHolds.items()]
+                    heapq.heapify(self._pickupHeap)
+                    self._stalePickups = 0
+        return ready
+
+    #Keeps a free copy of the book for each hold at the front of its queue, for as long as there are both. Users
+    #deleted since they placed their hold are skipped, and the holds on a deleted book are ended. Each hold is looked
+    #at once, so this is O(1) per copy returned apart from the cancelled holds it drops. The caller holds the book's lock
+    def _serve_next_hold(self, bookID):
+        queue = self._holdQueues.get(bookID)
+        if not queue: return
+        book = self._books.get_book_by_id(bookID)
+        if book is None:
+            for number, userID in list(queue):
+                if self.waitingHolds.get((bookID, userID)) == number: self._end_hold(bookID, userID)
+            return
+        while queue and self._free_copies(book) > 0:
+            number, userID = queue.popleft()
+            if self.waitingHolds.get((bookID, userID)) != number: continue
+            if self._users.get_user_by_id(userID) is None:
+                self._end_hold(bookID, userID)
+                continue
+            del self.waitingHolds[(bookID, userID)]
+            expiresAt = datetime.now() + self._pickupPeriod
+            self.readyHolds[(bookID, userID)] = (expiresAt, number)
+            self.setAside[bookID] = self.setAside.get(bookID, 0) + 1
+            with self._indexLock: heapq.heappush(self._pickupHeap, (expiresAt, number, bookID, userID))
+        if not queue: self._holdQueues.pop(bookID, None)
+
+    #Returns the ids of the given books that have outstanding loans
+    def books_in_use(self, bookIDs):
+        return {bookID for bookID in bookIDs if bookID in self.borrowedBooks}
+
+    #Returns the ids of the given users that have books on loan
+    def users_in_use(self, userIDs):
+        with self._indexLock: return {userID for userID in userIDs if userID in self.loanedUsers}
+
+    #Ends every outstanding loan of the books, as if the borrowers had returned them
+    def release_books(self, books):
+        for book in books:
+            with self._book_lock(book.get_id()):
+                for userID in list(self.borrowedBooks.get(book.get_id(), [])): self._take_back(book, self._users.get_user_by_id(userID))
+
+    #Ends every hold on the deleted books, the waiting ones and the ones a copy was kept for. The copies kept for
+    #holds aren't indexed by book, so the kept copies are found with one look at all of them whatever the number of books
+    def books_deleted(self, books):
+        bookIDs = {book.get_id() for book in books}
+        ready = {}
+        for bookID, userID in list(self.readyHolds):
+            if bookID in bookIDs: ready.setdefault(bookID, []).append(userID)
+        for bookID in bookIDs:
+            with self._book_lock(bookID):
+                for userID in ready.get(bookID, ()):
+                    if (bookID, userID) in self.readyHolds: self._end_hold(bookID, userID)
+                for number, userID in list(self._holdQueues.get(bookID, ())):
+                    if self.waitingHolds.get((bookID, userID)) == number: self._end_hold(bookID, userID)
+
+    #Ends every hold of the deleted users. A copy kept for one of them is given to the next hold on the book
+    def users_deleted(self, users):
+        for user in users:
+            with self._indexLock: bookIDs = list(self.userHolds.get(user.get_id(), ()))
+            for bookID in bookIDs:
+                with self._book_lock(bookID):
+                    if self._end_hold(bookID, user.get_id()): self._serve_next_hold(bookID)
+
+    #Takes back every book the users have borrowed
+    def release_users(self, users):
+        for user in users:
+            with self._indexLock: bookIDs = list(self.loanedUsers.get(user.get_id(), []))
+            for bookID in bookIDs:
+                with self._book_lock(bookID):
+                    if user.get_id() in self.borrowedBooks.get(bookID, []): self._take_back(self._books.get_book_by_id(bookID), user)
+
+    #Lends the book to the user without printing. Returns None when the book was lent, otherwise the reason it was not
+    def borrow(self, book, user):
         userID = user.get_id()
         bookID = book.get_id()
-        if self._books.has_book(book):
-            if self._users.has_user(user):
-                if bookID in  self.borrowedBooks:
-                    if userID in self.borrowedBooks[bookID]:
-                        self.borrowedBooks[bookID].remove(userID) #Removes only one UserID if there are multiple of them
-                        if not self.borrowedBooks[bookID]: del self.borrowedBooks[bookID]
-                        book.set_availableCopies(book.get_availableCopies() + 1)
-                    else:
-                        print("User", self.IDtoObject(userID).get_username(), "did not borrow this book")
-                else:
-                    print("Book", self.IDtoObject(bookID).get_title(), "has not been borrowed by anyone")
+        if not self._books.has_book(book): return "book has not been added to the booklist"
+        if not self._users.has_user(user): return "user has not been added to the userlist"
+        #The checks and the loan happen under the book's lock so two terminals can't both take the last copy
+        with self._book_lock(bookID):
+            if self._free_copies(book) <= 0 and (bookID, userID) not in self.readyHolds:
+                return "there are no more availble copies of the book, a hold can be placed on it"
+            #User already boorrowed the book. Can we allow multiple borrowings?
+            if userID in self.borrowedBooks.get(bookID, []):
+                return "User already borrowed this book. We don't allow a single user to take hold of all our collection. Let others read!"
+            self._lend(book, user)
+        return None
+
+    #Sets the number of copies of the book without printing. It is done under the book's lock so no loan or return
+    #comes between reading how many copies are on loan and setting the available copies. The copies kept for holds
+    #can't be taken away either, and copies added go to the holds waiting for the book. Returns None when the
+    #copies were set, otherwise the reason they were not
+    def set_copies(self, book, copies):
+        if not self._books.has_book(book): return "book has not been added to the booklist"
+        copies = handleInput(copies, errorCount=0, expected=int)
+        with self._book_lock(book.get_id()):
+            kept = self.setAside.get(book.get_id(), 0)
+            if copies - kept < book.get_copies() - book.get_availableCopies():
+                if kept: return str(kept) + " copies of the book are kept for holds, the book can't have fewer copies than are on loan and kept"
+            error = book.set_copies(copies)
+            if error is None: self._serve_next_hold(book.get_id())
+        return error
+
+    #Takes the book back from the user without printing. Returns None when it was returned, otherwise the reason it was not
+    def give_back(self, book, user):
+        userID = user.get_id()
+        bookID = book.get_id()
+        if not self._books.has_book(book): return "book has not been added to the booklist"
+        if not self._users.has_user(user): return "user has not been added to the userlist"
+        with self._book_lock(bookID):
+            if bookID not in self.borrowedBooks: return "Book " + book.get_title() + " has not been borrowed by anyone"
+            if userID not in self.borrowedBooks[bookID]: return "User " + user.get_username() + " did not borrow this book"
+            self._take_back(book, user)
+        return None
+
+    #Finds the books, given as books or ids, in one pass. Returns [(book or None, result)] with the result OK
+    #or the reason the book can't be used
+    def _resolve_batch(self, books, user):
+        resolved = []
+        seen = set()
+        userFound = self._users.has_user(user)
+        for book in books:
+            if not isinstance(book, Book): book = self._books.get_book_by_id(book)
+            elif not self._books.has_book(book): book = None
+            if book is None: resolved.append((None, self.NO_SUCH_BOOK))
+            elif not userFound: resolved.append((book, self.NO_SUCH_USER))
+            elif book.get_id() in seen: resolved.append((book, self.GIVEN_TWICE))
             else:
-                print("user has not been added to the userlist")
-        else:
-            print("book has not been added to the booklist")
+                seen.add(book.get_id())
+                resolved.append((book, self.OK))
+        return resolved
+
+    #Checks every book with check(book, userID) under the books' locks, and only when none fails gives each to apply.
+    #The locks are taken in order so batches sharing books can't wait on each other
+    def _apply_batch(self, books, user, check, apply):
+        resolved = self._resolve_batch(books, user)
+        userID = user.get_id()
+        stripes = sorted({hash(book.get_id()) % self.LOCK_STRIPES for book, result in resolved if result == self.OK})
+        for stripe in stripes: self._bookLocks[stripe].acquire()
+        try:
+            results = [check(book, userID) if result == self.OK else result for book, result in resolved]
+            if all(result == self.OK for result in results):
+                for book, _ in resolved: apply(book, user)
+                return results
+        finally:
+            for stripe in stripes: self._bookLocks[stripe].release()
+        return [self.NOT_DONE if result == self.OK else result for result in results]
+
+    def _check_borrow(self, book, userID):
+        if self._free_copies(book) <= 0 and (book.get_id(), userID) not in self.readyHolds: return self.NO_COPIES
+        if userID in self.borrowedBooks.get(book.get_id(), []): return self.ALREADY_BORROWED
+        return self.OK
+
+    def _check_return(self, book, userID):
+        if userID not in self.borrowedBooks.get(book.get_id(), []): return self.NOT_BORROWED
+        return self.OK
+
+    #Lends all the books, given as books or ids (e.g as they are scanned at the desk), to the user or none of them.
+    #Returns the result of each book, they were lent only when every result is OK
+    def borrow_many(self, books, user):
+        return self._apply_batch(books, user, self._check_borrow, self._lend)
+
+    #Takes all the books back from the user or none of them. Returns the result of each book like borrow_many
+    def return_many(self, books, user):
+        return self._apply_batch(books, user, self._check_return, self._take_back)
+
+    #Puts the user in the queue for the book without printing. Returns None when the hold was placed, otherwise the
+    #reason it was not. Holds can only be placed on books with no copies free
+    def place_hold(self, book, user):
+        userID = user.get_id()
+        bookID = book.get_id()
+        if not self._books.has_book(book): return "book has not been added to the booklist"
+        if not self._users.has_user(user): return "user has not been added to the userlist"
+        with self._book_lock(bookID):
+            if userID in self.borrowedBooks.get(bookID, []): return "User already borrowed this book"
+            if (bookID, userID) in self.waitingHolds or (bookID, userID) in self.readyHolds: return "User already has a hold on this book"
+            if self._free_copies(book) > 0: return "there are copies of the book available, it can be borrowed instead"
+            self._holdCount += 1
+            self.waitingHolds[(bookID, userID)] = self._holdCount
+            self._holdQueues.setdefault(bookID, deque()).append((self._holdCount, userID))
+            with self._indexLock: self.userHolds.setdefault(userID, set()).add(bookID)
+        return None
+
+    #Removes the user's hold on the book without printing, a copy kept for it goes to the next hold. Returns None
+    #when the hold was cancelled, otherwise the reason it was not
+    def cancel_hold(self, book, user):
+        userID = user.get_id()
+        bookID = book.get_id()
+        with self._book_lock(bookID):
+            if (bookID, userID) not in self.waitingHolds and (bookID, userID) not in self.readyHolds: return "User has no hold on this book"
+            if self._end_hold(bookID, userID): self._serve_next_hold(bookID)
+        return None
+
+    #Returns the user's place in the queue for the book: 0 when a copy is being kept for them, 1 when they are next
+    #and so on, or None when they have no hold on it. Only the holds ahead of the user's are looked at
+    def get_hold_position(self, book, user):
+        userID = user.get_id()
+        bookID = book.get_id()
+        with self._book_lock(bookID):
+            if (bookID, userID) in self.readyHolds: return 0
+            number = self.waitingHolds.get((bookID, userID))
+            if number is None: return None
+            position = 1
+            for entryNumber, entryUserID in self._holdQueues[bookID]:
+                if entryNumber == number: return position
+                if self.waitingHolds.get((bookID, entryUserID)) == entryNumber: position += 1
+
+    #Returns [(book, position)] for the user's holds, position as in get_hold_position
+    def get_holds_of_user(self, user):
+        with self._indexLock: bookIDs = list(self.userHolds.get(user.get_id(), ()))
+        books = [book for book in map(self._books.get_book_by_id, bookIDs) if book is not None]
+        return [(book, position) for book, position in ((book, self.get_hold_position(book, user)) for book in books) if position is not None]
+
+    #Returns [(expiresAt, book, user)] for the copies kept for holds that are given up at now + days (default the
+    #current time) or before, the earliest first. Like the due dates only these holds are looked at
+    def get_holds_expiring_within(self, days = 0, now = None):
+        if now is None: now = datetime.now()
+        with self._indexLock: expiring = list(self._iter_due(now + timedelta(days=days), self._pickupHeap, self.readyHolds))
+        return [(expiresAt, self._books.get_book_by_id(bookID), self._users.get_user_by_id(userID)) for expiresAt, bookID, userID in expiring]
+
+    #Gives the copies kept for holds that weren't picked up by now (default the current time) to the next holds.
+    #Returns [(book, user)] for the holds that were given up
+    def expire_holds(self, now = None):
+        if now is None: now = datetime.now()
+        expired = []
+        with self._indexLock:
+            while self._pickupHeap and self._pickupHeap[0][0] <= now: expired.append(heapq.heappop(self._pickupHeap))
+        given = []
+        for expiresAt, number, bookID, userID in expired:
+            with self._book_lock(bookID):
+                #The hold may have been picked up or cancelled since, then the entry is stale
+                if self.readyHolds.get((bookID, userID)) != (expiresAt, number): continue
+                self._end_hold(bookID, userID)
+                self._serve_next_hold(bookID)
+            given.append((self._books.get_book_by_id(bookID), self._users.get_user_by_id(userID)))
+        return given
+
+    def place_a_hold(self, book, user):
+        error = self.place_hold(book, user)
+        print(error if error else "Hold placed, the user is number " + str(self.get_hold_position(book, user)) + " in the queue")
+
+    def cancel_a_hold(self, book, user):
+        error = self.cancel_hold(book, user)
+        print(error if error else "Hold cancelled")
+
+    def borrow_a_book(self, book:Book, user:User):
+        error = self.borrow(book, user)
+        print(error if error else "Book borrowed by user")
+    
+    def return_a_book(self, book, user):
+        error = self.give_back(book, user)
+        if error: print(error)
     
     def get_number_of_user_borrowed_book(self, user):
         userID = user.get_id()
         if self._users.has_user(user):
-            usersToBook = self.translateBooksToUsers()
-            if userID in usersToBook:
-                return len(usersToBook[userID])
+            if userID in self.loanedUsers:
+                return len(self.loanedUsers[userID])
             else:
                 print("User has no borrowed books")
         else:
             print("user has not been added to the userlist")
     
-    def print_overdue_books(self):
-        if self.borrowedBooks:
-            for bookID, userIDs in self.borrowedBooks.items():
-                if userIDs:
-                    book: Book = self.IDtoObject(bookID)
-                    print()
-                    print(book.get_title())
-                    count = 0
-                    for userID in userIDs:
-                        count += 1
-                        user: User = self.IDtoObject(userID)
-                        print(str(count) + ". " + user.get_username() + " " + user.get_firstname())
-        else:
+    #Prints the overdue loans as they are found, the most overdue first
+    def print_overdue_books(self, now = None):
+        count = 0
+        for dueAt, book, user in self.iter_overdue_loans(now):
+            if count == 0: print()
+            count += 1
+            print(str(count) + ". " + book.get_title() + " - " + user.get_username() + " " + user.get_firstname() + " (due " + dueAt.strftime("%Y-%m-%d") + ")")
+        if count == 0:
             print("No overdue books.")
 
-def handleMenu():
+    def print_loans_due_within(self, days):
+        loans = self.get_loans_due_within(days)
+        if loans:
+            print()
+            for count, (dueAt, book, user) in enumerate(loans, 1):
+                print(str(count) + ". " + book.get_title() + " - " + user.get_username() + " " + user.get_firstname() + " (due " + dueAt.strftime("%Y-%m-%d") + ")")
+        else:
+            print("No books due in the next", days, "days.")
+
+#Keeps every loan ever made as compact columns, so the circulation analytics can count borrowings over the whole
+#history and not only the loans still outstanding. It follows the loans as a LibraryObserver, the outstanding
+#loans are recorded when it is made. The history is kept in memory only
+class LoanHistory(LibraryObserver):
+    def __init__(self, loans = None):
+        self.bookIDs = array("q")
+        self.userIDs = array("q")
+        #Seconds since the epoch the loans were made
+        self.borrowedAt = array("q")
+        #Loans can be made from several threads, the three columns are appended together
+        self._lock = threading.Lock()
+        if loans is not None:
+            for (bookID, userID), (borrowedAt, dueAt, number) in sorted(loans.loanDates.items(), key=lambda loan: loan[1][2]):
+                self.record(bookID, userID, borrowedAt)
+            loans.add_observer(self)
+
+    def __len__(self): return len(self.bookIDs)
+
+    def record(self, bookID, userID, borrowedAt):
+        with self._lock:
+            self.bookIDs.append(bookID)
+            self.userIDs.append(userID)
+            self.borrowedAt.append(int(borrowedAt.timestamp()))
+
+    def loan_added(self, book, user, borrowedAt, dueAt):
+        self.record(book.get_id(), user.get_id(), borrowedAt)
+
+#Circulation figures for management, worked out with NumPy over the whole catalogue at once. The books are read
+#into arrays once (see refresh) and each report is a few group-bys over them, so millions of loans take well under
+#a second. Without a LoanHistory the borrowings counted are the loans outstanding now
+class CirculationAnalytics:
+    def __init__(self, books, history = None):
+        """
+        books: the BookList reported on
+        history: LoanHistory the borrowings are counted from
+        """
+        if np is None: raise ImportError("the circulation analytics need NumPy, install it with: pip install numpy")
+        self._bookList = books
+        self._history = history
+        self.refresh()
+
+    #Reads the catalogue and the borrowings into arrays, call it again to report on later changes
+    def refresh(self):
+        self._books = list(self._bookList)
+        size = len(self._books)
+        ids, copies, onLoan, publisherCodes = array("q"), array("q"), array("q"), array("q")
+        codes = {}
+        for book in self._books:
+            ids.append(book.get_id())
+            copies.append(book.get_copies())
+            onLoan.append(book.get_copies() - book.get_availableCopies())
+            publisherCodes.append(codes.setdefault(book.get_publisher(), len(codes)))
+        self.bookIDs = np.frombuffer(ids, np.int64)
+        self.copies = np.frombuffer(copies, np.int64)
+        self.onLoan = np.frombuffer(onLoan, np.int64)
+        self.publisherCodes = np.frombuffer(publisherCodes, np.int64)
+        self.publishers = list(codes)
+        self.borrowings = self.onLoan if self._history is None else self._count_history(size)
+
+    #Number of times each book was borrowed. The history's book ids are matched to catalogue positions with a
+    #binary search over the sorted ids, loans of books deleted since are dropped
+    def _count_history(self, size):
+        if size == 0: return np.zeros(0, np.int64)
+        with self._history._lock: loaned = np.array(self._history.bookIDs, np.int64)
+        order = np.argsort(self.bookIDs, kind="stable")
+        sortedIDs = self.bookIDs[order]
+        positions = np.minimum(np.searchsorted(sortedIDs, loaned), size - 1)
+        known = sortedIDs[positions] == loaned
+        return np.bincount(order[positions[known]], minlength=size)
+
+    #Positions of the limit largest values, largest first and ties in catalogue order
+    @classmethod
+    def _top(self, values, limit):
+        if limit < len(values): candidates = np.argpartition(-values, limit - 1)[:limit]
+        else: candidates = np.arange(len(values))
+        return candidates[np.lexsort((candidates, -values[candidates]))]
+
+    #Returns [(book, borrowings)] for the limit books borrowed most, most first
+    def most_borrowed(self, limit = 10):
+        return [(self._books[i], int(self.borrowings[i])) for i in self._top(self.borrowings, limit) if self.borrowings[i] > 0]
+
+    #Returns [(publisher, copies, copies on loan, share of the copies on loan)] for every publisher, the busiest first
+    def utilization_by_publisher(self):
+        publishers = len(self.publishers)
+        copies = np.bincount(self.publisherCodes, weights=self.copies, minlength=publishers)
+        onLoan = np.bincount(self.publisherCodes, weights=self.onLoan, minlength=publishers)
+        utilization = np.divide(onLoan, copies, out=np.zeros(publishers), where=copies > 0)
+        return [(self.publishers[i], int(copies[i]), int(onLoan[i]), float(utilization[i])) for i in self._top(utilization, publishers)]
+
+    #Returns [(book, copies, borrowings, borrowings per copy)] for the limit books with the most demand for their
+    #copies, the most first. Books that were borrowed but have no copies left count as infinite demand
+    def demand_ratios(self, limit = 10):
+        ratios = np.divide(self.borrowings, self.copies, out=np.where(self.borrowings > 0, np.inf, 0.0), where=self.copies > 0)
+        return [(self._books[i], int(self.copies[i]), int(self.borrowings[i]), float(ratios[i])) for i in self._top(ratios, limit) if self.borrowings[i] > 0]
+
+    def print_report(self, limit = 10):
+        print()
+        print("Most borrowed books")
+        for count, (book, borrowings) in enumerate(self.most_borrowed(limit), 1):
+            print(str(count) + ". " + book.get_title() + " - borrowed " + str(borrowings) + " time(s)")
+        print()
+        print("Copies on loan by publisher")
+        for count, (publisher, copies, onLoan, utilization) in enumerate(self.utilization_by_publisher()[:limit], 1):
+            print(str(count) + ". " + publisher + " - " + str(onLoan) + " of " + str(copies) + " copies ({0:.0%})".format(utilization))
+        print()
+        print("Most demand per copy")
+        for count, (book, copies, borrowings, ratio) in enumerate(self.demand_ratios(limit), 1):
+            print(str(count) + ". " + book.get_title() + " - " + str(borrowings) + " borrowing(s) for " + str(copies) + " copies ({0:.2f} per copy)".format(ratio))
+
+#Feed of the changes to the catalogue and its availability, so displays and notifications follow the changes instead of
+#polling every book. Each change is an event with the next sequence number, kept in a ring of the last RETAINED events
+#(event n in slot n % RETAINED), so a consumer reads the events after its cursor in O(events read). Consumers pull at
+#their own pace and the desk never waits for them, so the feed is lossy: one that falls more than RETAINED events behind
+#is told it must resync (read gives None, see retained), it then reloads what it shows and carries on from the latest
+#event. Events are (seq, kind, bookID, field, copies, availableCopies),
+#kind is "added", "removed", "availability" (copies or availableCopies changed) or "changed" (another field)
+class ChangeFeed(LibraryObserver):
+    RETAINED = 65536
+
+    def __init__(self, books = None, retained = None):
+        self._size = retained or self.RETAINED
+        self._ring = [None] * self._size
+        self.sequence = 0
+        #Changes come from several threads (e.g checkout terminals), waiting consumers are woken through the condition
+        self._condition = threading.Condition()
+        if books is not None: books.add_observer(self)
+
+    def _publish(self, kind, book, field = None):
+        with self._condition:
+            self.sequence += 1
+            self._ring[self.sequence % self._size] = (self.sequence, kind, book.get_id(), field, book.get_copies(), book.get_availableCopies())
+            self._condition.notify_all()
+
+    def book_added(self, book):
+        self._publish("added", book)
+    def book_removed(self, book):
+        self._publish("removed", book)
+    def book_changed(self, book, field, oldValue):
+        self._publish("availability" if field in ("copies", "availableCopies") else "changed", book, field)
+
+    #Returns up to limit of the events after cursor, oldest first, or None when some of them are no longer kept
+    #(or the cursor is from before a restart)
+    def read(self, cursor, limit = 100):
+        with self._condition:
+            if cursor > self.sequence or cursor < self.sequence - self._size: return None
+            return [self._ring[seq % self._size] for seq in range(cursor + 1, min(cursor + limit, self.sequence) + 1)]
+
+    #Returns (oldest, latest), the sequence numbers of the oldest event still kept (the next one when none are kept yet)
+    #and of the latest event. A cursor from oldest - 1 to latest can be read from
+    def retained(self):
+        with self._condition: return max(1, self.sequence - self._size + 1), self.sequence
+
+    #Waits up to timeout seconds (None for ever) for an event after cursor, returns False when none came
+    def wait(self, cursor, timeout = None):
+        with self._condition: return self._condition.wait_for(lambda: self.sequence != cursor, timeout)
+
+    #Returns a FeedSubscription reading the events after cursor, by default only the ones to come
+    def subscribe(self, cursor = None, batchSize = 100):
+        return FeedSubscription(self, self.sequence if cursor is None else cursor, batchSize)
+
+#A consumer's place in a ChangeFeed. cursor is the sequence number of the last event it was given, a consumer that
+#saves it can subscribe again from there after it restarts
+class FeedSubscription:
+    def __init__(self, feed, cursor, batchSize):
+        self._feed = feed
+        self.cursor = cursor
+        self._batchSize = batchSize
+
+    #Returns the next events, at most batchSize and none if there are none yet. Returns None when events were missed,
+    #the cursor is then moved to the latest event and the consumer should reload what it shows
+    def poll(self):
+        events = self._feed.read(self.cursor, self._batchSize)
+        if events is None:
+            self.cursor = self._feed.sequence
+            return None
+        if events: self.cursor = events[-1][0]
+        return events
+
+    #Like poll, but waits up to timeout seconds (None for ever) for an event when there are none yet
+    def next_events(self, timeout = None):
+        self._feed.wait(self.cursor, timeout)
+        return self.poll()
+
+#Checks that concurrent borrowing and returning keeps the copies consistent. Several threads borrow and
+#return random books for random users while another thread keeps checking every book, then the final
+#state is compared with the loans. Returns the number of problems found, 0 when all is well
+def stressTestCirculation(threads = 8, books = 20, users = 50, operations = 5000, copies = 3):
+    bookList = BookList()
+    userList = UserList()
+    loans = Loans(bookList, userList)
+    bookList.add_books([Book.from_record(None, "Book " + str(i), ["Author"], 2000, "Publisher", copies, copies, datetime(2000, 1, 1)) for i in range(books)])
+    userList.add_users([User.from_record(None, "user" + str(i), "First", "Last", 1, "Street", "PC", "user@example.com", datetime(2000, 1, 1)) for i in range(users)])
+    problems = []
+    done = threading.Event()
+
+    def terminal(seed):
+        generator = random.Random(seed)
+        for _ in range(operations):
+            book = generator.choice(bookList.get_books())
+            user = generator.choice(userList.get_users())
+            if generator.random() < 0.6: loans.borrow_a_book(book, user)
+            else: loans.return_a_book(book, user)
+
+    def checker():
+        while not done.is_set():
+            for book in bookList.get_books():
+                if not 0 <= book.get_availableCopies() <= book.get_copies():
+                    problems.append(book.get_title() + " has " + str(book.get_availableCopies()) + " available copies")
+
+    #Switching threads as often as possible makes races far more likely to show up
+    switchInterval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        #The loans print a message for every call, only the problems are of interest here
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            workers = [threading.Thread(target=terminal, args=(seed,)) for seed in range(threads)]
+            watcher = threading.Thread(target=checker)
+            watcher.start()
+            for worker in workers: worker.start()
+            for worker in workers: worker.join()
+            done.set()
+            watcher.join()
+    finally:
+        sys.setswitchinterval(switchInterval)
+    for book in bookList.get_books():
+        borrowers = loans.borrowedBooks.get(book.get_id(), [])
+        if book.get_availableCopies() != book.get_copies() - len(borrowers):
+            problems.append(book.get_title() + " has " + str(book.get_availableCopies()) + " available copies but " + str(len(borrowers)) + " loans")
+        if len(set(borrowers)) != len(borrowers): problems.append(book.get_title() + " was lent twice to the same user")
+    loanCount = sum(len(bookIDs) for bookIDs in loans.loanedUsers.values())
+    if loanCount != sum(len(userIDs) for userIDs in loans.borrowedBooks.values()) or loanCount != len(loans.loanDates):
+        problems.append("the loan indexes disagree")
+    for problem in problems[:20]: print(problem)
+    print("Threads:", threads, "Operations:", threads * operations, "Problems found:", len(problems))
+    return len(problems)
+
+#Counts the calls, failures and latencies of the public methods of the classes it instruments (BookList, UserList and
+#Loans in the program). Latencies go into histograms of fixed size, with four buckets per doubling of the time, so the
+#percentiles are within about 12% and recording a call costs a few integer operations whatever the number of calls.
+#Each thread records into figures of its own, so no lock is taken per call, and dump adds them up.
+#A call fails when it raises, or for the methods in RESULT_ERRORS when it returns an error message instead of None.
+#Methods that return generators are timed until the generator is returned, not while it is used
+class OperationMetrics:
+    RESULT_ERRORS = ("Loans.borrow", "Loans.give_back")
+    #Enough buckets for any time that fits in 64 bits
+    BUCKETS = 4 * 65
+
+    def __init__(self):
+        #The figures of each thread that has recorded a call, {operation name: [calls, errors, total ns, max ns, histogram]}
+        self._threadOperations = []
+        self._local = threading.local()
+        #{class: {method name: original method}} for uninstrument
+        self._originals = {}
+        self._lock = threading.Lock()
+        #Name of the operation whose next call is run under cProfile, and the statistics of the last capture
+        self._profiling = None
+        self.lastProfile = None
+
+    #Replaces the public methods of each class with timed versions
+    def instrument(self, *classes):
+        for cls in classes:
+            if cls in self._originals: continue
+            originals = self._originals[cls] = {}
+            for name, method in list(vars(cls).items()):
+                if name.startswith("_") or not inspect.isfunction(method): continue
+                originals[name] = method
+                setattr(cls, name, self._timed(cls.__name__ + "." + name, method))
+
+    def uninstrument(self):
+        for cls, originals in self._originals.items():
+            for name, method in originals.items(): setattr(cls, name, method)
+        self._originals = {}
+
+    def _timed(self, operation, method):
+        metrics = self
+        failed = operation in self.RESULT_ERRORS
+        clock = time.perf_counter_ns
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            if metrics._profiling is not None and metrics._profiling == operation: return metrics._profile(operation, method, args, kwargs)
+            started = clock()
+            try: result = method(*args, **kwargs)
+            except BaseException:
+                metrics._record(operation, clock() - started, True)
+                raise
+            metrics._record(operation, clock() - started, failed and result is not None)
+            return result
+        return timed
+
+    #Middle of the range of times that fall in the bucket
+    def _bucket_time(self, bucket):
+        if bucket < 8: return bucket
+        bits, step = divmod(bucket, 4)
+        return ((4 + step) << (bits - 3)) + (1 << (bits - 4))
+
+    def _record(self, operation, ns, error):
+        try: operations = self._local.operations
+        except AttributeError:
+            operations = self._local.operations = {}
+            with self._lock: self._threadOperations.append(operations)
+        figures = operations.get(operation)
+        if figures is None: figures = operations[operation] = [0, 0, 0, 0, [0] * self.BUCKETS]
+        figures[0] += 1
+        if error: figures[1] += 1
+        figures[2] += ns
+        if ns > figures[3]: figures[3] = ns
+        #The bucket is 4 * bits + the two bits after the leading one, times under 8ns get buckets of their own
+        bits = ns.bit_length()
+        figures[4][bits * 4 + ((ns >> (bits - 3)) & 3) if bits > 3 else ns] += 1
+
+    #The estimate is never above the longest call
+    def _percentile(self, histogram, calls, longest, fraction):
+        rank = max(1, math.ceil(calls * fraction))
+        seen = 0
+        for bucket, number in enumerate(histogram):
+            seen += number
+            if seen >= rank: return min(self._bucket_time(bucket), longest)
+
+    #Returns {operation: {"calls", "errors", "total_ms", "mean_us", "p50_us", "p95_us", "p99_us", "max_us"}} for the operations called so far
+    def dump(self):
+        operations = {}
+        with self._lock: threadOperations = list(self._threadOperations)
+        for figures in threadOperations:
+            for name, (calls, errors, total, longest, histogram) in list(figures.items()):
+                if name not in operations: operations[name] = [0, 0, 0, 0, [0] * self.BUCKETS]
+                merged = operations[name]
+                merged[0] += calls
+                merged[1] += errors
+                merged[2] += total
+                merged[3] = max(merged[3], longest)
+                merged[4] = [x + y for x, y in zip(merged[4], histogram)]
+        microseconds = lambda ns: round(ns / 1000, 2)
+        return {name: {"calls": calls, "errors": errors, "total_ms": round(total / 1e6, 3), "mean_us": microseconds(total / calls),
+            "p50_us": microseconds(self._percentile(histogram, calls, longest, 0.50)), "p95_us": microseconds(self._percentile(histogram, calls, longest, 0.95)),
+            "p99_us": microseconds(self._percentile(histogram, calls, longest, 0.99)), "max_us": microseconds(longest)}
+            for name, (calls, errors, total, longest, histogram) in sorted(operations.items())}
+
+    def reset(self):
+        with self._lock:
+            for figures in self._threadOperations: figures.clear()
+
+    def get_operations(self):
+        return sorted(name for cls, originals in self._originals.items() for name in (cls.__name__ + "." + method for method in originals))
+
+    def print_details(self):
+        figures = self.dump()
+        if not figures:
+            print("No operations recorded yet.")
+            return
+        print()
+        print("{0:<46} {1:>8} {2:>7} {3:>11} {4:>11} {5:>11} {6:>11}".format("Operation", "Calls", "Errors", "p50 us", "p95 us", "p99 us", "max us"))
+        for name, values in figures.items():
+            print("{0:<46} {1:>8} {2:>7} {3:>11} {4:>11} {5:>11} {6:>11}".format(name, values["calls"], values["errors"], values["p50_us"],
+                values["p95_us"], values["p99_us"], values["max_us"]))
+
+    #Runs the next call of the operation (e.g "BookList.search_by_title") under cProfile, the statistics are printed after it
+    def capture_profile(self, operation):
+        self._profiling = operation
+
+    def _profile(self, operation, method, args, kwargs):
+        self._profiling = None
+        profiler = cProfile.Profile()
+        started = time.perf_counter_ns()
+        try: return profiler.runcall(method, *args, **kwargs)
+        finally:
+            self._record(operation, time.perf_counter_ns() - started, False)
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(25)
+            self.lastProfile = output.getvalue()
+            print("\nProfile of " + operation + ":")
+            print(self.lastProfile)
+
+#Metrics of the library operations, the program instruments BookList, UserList and Loans with it unless started with --no-metrics
+libraryMetrics = OperationMetrics()
+
+#Made up books and users, generated one at a time so any number of them can be made. The same seed gives the same records
+def syntheticBooks(count, seed=0):
+    generator = random.Random(seed)
+    words = ["river", "shadow", "garden", "winter", "stone", "glass", "night", "empire", "silent", "crown", "ocean", "letters",
+        "machine", "forest", "memory", "fire", "city", "daughter", "storm", "history"]
+    publishers = ["Penguin", "HarperCollins", "Macmillan", "Hachette", "Simon & Schuster", "Bloomsbury", "Faber", "Vintage", "Tor", "Orbit"]
+    for i in range(count):
+        title = " ".join(generator.sample(words, generator.randint(1, 4))).title() + " " + str(i)
+        authors = ["Author " + str(generator.randrange(count // 10 + 1)) for _ in range(generator.choice((1, 1, 1, 2)))]
+        year = generator.randint(1900, 2023)
+        copies = generator.randint(1, 5)
+        yield Book.from_record(None, title, authors, year, generator.choice(publishers), copies, copies, datetime(year, generator.randint(1, 12), generator.randint(1, 28)))
+
+def syntheticUsers(count, seed=0):
+    generator = random.Random(seed)
+    firstnames = ["Amara", "Ben", "Chloe", "Dev", "Elena", "Farid", "Grace", "Hiro", "Isla", "Jonas", "Kemi", "Liam", "Mei", "Noah"]
+    surnames = ["Smith", "Jones", "Okafor", "Patel", "Nguyen", "Garcia", "Kowalski", "Brown", "Ahmed", "Murphy", "Rossi", "Kim"]
+    streets = ["High Street", "Station Road", "Church Lane", "Mill Road", "Park Avenue", "Victoria Street", "Green Lane", "Kings Road"]
+    for i in range(count):
+        username = "user" + str(i)
+        yield User.from_record(None, username, generator.choice(firstnames), generator.choice(surnames), generator.randint(1, 250),
+            generator.choice(streets), "PC" + str(generator.randrange(2000)), username + "@example.com",
+            datetime(generator.randint(1940, 2010), generator.randint(1, 12), generator.randint(1, 28)))
+
+#Measures the memory each book and user takes, held as objects and held in a ColumnStore, using the synthetic records.
+#Returns {"book objects", "book columns", "user objects", "user columns"} in bytes per record
+def measureRecordMemory(count=100000):
+    def measure(build):
+        gc.collect()
+        start = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - start
+        del kept
+        return round(used / count, 1)
+
+    def columns(records, add):
+        store = ColumnStore()
+        for record in records: add(store, record)
+        return store
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing: tracemalloc.start()
+    try:
+        results = {"book objects": measure(lambda: list(syntheticBooks(count))),
+            "book columns": measure(lambda: columns(syntheticBooks(count), ColumnStore.book_added)),
+            "user objects": measure(lambda: list(syntheticUsers(count))),
+            "user columns": measure(lambda: columns(syntheticUsers(count), ColumnStore.user_added))}
+    finally:
+        if not tracing: tracemalloc.stop()
+    return results
+
+#Builds a library of synthetic books and users without going through the interactive constructors, and lends some of
+#the books with borrowing dates spread over the last loan periods so that some of the loans are overdue. Users and
+#loans default to a tenth and a twentieth of the books. Returns (bookList, userList, loans)
+def buildSyntheticLibrary(books, users=None, loans=None, seed=0, storage=None):
+    users = max(1, books // 10) if users is None else users
+    loans = books // 20 if loans is None else loans
+    bookList = BookList()
+    userList = UserList()
+    if storage is not None:
+        bookList.attach_storage(storage)
+        userList.attach_storage(storage)
+    library = Loans(bookList, userList)
+    bookIDs, userIDs = [], []
+    def remember(records, ids):
+        for record in records:
+            ids.append(record.get_id())
+            yield record
+    bookList.add_books(remember(syntheticBooks(books, seed), bookIDs))
+    userList.add_users(remember(syntheticUsers(users, seed), userIDs))
+    generator = random.Random(seed)
+    now = datetime.now()
+    for _ in range(loans):
+        book = bookList.get_book_by_id(generator.choice(bookIDs))
+        user = userList.get_user_by_id(generator.choice(userIDs))
+        with library._book_lock(book.get_id()):
+            if book.get_availableCopies() == 0 or user.get_id() in library.borrowedBooks.get(book.get_id(), []): continue
+            library._lend(book, user, now - timedelta(days=generator.uniform(0, 2 * library._loanPeriod.days)))
+    return bookList, userList, library
+
+#Calls function once per set of arguments, until they run out or budget seconds have passed, and returns
+#{"calls", "mean_us", "p50_us", "p95_us", "max_us"} for the time each call took
+def timeCalls(function, arguments, budget=2.0):
+    times = []
+    stop = time.perf_counter() + budget
+    for argument in arguments:
+        started = time.perf_counter_ns()
+        function(*argument)
+        times.append(time.perf_counter_ns() - started)
+        if time.perf_counter() > stop: break
+    times.sort()
+    microseconds = lambda ns: round(ns / 1000, 2)
+    return {"calls": len(times), "mean_us": microseconds(sum(times) / len(times)) if times else None,
+        "p50_us": microseconds(times[len(times) // 2]) if times else None, "p95_us": microseconds(times[int(len(times) * 0.95)]) if times else None,
+        "max_us": microseconds(times[-1]) if times else None}
+
+#Times every search of BookList, adding/looking up/deleting books, removing users and the borrowing, returning, counting
+#and overdue reports of Loans on a synthetic library of the given size. Each operation is called up to calls times with
+#arguments picked from the library, and for at most budget seconds. Returns {"books", "users", "loans", "build_seconds", "operations"}
+def benchmarkLibrary(books, calls=200, budget=2.0, seed=0, storage=None):
+    started = time.perf_counter()
+    bookList, userList, loans = buildSyntheticLibrary(books, seed=seed, storage=storage)
+    result = {"books": bookList.get_total_books(), "users": userList.get_total_users(), "loans": len(loans.loanDates),
+        "build_seconds": round(time.perf_counter() - started, 3), "operations": {}}
+    operations = result["operations"]
+    generator = random.Random(seed + 1)
+    sample = [bookList.get_book_by_id(id) for id in generator.sample(list(bookList._storage.iter_book_ids()) if bookList._storage else
+        [book.get_id() for book in bookList.get_books()], min(calls, books))]
+    users = list(userList)
+    words = [word for book in sample for word in book.get_title().lower().split() if not word.isdigit()]
+    queries = [(" ".join(generator.sample(words, 2)),) for _ in range(calls)] + [(word[:-2],) for word in words[:calls]]
+    dates = [(book.get_publicationDate(),) for book in sample]
+    years = [(year, year) for year in (book.get_year() for book in sample)]
+    months = [(date, date + timedelta(days=30)) for date in (book.get_publicationDate() for book in sample)]
+    #The searches print what they find, only the time they take is of interest here. They print every match without paging
+    #(pageSize None) so they do the same work as before paging was added
+    everything = lambda arguments: [argument + (None,) for argument in arguments]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        operations["BookList.search_by_title"] = timeCalls(bookList.search_by_title, [(book.get_title(), None) for book in sample], budget)
+        operations["BookList.search_by_author_name"] = timeCalls(bookList.search_by_author_name, [(book.get_authors()[0], None) for book in sample], budget)
+        operations["BookList.search_by_publisher"] = timeCalls(bookList.search_by_publisher, [(book.get_publisher(), None) for book in sample], budget)
+        operations["BookList.search_by_publication_date"] = timeCalls(bookList.search_by_publication_date, everything(dates), budget)
+        operations["BookList.search_by_keywords"] = timeCalls(bookList.search_by_keywords, [query + (10, None) for query in queries], budget)
+        operations["BookList.search"] = timeCalls(bookList.search, queries, budget)
+        operations["BookList.iter_books_by (first page)"] = timeCalls(lambda publisher: list(bookList.iter_books_by("publisher", publisher, 0, 10)),
+            [(book.get_publisher(),) for book in sample], budget)
+        operations["BookList.search_by_year_range"] = timeCalls(bookList.search_by_year_range, everything(years), budget)
+        operations["BookList.get_books_by_year_range"] = timeCalls(bookList.get_books_by_year_range, years, budget)
+        operations["BookList.search_by_publication_date_range"] = timeCalls(bookList.search_by_publication_date_range, everything(months), budget)
+        operations["BookList.get_books_by_publication_date_range"] = timeCalls(bookList.get_books_by_publication_date_range, months, budget)
+        operations["BookList.has_book"] = timeCalls(bookList.has_book, [(book,) for book in sample], budget)
+        #New books with titles of their own, so deleting one by title deletes only it
+        added = [Book.from_record(None, "Benchmark Book " + str(i), ["Benchmark Author"], 2000, "Benchmark", 1, 1, datetime(2000, 1, 1)) for i in range(calls)]
+        operations["BookList.add_book"] = timeCalls(bookList.add_book, [(book,) for book in added], budget)
+        operations["BookList.has_book (absent)"] = timeCalls(bookList.has_book, [(Book.from_record(None, "", [], 0, "", 0, 0, None),) for _ in range(calls)], budget)
+        operations["BookList.delete_book_by_title"] = timeCalls(bookList.delete_book_by_title, [(book.get_title(),) for book in added], budget)
+        #Users with firstnames of their own, so removing by firstname never asks which one
+        userList.add_users([User.from_record(None, "benchmark" + str(i), "Benchmark" + str(i), "User", 1, "Street", "PC", "b@example.com", datetime(2000, 1, 1))
+            for i in range(calls)])
+        operations["UserList.remove_user_by_firstname"] = timeCalls(userList.remove_user_by_firstname, [("Benchmark" + str(i),) for i in range(calls)], budget)
+        pairs = []
+        for book in sample:
+            user = generator.choice(users)
+            if book.get_availableCopies() > 0 and user.get_id() not in loans.borrowedBooks.get(book.get_id(), []): pairs.append((book, user))
+        operations["Loans.borrow_a_book"] = timeCalls(loans.borrow_a_book, pairs, budget)
+        operations["Loans.return_a_book"] = timeCalls(loans.return_a_book, pairs, budget)
+        operations["Loans.get_number_of_user_borrowed_book"] = timeCalls(loans.get_number_of_user_borrowed_book, [(user,) for user in users[:calls]], budget)
+        operations["Loans.get_overdue_loans"] = timeCalls(loans.get_overdue_loans, [()] * min(calls, 20), budget)
+        operations["Loans.print_overdue_books"] = timeCalls(loans.print_overdue_books, [()] * min(calls, 20), budget)
+        operations["Loans.get_loans_due_within"] = timeCalls(loans.get_loans_due_within, [(1,)] * calls, budget)
+    return result
+
+#Runs benchmarkLibrary for each size and writes the results, with what they were run on, to path as JSON so the
+#results of two versions can be compared. Returns the results
+def runBenchmarks(sizes, path="benchmark.json", calls=200, budget=2.0, seed=0, columns=False):
+    with open(__file__, "rb") as file: source = hashlib.sha1(file.read()).hexdigest()
+    results = {"created": timeToText(datetime.now()), "python": sys.version.split()[0], "platform": sys.platform, "source_sha1": source,
+        "seed": seed, "calls": calls, "budget_seconds": budget, "storage": "columns" if columns else "memory", "libraries": []}
+    for size in sizes:
+        print("Benchmarking", size, "books...")
+        result = benchmarkLibrary(size, calls, budget, seed, ColumnStore() if columns else None)
+        results["libraries"].append(result)
+        for name, timing in result["operations"].items():
+            print("  {0:<48} {1:>6} calls  p50 {2:>10} us  p95 {3:>10} us".format(name, timing["calls"], timing["p50_us"], timing["p95_us"]))
+        #Written after every size so a long run that is stopped still leaves the results so far
+        with open(path, "w") as file: json.dump(results, file, indent=2)
+    print("Results written to", path)
+    return results
+
+#Times the searches of a synthetic catalogue of books held in memory and in ShardedStorages of each number of shards,
+#so the cost of the round trips to the shards can be compared with the work they share. Every search takes all its
+#matches (a publisher matches about a tenth of the books) except the first page one. Writes the results to path as JSON
+#and returns {"books", "calls", "libraries": [{"shards", "operations"}]}, shards is 0 for the books held in memory
+def benchmarkShards(books, shardCounts=(1, 2, 4), path="benchmark.json", calls=50, budget=2.0, seed=0):
+    results = {"created": timeToText(datetime.now()), "python": sys.version.split()[0], "cores": os.cpu_count(), "books": books, "calls": calls,
+        "libraries": []}
+    records = [ShardedStorage.book_row(book) for book in syntheticBooks(books, seed)]
+    generator = random.Random(seed + 1)
+    sample = [Book.from_record(*row) for row in generator.sample(records, min(calls, books))]
+    words = [word for book in sample for word in book.get_title().lower().split() if not word.isdigit()]
+    queries = [(" ".join(generator.sample(words, 2)),) for _ in range(calls)]
+    for shards in (0,) + tuple(shardCounts):
+        print("Benchmarking", books, "books", "in " + str(shards) + " shards..." if shards else "in memory...")
+        storage = ShardedStorage(shards) if shards else None
+        try:
+            bookList = BookList()
+            if storage is not None: bookList.attach_storage(storage)
+            bookList.add_books(Book.from_record(*row) for row in records)
+            operations = {}
+            operations["BookList.iter_books_by (publisher)"] = timeCalls(lambda publisher: list(bookList.iter_books_by("publisher", publisher)),
+                [(book.get_publisher(),) for book in sample], budget)
+            operations["BookList.iter_books_by (publisher, first page)"] = timeCalls(lambda publisher: list(bookList.iter_books_by("publisher", publisher, 0, 10)),
+                [(book.get_publisher(),) for book in sample], budget)
+            operations["BookList.iter_books_by (author)"] = timeCalls(lambda author: list(bookList.iter_books_by("authors", author)),
+                [(book.get_authors()[0],) for book in sample], budget)
+            operations["BookList.get_books_by_year_range"] = timeCalls(bookList.get_books_by_year_range, [(book.get_year(), book.get_year()) for book in sample], budget)
+            operations["BookList.search"] = timeCalls(bookList.search, queries, budget)
+            results["libraries"].append({"shards": shards, "books held by the list": len(bookList._index), "operations": operations})
+        finally:
+            if storage is not None: storage.close()
+        for name, timing in operations.items():
+            print("  {0:<48} {1:>6} calls  p50 {2:>10} us  p95 {3:>10} us".format(name, timing["calls"], timing["p50_us"], timing["p95_us"]))
+    with open(path, "w") as file: json.dump(results, file, indent=2)
+    print("Results written to", path)
+    return results
+
+#Reads a count such as 10000, 10k or 2M
+def parseCount(text):
+    text = text.strip().lower()
+    multiplier = {"k": 1000, "m": 1000000}.get(text[-1:], 1)
+    if multiplier != 1: text = text[:-1]
+    return int(float(text) * multiplier)
+
+#Dates are kept as ISO text (2020-02-23) in storage, journals and snapshots
+def dateToText(date):
+    return date.strftime("%Y-%m-%d") if date is not None else None
+
+#fromisoformat reads the text dateToText writes into the same datetime as strptime, but much faster
+def textToDate(text):
+    return datetime.fromisoformat(text) if text is not None else None
+
+#Loan times are kept to the second, as ISO text (2020-02-23T14:05:00)
+def timeToText(moment):
+    return moment.isoformat(timespec="seconds") if moment is not None else None
+
+def textToTime(text):
+    return datetime.fromisoformat(text) if text is not None else None
+
+#Plain dict forms of books and users, used by the journal and snapshots. The keys match the field names the setters notify with
+def bookToRecord(book):
+    return {"id": book.get_id(), "title": book.get_title(), "authors": list(book.get_authors()), "year": book.get_year(), "publisher": book.get_publisher(),
+        "copies": book.get_copies(), "availableCopies": book.get_availableCopies(), "pubdate": dateToText(book.get_publicationDate())}
+
+def recordToBook(record):
+    return Book.from_record(record["id"], record["title"], record["authors"], record["year"], record["publisher"], record["copies"],
+        record["availableCopies"], textToDate(record["pubdate"]))
+
+def userToRecord(user):
+    return {"id": user.get_id(), "username": user.get_username(), "firstname": user.get_firstname(), "surname": user.get_surname(),
+        "houseNumber": user.get_houseNumber(), "streetname": user.get_streetname(), "postcode": user.get_postcode(), "email": user.get_email(),
+        "dateOfBirth": dateToText(user.get_dateOfBirth())}
+
+def changeToRecord(event):
+    seq, kind, bookID, field, copies, availableCopies = event
+    record = {"seq": seq, "type": kind, "book": bookID, "copies": copies, "availableCopies": availableCopies}
+    if kind == "changed": record["field"] = field
+    return record
+
+def recordToUser(record):
+    return User.from_record(record["id"], record["username"], record["firstname"], record["surname"], record["houseNumber"], record["streetname"],
+        record["postcode"], record["email"], textToDate(record["dateOfBirth"]))
+
+#Keeps books, users and loans in an SQLite database. It is a LibraryObserver, so once attached to the
+#lists and loans every change is queued and written in batches, each batch in a single transaction.
+#Reads always flush the queue first, so they see every change made so far
+class SQLiteStorage(LibraryObserver):
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS books (position INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER NOT NULL UNIQUE, title TEXT NOT NULL,
+        title_key TEXT NOT NULL, year INTEGER, publisher TEXT, publisher_key TEXT, copies INTEGER, available INTEGER, pubdate TEXT);
+    CREATE TABLE IF NOT EXISTS book_authors (book_id INTEGER NOT NULL, position INTEGER NOT NULL, name TEXT NOT NULL, name_key TEXT NOT NULL,
+        PRIMARY KEY (book_id, position)) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS users (position INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER NOT NULL UNIQUE, username TEXT, firstname TEXT,
+        firstname_key TEXT, surname TEXT, house_number INTEGER, streetname TEXT, postcode TEXT, email TEXT, date_of_birth TEXT);
+    CREATE TABLE IF NOT EXISTS loans (book_id INTEGER NOT NULL, user_id INTEGER NOT NULL, borrowed_at TEXT, due_at TEXT,
+        PRIMARY KEY (book_id, user_id)) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS books_title ON books (title_key);
+    CREATE INDEX IF NOT EXISTS books_publisher ON books (publisher_key);
+    CREATE INDEX IF NOT EXISTS books_pubdate ON books (pubdate, id);
+    CREATE INDEX IF NOT EXISTS books_year ON books (year, id);
+    CREATE INDEX IF NOT EXISTS book_authors_name ON book_authors (name_key);
+    CREATE INDEX IF NOT EXISTS users_firstname ON users (firstname_key);
+    CREATE INDEX IF NOT EXISTS loans_user ON loans (user_id);
+    """
+    #Indexes on columns added after the first version, created once the columns are known to exist
+    LATE_INDEXES = """
+    CREATE INDEX IF NOT EXISTS loans_due ON loans (due_at);
+    CREATE INDEX IF NOT EXISTS users_username ON users (username COLLATE NOCASE);
+    """
+    #Queries for the searches that are pushed down to the database, by the field searched
+    BOOK_KEYS = {"title": "SELECT id FROM books WHERE title_key = ? ORDER BY position",
+        "publisher": "SELECT id FROM books WHERE publisher_key = ? ORDER BY position",
+        "pubdate": "SELECT id FROM books WHERE pubdate = ? ORDER BY position",
+        "authors": "SELECT DISTINCT book_id FROM book_authors WHERE name_key = ?"}
+    USER_KEYS = {"firstname": "SELECT id FROM users WHERE firstname_key = ? ORDER BY position",
+        "username": "SELECT id FROM users WHERE username = ? COLLATE NOCASE ORDER BY position"}
+    #How many rows are read at a time when iterating over all books or users
+    PAGE_SIZE = 1000
+
+    def __init__(self, path="library.db", batchSize=500):
+        """
+        path: the database file, created if it doesn't exist
+        batchSize: the number of queued writes that triggers a flush
+        """
+        #The connection is shared by every thread using the library, _lock serialises its use
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        #With WAL, NORMAL only syncs at checkpoints, a committed batch can't be corrupted but may be lost on power failure
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(self.SCHEMA)
+        #Databases made before loans had dates get the new columns
+        loanColumns = [row[1] for row in self._connection.execute("PRAGMA table_info(loans)")]
+        for column in ("borrowed_at", "due_at"):
+            if column not in loanColumns: self._connection.execute("ALTER TABLE loans ADD COLUMN " + column + " TEXT")
+        self._connection.executescript(self.LATE_INDEXES)
+        self._batchSize = batchSize
+        #Queued writes as (sql, parameters), applied in order
+        self._pending = []
+
+    def _queue(self, sql, parameters):
+        with self._lock:
+            self._pending.append((sql, parameters))
+            if len(self._pending) >= self._batchSize: self.flush()
+
+    #Writes every queued change in one transaction, runs of the same statement go through executemany
+    def flush(self):
+        with self._lock:
+            if not self._pending: return
+            with self._connection:
+                for sql, run in groupby(self._pending, key=lambda x: x[0]):
+                    self._connection.executemany(sql, [parameters for _, parameters in run])
+                #The high-water mark of the ids is saved with every batch, so the ids of deleted records stay used
+                self._connection.execute("""INSERT INTO meta (key, value) VALUES ('highest_id', ?)
+                    ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)""", (recordIDs.get_highest(),))
+            self._pending = []
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    #Returns all the rows of a query, after writing the queued changes
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            self.flush()
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def _query_one(self, sql, parameters=()):
+        rows = self._query(sql, parameters)
+        return rows[0] if rows else None
+
+    def _save_book(self, book):
+        self._queue("""INSERT INTO books (id, title, title_key, year, publisher, publisher_key, copies, available, pubdate) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET title = excluded.title, title_key = excluded.title_key, year = excluded.year, publisher = excluded.publisher,
+            publisher_key = excluded.publisher_key, copies = excluded.copies, available = excluded.available, pubdate = excluded.pubdate""",
+            (book.get_id(), book.get_title(), book.get_title().casefold(), book.get_year(), book.get_publisher(), book.get_publisher().casefold(),
+            book.get_copies(), book.get_availableCopies(), dateToText(book.get_publicationDate())))
+
+    def _save_authors(self, book):
+        self._queue("DELETE FROM book_authors WHERE book_id = ?", (book.get_id(),))
+        for position, name in enumerate(book.get_authors()):
+            self._queue("INSERT INTO book_authors (book_id, position, name, name_key) VALUES (?, ?, ?, ?)", (book.get_id(), position, name, name.casefold()))
+
+    def _save_user(self, user):
+        self._queue("""INSERT INTO users (id, username, firstname, firstname_key, surname, house_number, streetname, postcode, email, date_of_birth)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET username = excluded.username, firstname = excluded.firstname,
+            firstname_key = excluded.firstname_key, surname = excluded.surname, house_number = excluded.house_number, streetname = excluded.streetname,
+            postcode = excluded.postcode, email = excluded.email, date_of_birth = excluded.date_of_birth""",
+            (user.get_id(), user.get_username(), user.get_firstname(), user.get_firstname().casefold(), user.get_surname(), user.get_houseNumber(),
+            user.get_streetname(), user.get_postcode(), user.get_email(), dateToText(user.get_dateOfBirth())))
+
+    def book_added(self, book):
+        self._save_book(book)
+        self._save_authors(book)
+    def book_removed(self, book):
+        self._queue("DELETE FROM books WHERE id = ?", (book.get_id(),))
+        self._queue("DELETE FROM book_authors WHERE book_id = ?", (book.get_id(),))
+    def book_changed(self, book, field, oldValue):
+        if field == "authors": self._save_authors(book)
+        else: self._save_book(book)
+    def user_added(self, user):
+        self._save_user(user)
+    def user_removed(self, user):
+        self._queue("DELETE FROM users WHERE id = ?", (user.get_id(),))
+    def user_changed(self, user, field, oldValue):
+        self._save_user(user)
+    def loan_added(self, book, user, borrowedAt, dueAt):
+        self._queue("INSERT OR REPLACE INTO loans (book_id, user_id, borrowed_at, due_at) VALUES (?, ?, ?, ?)",
+            (book.get_id(), user.get_id(), timeToText(borrowedAt), timeToText(dueAt)))
+    def loan_removed(self, book, user):
+        self._queue("DELETE FROM loans WHERE book_id = ? AND user_id = ?", (book.get_id(), user.get_id()))
+
+    #The largest id given out when the database was last written, 0 when there are none. Databases made before the
+    #high-water mark was saved have the largest id stored
+    def max_record_id(self):
+        return self._query_one("""SELECT MAX(COALESCE((SELECT value FROM meta WHERE key = 'highest_id'), 0),
+            COALESCE((SELECT MAX(id) FROM books), 0), COALESCE((SELECT MAX(id) FROM users), 0))""")[0]
+
+    def has_book(self, id):
+        return self._query_one("SELECT 1 FROM books WHERE id = ?", (id,)) is not None
+    def count_books(self):
+        return self._query_one("SELECT COUNT(*) FROM books")[0]
+
+    def load_book(self, id):
+        row = self._query_one("SELECT id, title, year, publisher, copies, available, pubdate FROM books WHERE id = ?", (id,))
+        if row is None: return None
+        authors = [name for (name,) in self._query("SELECT name FROM book_authors WHERE book_id = ? ORDER BY position", (id,))]
+        return Book.from_record(row[0], row[1], authors, row[2], row[3], row[4], row[5], textToDate(row[6]))
+
+    #Yields the ids of all books in the order they were added, a page at a time so no cursor is held open
+    def iter_book_ids(self):
+        position = 0
+        while True:
+            rows = self._query("SELECT position, id FROM books WHERE position > ? ORDER BY position LIMIT ?", (position, self.PAGE_SIZE))
+            if not rows: return
+            for position, id in rows: yield id
+
+    #Yields all the books in the order they were added, a page of books and their authors is read with two queries
+    def iter_books(self):
+        position = 0
+        while True:
+            rows = self._query("""SELECT position, id, title, year, publisher, copies, available, pubdate FROM books WHERE position > ?
+                ORDER BY position LIMIT ?""", (position, self.PAGE_SIZE))
+            if not rows: return
+            authors = {}
+            for bookID, name in self._query("""SELECT book_id, name FROM book_authors WHERE book_id IN
+                    (SELECT id FROM books WHERE position > ? ORDER BY position LIMIT ?) ORDER BY book_id, position""", (position, self.PAGE_SIZE)):
+                authors.setdefault(bookID, []).append(name)
+            for position, id, title, year, publisher, copies, available, pubdate in rows:
+                yield Book.from_record(id, title, authors.get(id, []), year, publisher, copies, available, textToDate(pubdate))
+
+    #Returns the ids of the books whose field equals value, ignoring case like the in memory indexes
+    def find_book_ids(self, field, value):
+        key = dateToText(value) if field == "pubdate" else value.casefold()
+        return [id for (id,) in self._query(self.BOOK_KEYS[field], (key,))]
+
+    #Returns the ids of the books with low <= field <= high ordered by field, field is year or pubdate
+    def book_ids_in_range(self, field, low=None, high=None):
+        if field == "pubdate": low, high = dateToText(low), dateToText(high)
+        conditions, parameters = [], []
+        if low is not None:
+            conditions.append(field + " >= ?")
+            parameters.append(low)
+        if high is not None:
+            conditions.append(field + " <= ?")
+            parameters.append(high)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return [id for (id,) in self._query("SELECT id FROM books" + where + " ORDER BY " + field + ", id", parameters)]
+
+    #The books of a search are loaded by the BookList from the ids, only a ShardedStorage returns them itself
+    def find_books(self, field, value, limit=None):
+        return None
+    def books_in_range(self, field, low=None, high=None, limit=None):
+        return None
+
+    #Keyword searches aren't run by the database, the BookList indexes the words of all the stored books itself (see _keyword_index)
+    def keyword_matches(self, query, limit):
+        return None
+
+    def has_user(self, id):
+        return self._query_one("SELECT 1 FROM users WHERE id = ?", (id,)) is not None
+    def count_users(self):
+        return self._query_one("SELECT COUNT(*) FROM users")[0]
+
+    def load_user(self, id):
+        row = self._query_one("SELECT id, username, firstname, surname, house_number, streetname, postcode, email, date_of_birth FROM users WHERE id = ?", (id,))
+        if row is None: return None
+        return User.from_record(*row[:8], textToDate(row[8]))
+
+    def iter_user_ids(self):
+        position = 0
+        while True:
+            rows = self._query("SELECT position, id FROM users WHERE position > ? ORDER BY position LIMIT ?", (position, self.PAGE_SIZE))
+            if not rows: return
+            for position, id in rows: yield id
+
+    def iter_users(self):
+        for id in self.iter_user_ids(): yield self.load_user(id)
+
+    def find_user_ids(self, field, value):
+        return [id for (id,) in self._query(self.USER_KEYS[field], (value.casefold(),))]
+
+    #Returns the ids that are stored and the usernames (case folded) that are taken, out of the ones given. The
+    #queued writes are flushed once and the values are looked up PAGE_SIZE at a time
+    def find_users(self, ids, usernames):
+        storedIDs, storedUsernames = set(), set()
+        with self._lock:
+            for start in range(0, len(ids), self.PAGE_SIZE):
+                page = ids[start:start + self.PAGE_SIZE]
+                storedIDs.update(id for (id,) in self._query("SELECT id FROM users WHERE id IN (" + ", ".join("?" * len(page)) + ")", page))
+            for start in range(0, len(usernames), self.PAGE_SIZE):
+                page = usernames[start:start + self.PAGE_SIZE]
+                storedUsernames.update(username.casefold() for (username,) in self._query("SELECT username FROM users WHERE username COLLATE NOCASE IN ("
+                    + ", ".join("?" * len(page)) + ")", page))
+        return storedIDs, storedUsernames
+
+    #Yields (bookID, userID, borrowedAt, dueAt) for every outstanding loan
+    def iter_loans(self):
+        for bookID, userID, borrowedAt, dueAt in self._query("SELECT book_id, user_id, borrowed_at, due_at FROM loans"):
+            yield bookID, userID, textToTime(borrowedAt), textToTime(dueAt)
+
+#A table kept as columns, one row per record. Each field is stored by its kind: "str" values are interned and kept
+#in a list so equal strings are stored once, "strs" (e.g authors) as lists of interned strings, "int" in a typed
+#array and "date" as the ordinal day number in a typed array, 0 standing for no date. Removed rows are left as
+#holes and squeezed out once they are half of the table
+class ColumnTable:
+    def __init__(self, fields):
+        """
+        fields: [(name, kind)] in the order values are given and returned
+        """
+        self._fields = fields
+        self._ids = array("q")
+        self._columns = [array("q") if kind in ("int", "date") else [] for name, kind in fields]
+        self._positions = {name: i for i, (name, kind) in enumerate(fields)}
+        #Maps the id of every live record to its row
+        self._rows = {}
+
+    def __len__(self): return len(self._rows)
+    def __contains__(self, id): return id in self._rows
+
+    def _encode(self, kind, value):
+        if kind == "str": return sys.intern(value) if isinstance(value, str) else value
+        #A single string (the usual single author) is kept as itself rather than in a tuple
+        if kind == "strs": return sys.intern(value[0]) if len(value) == 1 else tuple(sys.intern(x) for x in value)
+        if kind == "date": return value.toordinal() if value is not None else 0
+        return value
+
+    def _decode(self, kind, value):
+        if kind == "strs": return [value] if isinstance(value, str) else list(value)
+        if kind == "date": return datetime.fromordinal(value) if value else None
+        return value
+
+    #Adds the record, or overwrites it if the id is already in the table
+    def put(self, id, values):
+        row = self._rows.get(id)
+        if row is not None:
+            for column, (name, kind), value in zip(self._columns, self._fields, values): column[row] = self._encode(kind, value)
+            return
+        self._rows[id] = len(self._ids)
+        self._ids.append(id)
+        for column, (name, kind), value in zip(self._columns, self._fields, values): column.append(self._encode(kind, value))
+
+    #Returns the values of the record in field order, or None if it isn't in the table
+    def get(self, id):
+        row = self._rows.get(id)
+        if row is None: return None
+        return [self._decode(kind, column[row]) for column, (name, kind) in zip(self._columns, self._fields)]
+
+    def delete(self, id):
+        row = self._rows.pop(id, None)
+        if row is None: return
+        for column, (name, kind) in zip(self._columns, self._fields):
+            if kind not in ("int", "date"): column[row] = None
+        if len(self._rows) * 2 < len(self._ids): self._squeeze()
+
+    def _squeeze(self):
+        live = [row for id, row in sorted(self._rows.items(), key=lambda x: x[1])]
+        self._ids = array("q", (self._ids[row] for row in live))
+        self._columns = [type(column)(column.typecode, (column[row] for row in live)) if isinstance(column, array) else [column[row] for row in live]
+            for column in self._columns]
+        self._rows = {id: row for row, id in enumerate(self._ids)}
+
+    #Yields the ids in the order the records were added
+    def ids(self):
+        for row, id in enumerate(self._ids):
+            if self._rows.get(id) == row: yield id
+
+    #Returns the ids of the records whose field satisfies test, in the order they were added. The test is
+    #made once per distinct stored value, so low cardinality columns (e.g publishers) are cheap to scan
+    def find(self, name, test):
+        position = self._positions[name]
+        kind = self._fields[position][1]
+        results = {}
+        matches = []
+        for row, value in enumerate(self._columns[position]):
+            if value is None: continue
+            result = results.get(value)
+            if result is None: result = results[value] = test(self._decode(kind, value))
+            if result and self._rows.get(self._ids[row]) == row: matches.append(self._ids[row])
+        return matches
+
+    #Returns the ids of the records with low <= field <= high ordered by the field (then id), for int and date fields
+    def range(self, name, low=None, high=None):
+        position = self._positions[name]
+        kind = self._fields[position][1]
+        low = self._encode(kind, low) if low is not None else None
+        high = self._encode(kind, high) if high is not None else None
+        matches = []
+        for row, value in enumerate(self._columns[position]):
+            if kind == "date" and not value: continue
+            if (low is None or value >= low) and (high is None or value <= high) and self._rows.get(self._ids[row]) == row:
+                matches.append((value, self._ids[row]))
+        matches.sort()
+        return [id for value, id in matches]
+
+#Keeps books and users in memory as compact columns (see ColumnTable) instead of as Book and User objects, for
+#catalogues too big to hold as objects. It has the same interface as SQLiteStorage and is attached to the lists the
+#same way, they then only make objects for the records that are used. There are no secondary indexes, lookups by
+#field scan the columns, so the memory used stays close to that of the data itself
+class ColumnStore(LibraryObserver):
+    BOOK_FIELDS = [("title", "str"), ("authors", "strs"), ("year", "int"), ("publisher", "str"), ("copies", "int"),
+        ("availableCopies", "int"), ("pubdate", "date")]
+    USER_FIELDS = [("username", "str"), ("firstname", "str"), ("surname", "str"), ("houseNumber", "int"), ("streetname", "str"),
+        ("postcode", "str"), ("email", "str"), ("dateOfBirth", "date")]
+
+    def __init__(self):
+        self._books = ColumnTable(self.BOOK_FIELDS)
+        self._users = ColumnTable(self.USER_FIELDS)
+        #Maps case folded usernames to user ids, so looking a username up doesn't scan the column
+        self._usernames = {}
+        #The largest id ever stored, deleted records included
+        self._highestID = 0
+
+    def book_added(self, book):
+        self._highestID = max(self._highestID, book.get_id())
+        self._books.put(book.get_id(), [book.get_title(), book.get_authors(), book.get_year(), book.get_publisher(), book.get_copies(),
+            book.get_availableCopies(), book.get_publicationDate()])
+    def book_removed(self, book):
+        self._books.delete(book.get_id())
+    #A changed record is written again whole, setting the copies also changes the available copies
+    def book_changed(self, book, field, oldValue):
+        self.book_added(book)
+    def user_added(self, user):
+        self._highestID = max(self._highestID, user.get_id())
+        self._users.put(user.get_id(), [user.get_username(), user.get_firstname(), user.get_surname(), user.get_houseNumber(),
+            user.get_streetname(), user.get_postcode(), user.get_email(), user.get_dateOfBirth()])
+        #Most usernames are already case folded, the username itself is then the key instead of a copy
+        username = user.get_username()
+        key = username.casefold()
+        self._usernames[username if key == username else key] = user.get_id()
+    def user_removed(self, user):
+        self._users.delete(user.get_id())
+        if self._usernames.get(user.get_username().casefold()) == user.get_id(): del self._usernames[user.get_username().casefold()]
+    def user_changed(self, user, field, oldValue):
+        self.user_added(user)
+
+    def has_book(self, id):
+        return id in self._books
+    def count_books(self):
+        return len(self._books)
+    def load_book(self, id):
+        values = self._books.get(id)
+        if values is None: return None
+        return Book.from_record(id, *values)
+    def iter_book_ids(self):
+        return self._books.ids()
+    def iter_books(self):
+        for id in self.iter_book_ids(): yield self.load_book(id)
+
+    #Returns the ids of the books whose field equals value, ignoring case like the in memory indexes
+    def find_book_ids(self, field, value):
+        if field == "pubdate": return self._books.find(field, lambda x: x == value)
+        key = value.casefold()
+        if field == "authors": return self._books.find(field, lambda authors: any(author.casefold() == key for author in authors))
+        return self._books.find(field, lambda x: x.casefold() == key)
+
+    #Returns the ids of the books with low <= field <= high ordered by field, field is year or pubdate
+    def book_ids_in_range(self, field, low=None, high=None):
+        return self._books.range(field, low, high)
+
+    #The books of a search are loaded by the BookList from the ids, only a ShardedStorage returns them itself
+    def find_books(self, field, value, limit=None):
+        return None
+    def books_in_range(self, field, low=None, high=None, limit=None):
+        return None
+
+    #Keyword searches aren't run by the column store, the BookList indexes the words of all the stored books itself (see _keyword_index)
+    def keyword_matches(self, query, limit):
+        return None
+
+    def has_user(self, id):
+        return id in self._users
+    def count_users(self):
+        return len(self._users)
+    def load_user(self, id):
+        values = self._users.get(id)
+        if values is None: return None
+        return User.from_record(id, *values)
+    def iter_user_ids(self):
+        return self._users.ids()
+    def iter_users(self):
+        for id in self.iter_user_ids(): yield self.load_user(id)
+    def find_user_ids(self, field, value):
+        key = value.casefold()
+        if field == "username": return [self._usernames[key]] if key in self._usernames else []
+        return self._users.find(field, lambda x: x.casefold() == key)
+
+    #Returns the ids that are stored and the usernames (case folded) that are taken, out of the ones given
+    def find_users(self, ids, usernames):
+        return {id for id in ids if id in self._users}, {username.casefold() for username in usernames if username.casefold() in self._usernames}
+
+    #The largest book or user id ever stored, 0 when there are none
+    def max_record_id(self):
+        return self._highestID
+
+#Runs in each process of a ShardedStorage. The shard's books are kept in an ordinary BookList with all its indexes,
+#requests are answered until None is received. Writes come in batches and get no reply
+def shardWorker(connection):
+    books = BookList()
+    while True:
+        request = connection.recv()
+        if request is None: break
+        op = request[0]
+        try:
+            if op == "write":
+                for change, value in request[1]:
+                    old = books.get_book_by_id(value if change == "remove" else value[0])
+                    if old is not None: books._remove_book(old)
+                    if change == "put": books.add_books([Book.from_record(*value)])
+                continue
+            if op == "find": reply = [book.get_id() for book in books.iter_books_by(request[1], request[2])]
+            elif op == "findrows":
+                matches = books.iter_books_by(request[1], request[2])
+                matches = sorted(matches, key=Book.get_id) if request[3] is None else heapq.nsmallest(request[3], matches, key=Book.get_id)
+                reply = [ShardedStorage.book_row(book) for book in matches]
+            elif op == "range":
+                field = request[1]
+                reply = sorted((books._field_value(book, field), book.get_id()) for book in books.iter_books_in_range(field, request[2], request[3]))
+            elif op == "rangerows":
+                field = request[1]
+                #The books come ordered by the field, ties are ordered by id like the other shards' so the replies merge
+                matches = sorted(((books._field_value(book, field), book.get_id(), book) for book in books.iter_books_in_range(field, request[2], request[3])),
+                    key=lambda match: match[:2])
+                reply = [(value, id, ShardedStorage.book_row(book)) for value, id, book in matches[:request[4]]]
+            elif op == "expand":
+                expansions = books._searchIndex.expand_query(request[1])
+                reply = (expansions, books._searchIndex.word_counts({word for words in expansions for word in words}), books.get_total_books())
+            elif op == "keywords":
+                matches = books._searchIndex.search(None, request[1], expansions=request[2], stats=request[3])
+                reply = [(score, id, ShardedStorage.book_row(books.get_book_by_id(id))) for score, id in matches]
+            elif op == "load":
+                book = books.get_book_by_id(request[1])
+                reply = None if book is None else ShardedStorage.book_row(book)
+            elif op == "all": reply = [ShardedStorage.book_row(book) for book in books]
+            else: reply = ValueError("unknown shard request " + repr(op))
+        except Exception as error: reply = error
+        connection.send(reply)
+
+#Keeps the books in several worker processes (shards), so searches of a large catalogue run on several cores at
+#once instead of one under the GIL. A book lives in shard id % shards. Writes are queued and sent to the owning
+#shard in batches, searches are sent to every shard at once and their answers merged. It is attached to a BookList
+#like the other storages, which keeps its search methods, only books are sharded. The ids are also kept here so
+#counting, listing and checking books needs no round trip
+class ShardedStorage(LibraryObserver):
+    def __init__(self, shards=None, batchSize=500):
+        """
+        shards: the number of worker processes, default the number of cores
+        batchSize: the number of queued writes for a shard that triggers sending them
+        """
+        shards = shards or os.cpu_count() or 1
+        self._connections = []
+        self._processes = []
+        for _ in range(shards):
+            connection, workerConnection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=shardWorker, args=(workerConnection,), daemon=True)
+            process.start()
+            workerConnection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+        #The ids of the stored books, in the order they were added, and the largest id ever stored
+        self._ids = {}
+        self._highestID = 0
+        #Queued writes of each shard as (change, value), change is put (value is a book row) or remove (value is the id)
+        self._pending = [[] for _ in range(shards)]
+        self._batchSize = batchSize
+        #A request and its reply must not be interleaved with another thread's, _lock serialises the use of the shards
+        self._lock = threading.RLock()
+
+    #The values of a book in the order Book.from_record takes them
+    @classmethod
+    def book_row(self, book):
+        return (book.get_id(), book.get_title(), list(book.get_authors()), book.get_year(), book.get_publisher(), book.get_copies(),
+            book.get_availableCopies(), book.get_publicationDate())
+
+    def _shard(self, id):
+        return id % len(self._connections)
+
+    def _queue(self, id, change, value):
+        with self._lock:
+            pending = self._pending[self._shard(id)]
+            pending.append((change, value))
+            if len(pending) >= self._batchSize: self.flush()
+
+    #Sends every queued write to its shard
+    def flush(self):
+        with self._lock:
+            for connection, pending in zip(self._connections, self._pending):
+                if pending:
+                    connection.send(("write", pending))
+                    pending.clear()
+
+    def _reply(self, connection):
+        reply = connection.recv()
+        if isinstance(reply, Exception): raise reply
+        return reply
+
+    #Sends the request to every shard before reading any answer, so the shards work on it at the same time
+    def _ask_all(self, request):
+        with self._lock:
+            self.flush()
+            for connection in self._connections: connection.send(request)
+            return [self._reply(connection) for connection in self._connections]
+
+    def _ask(self, id, request):
+        with self._lock:
+            self.flush()
+            connection = self._connections[self._shard(id)]
+            connection.send(request)
+            return self._reply(connection)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            for connection in self._connections: connection.send(None)
+            for process in self._processes: process.join()
+            for connection in self._connections: connection.close()
+
+    def book_added(self, book):
+        self._ids[book.get_id()] = None
+        self._highestID = max(self._highestID, book.get_id())
+        self._queue(book.get_id(), "put", self.book_row(book))
+    def book_removed(self, book):
+        self._ids.pop(book.get_id(), None)
+        self._queue(book.get_id(), "remove", book.get_id())
+    def book_changed(self, book, field, oldValue):
+        self._queue(book.get_id(), "put", self.book_row(book))
+
+    def has_book(self, id):
+        return id in self._ids
+    def count_books(self):
+        return len(self._ids)
+    def load_book(self, id):
+        if id not in self._ids: return None
+        row = self._ask(id, ("load", id))
+        return None if row is None else Book.from_record(*row)
+    def iter_book_ids(self):
+        return iter(list(self._ids))
+    def iter_books(self):
+        rows = {row[0]: row for rows in self._ask_all(("all",)) for row in rows}
+        for id in list(self._ids):
+            if id in rows: yield Book.from_record(*rows[id])
+
+    #The shards' matches are merged in id order, which is the order the books were added
+    def find_book_ids(self, field, value):
+        return sorted(id for ids in self._ask_all(("find", field, value)) for id in ids)
+
+    #Returns the first limit books whose field matches the value, in id order. Every shard sends the rows of its
+    #matches in its reply, so a search is one round trip to each shard however many books it finds. The books are
+    #built from the rows, the BookList gives its loaded book instead of one it already has (see BookList._stored_books)
+    def find_books(self, field, value, limit=None):
+        rows = heapq.merge(*self._ask_all(("findrows", field, value, limit)), key=itemgetter(0))
+        return [Book.from_record(*row) for row in islice(rows, limit)]
+
+    #Returns the ids of the books with low <= field <= high ordered by field, field is year or pubdate
+    def book_ids_in_range(self, field, low=None, high=None):
+        return [id for key, id in heapq.merge(*self._ask_all(("range", field, low, high)))]
+
+    #Returns the first limit books with low <= field <= high ordered by field, read like find_books
+    def books_in_range(self, field, low=None, high=None, limit=None):
+        matches = heapq.merge(*self._ask_all(("rangerows", field, low, high, limit)), key=itemgetter(0, 1))
+        return [Book.from_record(*row) for value, id, row in islice(matches, limit)]
+
+    #Returns the best limit matching books of a keyword search, best first, read like find_books. The shards first say
+    #what the query words expand to and how many books have each word, then search with the figures of the whole
+    #catalogue, so every shard expands and weighs the words like a single list holding all the books would
+    def keyword_matches(self, query, limit):
+        replies = self._ask_all(("expand", query))
+        expansions = BookSearchIndex.merge_expansions([expansions for expansions, counts, books in replies])
+        counts = {}
+        for _, shardCounts, _ in replies:
+            for word, count in shardCounts.items(): counts[word] = counts.get(word, 0) + count
+        stats = (sum(books for _, _, books in replies), counts)
+        matches = heapq.nlargest(limit, (match for matches in self._ask_all(("keywords", limit, expansions, stats)) for match in matches), key=itemgetter(0, 1))
+        return [Book.from_record(*row) for score, id, row in matches]
+
+    #The largest book id ever stored, 0 when there are none
+    def max_record_id(self):
+        return self._highestID
+
+#A catalogue saved as one binary file that is memory mapped when opened, so opening it takes the same time whatever
+#its size and a record is only read and built when it is used. The file is a header followed by sections, each a
+#typed array in the machine's byte order, 8 byte aligned:
+#
+#   header          b"LMSCAT01", the length of the directory (8 bytes), the directory as JSON: {name: [offset, typecode, count]}
+#   strings         every distinct string once, as UTF-8 (strings.heap) and where each starts (strings.starts)
+#   <table>.ids     the record ids in the order they were added, a row is a position in this order
+#   <table>.<field> a fixed width column per field: ints, dates as day ordinals (0 for none), strings as string numbers.
+#                   A list of strings (authors) is a column of where each row's strings start in <field>.items
+#   <table>.byid    the ids sorted, with their rows (byid.rows), so an id is found with a binary search
+#   <field>.keys    the case folded keys of a searched string field, sorted, with where each key's rows start in <field>.rows
+#   <field>.sorted  the values of a range searched field sorted (ties by id), with their rows in <field>.sortedrows
+#   loans.*         the outstanding loans as columns, times as seconds since 1970 (LOAN_NO_TIME for none)
+#
+#It is attached like the other storages. The file itself is never changed: the records added, changed or removed
+#since it was written are kept here and combined with the file, and save writes them into a new file
+class MappedCatalog(LibraryObserver):
+    MAGIC = b"LMSCAT01"
+    BOOK_FIELDS = ColumnStore.BOOK_FIELDS
+    USER_FIELDS = ColumnStore.USER_FIELDS
+    #The fields with an index section: searched by key, or by range
+    BOOK_KEYS = ("title", "authors", "publisher")
+    BOOK_RANGES = ("year", "pubdate")
+    USER_KEYS = ("username", "firstname")
+    EPOCH = datetime(1970, 1, 1)
+    LOAN_NO_TIME = -2**63
+    BOOK_GETTERS = {"title": Book.get_title, "publisher": Book.get_publisher, "year": Book.get_year, "pubdate": Book.get_publicationDate}
+
+    def __init__(self, path):
+        self._path = path
+        self._open()
+
+    #Maps the file and reads its directory, the sections are views into the mapping and nothing else is read
+    def _open(self):
+        self._file = open(self._path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:8] != self.MAGIC:
+            self._map.close()
+            self._file.close()
+            raise ValueError(self._path + " is not a catalogue file")
+        length = int.from_bytes(self._map[8:16], "little")
+        directory = json.loads(self._map[16:16 + length])
+        if directory["byteorder"] != sys.byteorder: raise ValueError(self._path + " was written on a machine with another byte order")
+        self._highestID = directory.get("highestID", 0)
+        buffer = memoryview(self._map)
+        self._views = [buffer]
+        self._sections = {}
+        for name, (offset, typecode, count) in directory["sections"].items():
+            view = buffer[offset:offset + count * array(typecode).itemsize].cast(typecode)
+            self._views.append(view)
+            self._sections[name] = view
+        #Decoded strings, so the records built share them
+        self._strings = {}
+        #Changes made since the file was written: the records added or changed (the objects themselves) and the ids removed
+        self._changed = {"books": {}, "users": {}}
+        self._removed = {"books": set(), "users": set()}
+        self._addedLoans = {}
+        self._removedLoans = set()
+        self._counts = {table: len(self._sections[table + ".ids"]) for table in ("books", "users")}
+
+    def close(self):
+        for view in reversed(self._views): view.release()
+        self._map.close()
+        self._file.close()
+
+    def _string(self, number):
+        text = self._strings.get(number)
+        if text is None:
+            starts = self._sections["strings.starts"]
+            text = self._strings[number] = bytes(self._sections["strings.heap"][starts[number]:starts[number + 1]]).decode()
+        return text
+
+    #Lets bisect search the sorted keys of a field as strings
+    class _Keys:
+        def __init__(self, catalog, numbers):
+            self._catalog = catalog
+            self._numbers = numbers
+        def __len__(self): return len(self._numbers)
+        def __getitem__(self, i): return self._catalog._string(self._numbers[i])
+
+    #Returns the row of the id in the file, or None
+    def _row(self, table, id):
+        ids = self._sections[table + ".byid"]
+        i = bisect_left(ids, id)
+        if i < len(ids) and ids[i] == id: return self._sections[table + ".byid.rows"][i]
+        return None
+
+    def _values(self, table, fields, row):
+        values = []
+        for name, kind in fields:
+            column = self._sections[table + "." + name]
+            if kind == "int": values.append(column[row])
+            elif kind == "date": values.append(datetime.fromordinal(column[row]) if column[row] else None)
+            elif kind == "str": values.append(self._string(column[row]))
+            else:
+                items = self._sections[table + "." + name + ".items"]
+                values.append([self._string(items[i]) for i in range(column[row], column[row + 1])])
+        return values
+
+    #The ids of the file's records that are still current, i.e not removed or changed since
+    def _current(self, table, ids):
+        changed, removed = self._changed[table], self._removed[table]
+        if not changed and not removed: return list(ids)
+        return [id for id in ids if id not in changed and id not in removed]
+
+    def _has(self, table, id):
+        if id in self._changed[table]: return True
+        return id not in self._removed[table] and self._row(table, id) is not None
+
+    def _iter_ids(self, table):
+        changed, removed = self._changed[table], self._removed[table]
+        for id in self._sections[table + ".ids"]:
+            if id not in removed: yield id
+        #Changed records of the file keep their place, only the new ones go at the end
+        for id in list(changed):
+            if self._row(table, id) is None: yield id
+
+    #Returns the ids of the file's records whose field has the case folded key, in the order they were added
+    def _find(self, table, field, key):
+        keys = self._sections[table + "." + field + ".keys"]
+        i = bisect_left(self._Keys(self, keys), key)
+        if i == len(keys) or self._string(keys[i]) != key: return []
+        starts, rows = self._sections[table + "." + field + ".keystarts"], self._sections[table + "." + field + ".keyrows"]
+        ids = self._sections[table + ".ids"]
+        return self._current(table, (ids[row] for row in rows[starts[i]:starts[i + 1]]))
+
+    def _added(self, table, id, record):
+        if id not in self._changed[table] and not self._has(table, id): self._counts[table] += 1
+        self._removed[table].discard(id)
+        self._changed[table][id] = record
+    def _deleted(self, table, id):
+        if self._has(table, id): self._counts[table] -= 1
+        self._changed[table].pop(id, None)
+        if self._row(table, id) is not None: self._removed[table].add(id)
+
+    def book_added(self, book):
+        self._added("books", book.get_id(), book)
+    def book_removed(self, book):
+        self._deleted("books", book.get_id())
+    def book_changed(self, book, field, oldValue):
+        self._changed["books"][book.get_id()] = book
+    def user_added(self, user):
+        self._added("users", user.get_id(), user)
+    def user_removed(self, user):
+        self._deleted("users", user.get_id())
+    def user_changed(self, user, field, oldValue):
+        self._changed["users"][user.get_id()] = user
+    def loan_added(self, book, user, borrowedAt, dueAt):
+        self._addedLoans[(book.get_id(), user.get_id())] = (borrowedAt, dueAt)
+    def loan_removed(self, book, user):
+        if self._addedLoans.pop((book.get_id(), user.get_id()), None) is None: self._removedLoans.add((book.get_id(), user.get_id()))
+
+    #The largest id given out when the file was written (see write), or added since. 0 when there are none
+    def max_record_id(self):
+        largest = max((ids[-1] for ids in (self._sections["books.byid"], self._sections["users.byid"]) if len(ids)), default=0)
+        return max(self._highestID, largest, max(self._changed["books"], default=0), max(self._changed["users"], default=0))
+
+    def has_book(self, id):
+        return self._has("books", id)
+    def count_books(self):
+        return self._counts["books"]
+    #Builds the book from the file, a book added or changed since is returned as it is
+    def load_book(self, id):
+        book = self._changed["books"].get(id)
+        if book is not None or id in self._removed["books"]: return book
+        row = self._row("books", id)
+        if row is None: return None
+        return Book.from_record(id, *self._values("books", self.BOOK_FIELDS, row))
+    def iter_book_ids(self):
+        return self._iter_ids("books")
+    def iter_books(self):
+        for id in self.iter_book_ids(): yield self.load_book(id)
+
+    #Returns the ids of the books whose field equals value, ignoring case like the in memory indexes
+    def find_book_ids(self, field, value):
+        if field == "pubdate": return [id for key, id in self._range("pubdate", value, value)]
+        key = value.casefold()
+        ids = self._find("books", field, key)
+        for id, book in self._changed["books"].items():
+            if field == "authors": matched = any(author.casefold() == key for author in book.get_authors())
+            else: matched = self.BOOK_GETTERS[field](book).casefold() == key
+            if matched: ids.append(id)
+        return ids
+
+    #Dates are compared as day ordinals like they are stored, 0 standing for no date
+    @classmethod
+    def _range_value(self, field, value):
+        if field == "pubdate": return value.toordinal() if value else 0
+        return value
+
+    #Returns [(stored value, id)] for the current books with low <= field <= high, ordered by value and id
+    def _range(self, field, low, high):
+        values, rows = self._sections["books." + field + ".sorted"], self._sections["books." + field + ".sortedrows"]
+        start = 0 if low is None else bisect_left(values, self._range_value(field, low))
+        end = len(values) if high is None else bisect_right(values, self._range_value(field, high))
+        ids = self._sections["books.ids"]
+        changed, removed = self._changed["books"], self._removed["books"]
+        matches = [(values[i], ids[rows[i]]) for i in range(start, end) if ids[rows[i]] not in changed and ids[rows[i]] not in removed]
+        low = None if low is None else self._range_value(field, low)
+        high = None if high is None else self._range_value(field, high)
+        changedMatches = []
+        for id, book in changed.items():
+            value = self._range_value(field, self.BOOK_GETTERS[field](book))
+            if (low is None or value >= low) and (high is None or value <= high): changedMatches.append((value, id))
+        return list(heapq.merge(matches, sorted(changedMatches)))
+
+    #Returns the ids of the books with low <= field <= high ordered by field, field is year or pubdate
+    def book_ids_in_range(self, field, low=None, high=None):
+        return [id for value, id in self._range(field, low, high)]
+
+    #The books of a search are loaded by the BookList from the ids, only a ShardedStorage returns them itself
+    def find_books(self, field, value, limit=None):
+        return None
+    def books_in_range(self, field, low=None, high=None, limit=None):
+        return None
+
+    #Keyword searches aren't run by the catalogue, the BookList indexes the words of all the stored books itself (see _keyword_index)
+    def keyword_matches(self, query, limit):
+        return None
+
+    def has_user(self, id):
+        return self._has("users", id)
+    def count_users(self):
+        return self._counts["users"]
+    def load_user(self, id):
+        user = self._changed["users"].get(id)
+        if user is not None or id in self._removed["users"]: return user
+        row = self._row("users", id)
+        if row is None: return None
+        return User.from_record(id, *self._values("users", self.USER_FIELDS, row))
+    def iter_user_ids(self):
+        return self._iter_ids("users")
+    def iter_users(self):
+        for id in self.iter_user_ids(): yield self.load_user(id)
+    def find_user_ids(self, field, value):
+        key = value.casefold()
+        ids = self._find("users", field, key)
+        for id, user in self._changed["users"].items():
+            if (user.get_username() if field == "username" else user.get_firstname()).casefold() == key: ids.append(id)
+        return ids
+
+    #Returns the ids that are stored and the usernames (case folded) that are taken, out of the ones given
+    def find_users(self, ids, usernames):
+        return {id for id in ids if self.has_user(id)}, {username.casefold() for username in usernames if self.find_user_ids("username", username)}
+
+    #Yields (bookID, userID, borrowedAt, dueAt) for every outstanding loan
+    def iter_loans(self):
+        books, users = self._sections["loans.books"], self._sections["loans.users"]
+        times = (self._sections["loans.borrowed"], self._sections["loans.due"])
+        toTime = lambda seconds: None if seconds == self.LOAN_NO_TIME else self.EPOCH + timedelta(seconds=seconds)
+        for i in range(len(books)):
+            loan = (books[i], users[i])
+            if loan not in self._removedLoans and loan not in self._addedLoans: yield books[i], users[i], toTime(times[0][i]), toTime(times[1][i])
+        for (bookID, userID), (borrowedAt, dueAt) in list(self._addedLoans.items()): yield bookID, userID, borrowedAt, dueAt
+
+    #Writes the catalogue with the changes made since it was opened into path (default the file it was opened
+    #from, which is then mapped again). Nothing is written when there are no changes to the file
+    def save(self, path=None):
+        unchanged = not any(self._changed.values()) and not any(self._removed.values()) and not self._addedLoans and not self._removedLoans
+        if path is None:
+            if unchanged: return
+            self.write(self._path, self.iter_books(), self.iter_users(), self.iter_loans())
+            self.close()
+            self._open()
+        else: self.write(path, self.iter_books(), self.iter_users(), self.iter_loans())
+
+    @classmethod
+    def write(self, path, books, users=(), loans=(), highestID=None):
+        """
+        path: the file written, it is replaced whole once the new one is complete
+        books: the books to write, e.g a BookList
+        users: the users to write, e.g a UserList
+        loans: (bookID, userID, borrowedAt, dueAt) for each outstanding loan, e.g Loans.iter_loans()
+        highestID: the high-water mark of the ids kept in the header, default the largest id given out so far
+        """
+        strings = {}
+        sections = {}
+        bookRecords = [(book.get_id(), [book.get_title(), book.get_authors(), book.get_year(), book.get_publisher(), book.get_copies(),
+            book.get_availableCopies(), book.get_publicationDate()]) for book in books]
+        userRecords = [(user.get_id(), [user.get_username(), user.get_firstname(), user.get_surname(), user.get_houseNumber(),
+            user.get_streetname(), user.get_postcode(), user.get_email(), user.get_dateOfBirth()]) for user in users]
+        self._write_table(sections, strings, "books", self.BOOK_FIELDS, self.BOOK_KEYS, self.BOOK_RANGES, bookRecords)
+        self._write_table(sections, strings, "users", self.USER_FIELDS, self.USER_KEYS, (), userRecords)
+        loans = list(loans)
+        toSeconds = lambda moment: self.LOAN_NO_TIME if moment is None else int((moment - self.EPOCH).total_seconds())
+        sections["loans.books"] = array("q", (loan[0] for loan in loans))
+        sections["loans.users"] = array("q", (loan[1] for loan in loans))
+        sections["loans.borrowed"] = array("q", (toSeconds(loan[2]) for loan in loans))
+        sections["loans.due"] = array("q", (toSeconds(loan[3]) for loan in loans))
+        heap = bytearray()
+        starts = array("q", [0])
+        for text in strings:
+            heap += text.encode()
+            starts.append(len(heap))
+        sections["strings.heap"] = array("B", heap)
+        sections["strings.starts"] = starts
+        #The directory's offsets depend on its own length, it is laid out again until the length stays the same
+        directory = {"byteorder": sys.byteorder, "highestID": recordIDs.get_highest() if highestID is None else highestID, "sections": {}}
+        header = b""
+        while len(json.dumps(directory).encode()) != len(header):
+            header = json.dumps(directory).encode()
+            offset = len(self.MAGIC) + 8 + len(header)
+            offset += -offset % 8
+            for name, section in sections.items():
+                directory["sections"][name] = [offset, section.typecode, len(section)]
+                offset += len(section) * section.itemsize
+                offset += -offset % 8
+        header = json.dumps(directory).encode()
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(self.MAGIC + len(header).to_bytes(8, "little") + header)
+            for name, section in sections.items():
+                file.write(bytes(directory["sections"][name][0] - file.tell()))
+                section.tofile(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+
+    #Adds the columns and index sections of a table of (id, values) records, numbering the strings met in strings
+    @classmethod
+    def _write_table(self, sections, strings, table, fields, keyFields, rangeFields, records):
+        number = lambda text: strings.setdefault(text, len(strings))
+        ids = array("q", (id for id, values in records))
+        sections[table + ".ids"] = ids
+        for position, (name, kind) in enumerate(fields):
+            if kind == "int": sections[table + "." + name] = array("q", (values[position] for id, values in records))
+            elif kind == "date": sections[table + "." + name] = array("q", (values[position].toordinal() if values[position] else 0 for id, values in records))
+            elif kind == "str": sections[table + "." + name] = array("q", (number(values[position]) for id, values in records))
+            else:
+                starts, items = array("q", [0]), array("q")
+                for id, values in records:
+                    items.extend(number(text) for text in values[position])
+                    starts.append(len(items))
+                sections[table + "." + name] = starts
+                sections[table + "." + name + ".items"] = items
+            if name in keyFields:
+                rowsByKey = {}
+                for row, (id, values) in enumerate(records):
+                    texts = values[position] if kind == "strs" else [values[position]]
+                    for key in dict.fromkeys(text.casefold() for text in texts): rowsByKey.setdefault(key, []).append(row)
+                keys, starts, rows = array("q"), array("q", [0]), array("q")
+                for key in sorted(rowsByKey):
+                    keys.append(number(key))
+                    rows.extend(rowsByKey[key])
+                    starts.append(len(rows))
+                sections[table + "." + name + ".keys"] = keys
+                sections[table + "." + name + ".keystarts"] = starts
+                sections[table + "." + name + ".keyrows"] = rows
+            if name in rangeFields:
+                column = sections[table + "." + name]
+                order = sorted(range(len(records)), key=lambda row: (column[row], ids[row]))
+                sections[table + "." + name + ".sorted"] = array("q", (column[row] for row in order))
+                sections[table + "." + name + ".sortedrows"] = array("q", order)
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        sections[table + ".byid"] = array("q", (ids[row] for row in order))
+        sections[table + ".byid.rows"] = array("q", order)
+
+#Write-ahead journal of every change made to the books, users and loans, with snapshots for fast restarts.
+#Each change is appended to the journal as a JSON line with a sequence number. Lines are written and fsynced
+#in groups (group commit), so a crash loses at most the last unsynced group. A snapshot holds the whole
+#library as of a sequence number; on start the latest snapshot is loaded and only the journal lines after it
+#are replayed. Compacting writes a new snapshot and empties the journal, it also happens on its own at the first
+#sync after the journal grows past maxJournalBytes
+class OperationJournal(LibraryObserver):
+    JOURNAL = "journal.log"
+    SNAPSHOT = "snapshot.jsonl"
+    #The fields whose changes are journaled. Available copies are left out, they follow from the loans
+    BOOK_FIELDS = ("title", "authors", "year", "publisher", "copies", "pubdate")
+    USER_FIELDS = ("firstname", "surname", "houseNumber", "streetname", "postcode", "email", "dateOfBirth")
+    #Snapshots are loaded a batch of records at a time
+    LOAD_BATCH = 1000
+
+    def __init__(self, directory, groupSize=64, syncInterval=0.5, maxJournalBytes=64*1024*1024):
+        """
+        directory: where the journal and snapshot files are kept, created if needed
+        groupSize: the number of changes written together with a single fsync
+        syncInterval: seconds after which waiting changes are synced even if the group isn't full
+        maxJournalBytes: journal size that triggers a compaction
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._journalPath = os.path.join(directory, self.JOURNAL)
+        self._snapshotPath = os.path.join(directory, self.SNAPSHOT)
+        self._groupSize = groupSize
+        self._syncInterval = syncInterval
+        self._maxJournalBytes = maxJournalBytes
+        #Encoded lines waiting for the next group commit
+        self._pending = []
+        self._lastSync = time.monotonic()
+        self._seq = 0
+        self._file = None
+        self._books = self._users = self._loans = None
+        #Changes may come from several threads, they are numbered and written one at a time
+        self._lock = threading.RLock()
+
+    #Restores the library from the snapshot and journal, then starts journaling every change made to it
+    def attach(self, bookList, userList, loans):
+        self._books, self._users, self._loans = bookList, userList, loans
+        self._seq = self._load_snapshot()
+        self._replay()
+        self._file = open(self._journalPath, "ab")
+        for container in (bookList, userList, loans): container.add_observer(self)
+
+    #Loans and returns are recorded under the book's lock, so their sequence numbers follow the order they were made in
+    def _record(self, entry):
+        with self._lock:
+            self._seq += 1
+            entry["seq"] = self._seq
+            self._pending.append(json.dumps(entry, separators=(",", ":")).encode() + b"\n")
+            if len(self._pending) >= self._groupSize or time.monotonic() - self._lastSync >= self._syncInterval: self._write_pending()
+
+    def _write_pending(self):
+        with self._lock:
+            if self._pending:
+                self._file.write(b"".join(self._pending))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._pending = []
+            self._lastSync = time.monotonic()
+
+    #Commits the waiting changes, compacting afterwards if the journal got too big. Compacting takes the loans' locks,
+    #so it is left to sync and never done while a change is recorded under a book's lock
+    def sync(self):
+        with self._lock:
+            self._write_pending()
+            full = self._file.tell() > self._maxJournalBytes
+        if full: self.compact()
+
+    def close(self):
+        with self._lock:
+            self._write_pending()
+            self._file.close()
+
+    def book_added(self, book):
+        self._record({"op": "add_book", "book": bookToRecord(book)})
+    def book_removed(self, book):
+        self._record({"op": "remove_book", "id": book.get_id()})
+    def book_changed(self, book, field, oldValue):
+        if field in self.BOOK_FIELDS:
+            self._record({"op": "set_book", "id": book.get_id(), "field": field, "value": bookToRecord(book)[field]})
+    def user_added(self, user):
+        self._record({"op": "add_user", "user": userToRecord(user)})
+    def user_removed(self, user):
+        self._record({"op": "remove_user", "id": user.get_id()})
+    def user_changed(self, user, field, oldValue):
+        if field in self.USER_FIELDS:
+            self._record({"op": "set_user", "id": user.get_id(), "field": field, "value": userToRecord(user)[field]})
+    def loan_added(self, book, user, borrowedAt, dueAt):
+        self._record({"op": "borrow", "book": book.get_id(), "user": user.get_id(), "borrowedAt": timeToText(borrowedAt), "dueAt": timeToText(dueAt)})
+    def loan_removed(self, book, user):
+        self._record({"op": "return", "book": book.get_id(), "user": user.get_id()})
+
+    #Loads the snapshot if there is one and returns the sequence number it was taken at
+    def _load_snapshot(self):
+        if not os.path.exists(self._snapshotPath): return 0
+        books, users = [], []
+        with open(self._snapshotPath, "rb") as file:
+            header = json.loads(file.readline())
+            seq = header["seq"]
+            #The ids given out before the snapshot stay used, those of records deleted since included
+            recordIDs.reserve(header.get("highestID"))
+            for line in file:
+                entry = json.loads(line)
+                if "book" in entry: books.append(recordToBook(entry["book"]))
+                elif "user" in entry: users.append(recordToUser(entry["user"]))
+                else:
+                    bookID, userID, borrowedAt, dueAt = (entry["loan"] + [None, None])[:4]
+                    self._loans._restore_loan(bookID, userID, textToTime(borrowedAt), textToTime(dueAt))
+                if len(books) >= self.LOAD_BATCH:
+                    self._books.add_books(books)
+                    books = []
+                if len(users) >= self.LOAD_BATCH:
+                    self._users.add_users(users)
+                    users = []
+        self._books.add_books(books)
+        self._users.add_users(users)
+        return seq
+
+    #Applies the journal lines written after the snapshot. A line cut short by a crash ends the journal and is dropped
+    def _replay(self):
+        if not os.path.exists(self._journalPath): return
+        with open(self._journalPath, "r+b") as file:
+            offset = 0
+            for line in file:
+                try: entry = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError: entry = None
+                if entry is None:
+                    file.truncate(offset)
+                    break
+                offset += len(line)
+                if entry["seq"] <= self._seq: continue
+                self._apply(entry)
+                self._seq = entry["seq"]
+
+    #Applies a journal entry. The values were checked when they were first set, so they are set again without the
+    #setters' checks. An entry the library already reflects is skipped (a record or loan already there, a record
+    #already removed, a loan already returned), so replaying an entry the snapshot already holds changes nothing
+    def _apply(self, entry):
+        op = entry["op"]
+        if op == "add_book": self._books.add_books([recordToBook(entry["book"])])
+        elif op == "add_user": self._users.add_users([recordToUser(entry["user"])])
+        elif op == "remove_book":
+            book = self._books.get_book_by_id(entry["id"])
+            if book is not None: self._books._remove_book(book)
+        elif op == "remove_user":
+            user = self._users.get_user_by_id(entry["id"])
+            if user is not None: self._users._remove_user(user)
+        elif op == "set_book":
+            book, field, value = self._books.get_book_by_id(entry["id"]), entry["field"], entry["value"]
+            if book is None: return
+            if field == "copies": book._set_copies(value)
+            elif field == "pubdate": book._set_field(field, textToDate(value))
+            else: book._set_field(field, list(value) if field == "authors" else value)
+        elif op == "set_user":
+            user, field, value = self._users.get_user_by_id(entry["id"]), entry["field"], entry["value"]
+            if user is not None: user._set_field(field, textToDate(value) if field == "dateOfBirth" else value)
+        elif op in ("borrow", "return"):
+            book, user = self._books.get_book_by_id(entry["book"]), self._users.get_user_by_id(entry["user"])
+            if book is None or user is None: return
+            with self._loans._book_lock(book.get_id()):
+                onLoan = user.get_id() in self._loans.borrowedBooks.get(book.get_id(), [])
+                if op == "borrow" and not onLoan: self._loans._lend(book, user, textToTime(entry.get("borrowedAt")), textToTime(entry.get("dueAt")))
+                elif op == "return" and onLoan: self._loans._take_back(book, user)
+
+    #Writes a snapshot of the whole library and empties the journal. The snapshot is written to a
+    #temporary file and renamed, so a crash leaves either the old or the new snapshot in place.
+    #The loans are held still while it is written, so each loan and return is either in the snapshot or
+    #journaled after its sequence number, never both
+    def compact(self):
+        self._loans._lock_all()
+        try:
+            with self._lock: self._compact()
+        finally: self._loans._unlock_all()
+
+    def _compact(self):
+        self._write_pending()
+        temporaryPath = self._snapshotPath + ".tmp"
+        with open(temporaryPath, "wb") as file:
+            file.write(json.dumps({"seq": self._seq, "highestID": recordIDs.get_highest()}).encode() + b"\n")
+            for book in self._books: file.write(json.dumps({"book": bookToRecord(book)}, separators=(",", ":")).encode() + b"\n")
+            for user in self._users: file.write(json.dumps({"user": userToRecord(user)}, separators=(",", ":")).encode() + b"\n")
+            for (bookID, userID), (borrowedAt, dueAt, _) in self._loans.loanDates.items():
+                file.write(json.dumps({"loan": [bookID, userID, timeToText(borrowedAt), timeToText(dueAt)]}).encode() + b"\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporaryPath, self._snapshotPath)
+        #Journal lines up to the snapshot's sequence number are skipped on replay, so a crash here is harmless
+        self._file.close()
+        self._file = open(self._journalPath, "wb")
+
+#Yields (line number, record) from a .csv file with a header row, or from a file with one JSON object per line
+def readRecords(path):
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.lower().endswith(".csv"):
+            reader = csv.DictReader(file)
+            for record in reader: yield reader.line_num, record
+        else:
+            for lineNumber, line in enumerate(file, 1):
+                if not line.strip(): continue
+                try: record = json.loads(line)
+                except ValueError as error:
+                    yield lineNumber, error
+                    continue
+                yield lineNumber, record
+
+#Summary of a bulk import. Only the first maxRejects rejected rows are kept so memory stays bounded
+class ImportReport:
+    def __init__(self, maxRejects=1000):
+        self.accepted = 0
+        self.rejected = 0
+        #[(line number, reason)]
+        self.rejects = []
+        self._maxRejects = maxRejects
+
+    def reject(self, lineNumber, reason):
+        self.rejected += 1
+        if len(self.rejects) < self._maxRejects: self.rejects.append((lineNumber, reason))
+
+    def print_details(self):
+        print("Records imported:", self.accepted)
+        print("Records rejected:", self.rejected)
+        for lineNumber, reason in self.rejects: print("  line " + str(lineNumber) + ": " + reason)
+        if self.rejected > len(self.rejects): print("  ...", self.rejected - len(self.rejects), "more")
+
+#Loads books and users from CSV or JSONL files without asking for input. Records are read one at a time,
+#checked with the same rules as the constructors and added to the list a batch at a time,
+#so a file of any size is imported in constant memory. Invalid records are reported instead of stopping the import
+class BulkLoader:
+    def __init__(self, batchSize=1000, maxRejects=1000):
+        self._batchSize = batchSize
+        self._maxRejects = maxRejects
+
+    #Checks a batch of (line number, record) with the schema in one go, rejects the invalid records and adds the others.
+    #The records the list won't take (e.g a username already taken) are rejected too
+    def _add_batch(self, batch, schema, makeRecord, addRecords, report):
+        valid, errors = schema.validate_many([record for lineNumber, record in batch])
+        rejected = [(batch[position][0], "; ".join(error if field is None else field + ": " + error for _, field, error in recordErrors))
+            for position, recordErrors in groupby(errors, key=lambda x: x[0])]
+        if valid:
+            records = [makeRecord(values) for position, values in valid]
+            skipped = []
+            report.accepted += addRecords(records, skipped)
+            lineNumbers = {id(record): batch[position][0] for record, (position, values) in zip(records, valid)}
+            rejected.extend((lineNumbers[id(record)], reason) for record, reason in skipped)
+        for lineNumber, reason in sorted(rejected): report.reject(lineNumber, reason)
+
+    def _load(self, path, schema, makeRecord, addRecords):
+        report = ImportReport(self._maxRejects)
+        batch = []
+        for lineNumber, record in readRecords(path):
+            batch.append((lineNumber, record))
+            if len(batch) >= self._batchSize:
+                self._add_batch(batch, schema, makeRecord, addRecords, report)
+                batch = []
+        if batch: self._add_batch(batch, schema, makeRecord, addRecords, report)
+        return report
+
+    def load_books(self, path, bookList):
+        def makeBook(values):
+            title, authors, year, publisher, copies, pubdate = values
+            return Book.from_record(None, title, authors, year, publisher, copies, copies, pubdate)
+        return self._load(path, BOOK_SCHEMA, makeBook, bookList.add_books)
+
+    def load_users(self, path, userList):
+        return self._load(path, USER_SCHEMA, lambda values: User.from_record(None, *values), userList.add_users)
+
+#Serves the library as an HTTP/JSON API from a single asyncio event loop, so many clients can be connected at once.
+#Connections are kept alive and requests may be pipelined, the responses are written back in the order the requests came.
+#All the library calls are made on the event loop thread, one request at a time, so they need no locking.
+#
+#   GET    /books?q=words&limit=10            ranked keyword search
+#   GET    /books?title=|author=|publisher=   exact (case insensitive) field search
+#   GET    /books?from=1990&to=2000           year range search
+#   GET    /books?offset=0&limit=100          all books, a page at a time
+#   POST   /books                             add a book, same fields as the bulk import
+#   GET    /books/<id>, DELETE /books/<id>
+#   GET    /users?offset=0&limit=100          all users, a page at a time
+#   POST   /users                             add a user, same fields as the bulk import
+#   GET    /users/<id>, DELETE /users/<id>
+#   GET    /users/<id>/loans                  books borrowed by the user
+#   POST   /loans {"book": id, "user": id}    borrow a book
+#   DELETE /loans/<bookID>/<userID>           return a book
+#   GET    /loans/overdue                     overdue loans, the most overdue first
+#   GET    /changes?after=<seq>&limit=100     changes to the books after a cursor, see _get_changes
+#   GET    /metrics                           call counts and latencies of the library operations
+class LibraryServer:
+    STATUS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 410: "Gone",
+        413: "Payload Too Large", 500: "Internal Server Error"}
+    MAX_BODY = 1024 * 1024
+    MAX_PAGE = 1000
+
+    def __init__(self, bookList, userList, loans, host="127.0.0.1", port=8080, maintenance=()):
+        """
+        bookList, userList, loans: the library that is served
+        host, port: address to listen on, port 0 picks a free port
+        maintenance: functions called every second and when the server stops, e.g to flush the storage or sync the journal
+        """
+        self._books = bookList
+        self._users = userList
+        self._loans = loans
+        self._host = host
+        self._port = port
+        self._maintenance = list(maintenance)
+        #Lets displays follow the changes to the books from a cursor, see _get_changes
+        self._changes = ChangeFeed(bookList)
+        self._server = None
+        #[(method, compiled path pattern, handler)], the handlers get the path groups, the query and the decoded body
+        self._routes = [
+            ("GET", re.compile(r"/books"), self._get_books),
+            ("POST", re.compile(r"/books"), self._add_book),
+            ("GET", re.compile(r"/books/(-?\d+)"), self._get_book),
+            ("DELETE", re.compile(r"/books/(-?\d+)"), self._delete_book),
+            ("GET", re.compile(r"/users"), self._get_users),
+            ("POST", re.compile(r"/users"), self._add_user),
+            ("GET", re.compile(r"/users/(-?\d+)"), self._get_user),
+            ("DELETE", re.compile(r"/users/(-?\d+)"), self._delete_user),
+            ("GET", re.compile(r"/users/(-?\d+)/loans"), self._get_user_loans),
+            ("GET", re.compile(r"/users/(-?\d+)/holds"), self._get_user_holds),
+            ("POST", re.compile(r"/holds"), self._place_hold),
+            ("DELETE", re.compile(r"/holds/(-?\d+)/(-?\d+)"), self._cancel_hold),
+            ("POST", re.compile(r"/loans"), self._borrow),
+            ("POST", re.compile(r"/loans/batch"), self._borrow_many),
+            ("POST", re.compile(r"/loans/returns"), self._return_many),
+            ("DELETE", re.compile(r"/loans/(-?\d+)/(-?\d+)"), self._return),
+            ("GET", re.compile(r"/loans/overdue"), self._get_overdue),
+            ("GET", re.compile(r"/changes"), self._get_changes),
+            ("GET", re.compile(r"/metrics"), self._get_metrics),
+            ("GET", re.compile(r"/metrics/search-cache"), self._get_search_cache),
+        ]
+
+    #Starts listening and returns the port, the connections are then served while the event loop runs
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_client, self._host, self._port, backlog=1024)
+        self._port = self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        for function in self._maintenance: function()
+
+    #Serves until cancelled (Ctrl-C with run)
+    async def serve(self):
+        await self.start()
+        print("Serving the library on http://" + self._host + ":" + str(self._port))
+        try:
+            while True:
+                await asyncio.sleep(1)
+                for function in self._maintenance: function()
+        finally:
+            await self.stop()
+
+    def run(self):
+        try: asyncio.run(self.serve())
+        except KeyboardInterrupt: print("Server stopped.")
+
+    async def _serve_client(self, reader, writer):
+        try:
+            while True:
+                try: request = await self._read_request(reader)
+                except ValueError as error:
+                    writer.write(self._response(400, {"error": str(error)}, False))
+                    break
+                if request is None: break
+                method, target, body, keepAlive = request
+                status, payload = self._dispatch(method, target, body)
+                writer.write(self._response(status, payload, keepAlive))
+                #drain only waits when the socket buffer is full, so the responses to pipelined requests go out back to back
+                await writer.drain()
+                if not keepAlive: break
+        except (ConnectionError, asyncio.IncompleteReadError): pass
+        finally: writer.close()
+
+    #Reads one request and returns (method, target, body, keepAlive), or None when the client has closed the connection
+    async def _read_request(self, reader):
+        try: head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as error:
+            if error.partial.strip(): raise ValueError("incomplete request")
+            return None
+        except asyncio.LimitOverrunError: raise ValueError("request head too long")
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."): raise ValueError("malformed request line")
+        method, target, version = parts
+        headers = {}
+        for line in lines[1:]:
+            if not line: continue
+            name, colon, value = line.partition(":")
+            if not colon: raise ValueError("malformed header: " + line)
+            headers[name.strip().lower()] = value.strip()
+        length = headers.get("content-length", "0")
+        if not length.isdigit(): raise ValueError("bad content-length")
+        if int(length) > self.MAX_BODY: raise ValueError("body too large")
+        body = await reader.readexactly(int(length)) if int(length) else b""
+        connection = headers.get("connection", "").lower()
+        keepAlive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        return method, target, body, keepAlive
+
+    def _response(self, status, payload, keepAlive):
+        body = json.dumps(payload).encode()
+        head = "HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\nConnection: {3}\r\n\r\n".format(
+            status, self.STATUS[status], len(body), "keep-alive" if keepAlive else "close")
+        return head.encode() + body
+
+    #Returns (status, payload) for the request
+    def _dispatch(self, method, target, body):
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        allowed = False
+        for routeMethod, pattern, handler in self._routes:
+            match = pattern.fullmatch(url.path)
+            if match is None: continue
+            if routeMethod != method:
+                allowed = True
+                continue
+            if body:
+                try: body = json.loads(body)
+                except ValueError: return 400, {"error": "body is not valid JSON"}
+            try: return handler(*match.groups(), query=query, body=body)
+            except Exception as error: return 500, {"error": type(error).__name__ + ": " + str(error)}
+        if allowed: return 405, {"error": method + " is not allowed on " + url.path}
+        return 404, {"error": "no such resource: " + url.path}
+
+    #Returns the offset and limit of a page, or an error message
+    def _page(self, query, limit=100):
+        offset, offsetError = checkInput(query.get("offset"), int, True)
+        limit, limitError = checkInput(query.get("limit", limit), int)
+        if offsetError or limitError: return None, None, "offset and limit must be integers"
+        return offset or 0, min(limit, self.MAX_PAGE), None
+
+    def _get_books(self, query, body):
+        offset, limit, error = self._page(query, 10 if "q" in query else 100)
+        if error: return 400, {"error": error}
+        if "q" in query: books = self._books.iter_keyword_matches(query["q"], offset, limit)
+        elif "title" in query: books = self._books.iter_books_by("title", query["title"], offset, limit)
+        elif "author" in query: books = self._books.iter_books_by("authors", query["author"], offset, limit)
+        elif "publisher" in query: books = self._books.iter_books_by("publisher", query["publisher"], offset, limit)
+        elif "from" in query or "to" in query:
+            start, startError = checkInput(query.get("from"), int, True)
+            end, endError = checkInput(query.get("to"), int, True)
+            if startError or endError: return 400, {"error": "from and to must be years"}
+            books = self._books.iter_books_in_range("year", start, end, offset, limit)
+        else: books = islice(self._books, offset, offset + limit)
+        return 200, {"books": [bookToRecord(book) for book in books]}
+
+    def _get_book(self, id, query, body):
+        book = self._books.get_book_by_id(int(id))
+        if book is None: return 404, {"error": "no such book"}
+        return 200, bookToRecord(book)
+
+    def _add_book(self, query, body):
+        if not isinstance(body, dict): return 400, {"error": "expected a JSON object"}
+        (title, authors, year, publisher, copies, pubdate), errors = BOOK_SCHEMA.validate(body)
+        if errors: return 400, {"error": "; ".join(field + ": " + error for field, error in errors), "fields": dict(errors)}
+        book = Book.from_record(None, title, authors, year, publisher, copies, copies, pubdate)
+        self._books.add_books([book])
+        return 201, bookToRecord(book)
+
+    def _delete_book(self, id, query, body):
+        book = self._books.get_book_by_id(int(id))
+        if book is None: return 404, {"error": "no such book"}
+        if self._books.delete_books([book.get_id()])[1]: return 409, {"error": "the book is on loan"}
+        return 200, {"deleted": book.get_id()}
+
+    def _get_users(self, query, body):
+        offset, limit, error = self._page(query)
+        if error: return 400, {"error": error}
+        return 200, {"users": [userToRecord(user) for user in islice(self._users, offset, offset + limit)]}
+
+    def _get_user(self, id, query, body):
+        user = self._users.get_user_by_id(int(id))
+        if user is None: return 404, {"error": "no such user"}
+        return 200, userToRecord(user)
+
+    def _add_user(self, query, body):
+        if not isinstance(body, dict): return 400, {"error": "expected a JSON object"}
+        values, errors = USER_SCHEMA.validate(body)
+        if errors: return 400, {"error": "; ".join(field + ": " + error for field, error in errors), "fields": dict(errors)}
+        user = User.from_record(None, *values)
+        if not self._users.add_users([user]): return 409, {"error": "username already taken"}
+        return 201, userToRecord(user)
+
+    def _delete_user(self, id, query, body):
+        user = self._users.get_user_by_id(int(id))
+        if user is None: return 404, {"error": "no such user"}
+        if self._users.delete_users([user.get_id()])[1]: return 409, {"error": "the user has books on loan"}
+        return 200, {"deleted": user.get_id()}
+
+    def _loan_record(self, book, user):
+        borrowedAt, dueAt = self._loans.get_loan_dates(book, user)
+        return {"book": book.get_id(), "user": user.get_id(), "title": book.get_title(), "borrowedAt": timeToText(borrowedAt), "dueAt": timeToText(dueAt)}
+
+    def _get_user_loans(self, id, query, body):
+        user = self._users.get_user_by_id(int(id))
+        if user is None: return 404, {"error": "no such user"}
+        books = [self._books.get_book_by_id(bookID) for bookID in self._loans.get_books_borrowed_by_user(user)]
+        return 200, {"loans": [self._loan_record(book, user) for book in books]}
+
+    def _get_user_holds(self, id, query, body):
+        user = self._users.get_user_by_id(int(id))
+        if user is None: return 404, {"error": "no such user"}
+        return 200, {"holds": [{"book": book.get_id(), "title": book.get_title(), "position": position} for book, position in self._loans.get_holds_of_user(user)]}
+
+    def _place_hold(self, query, body):
+        if not isinstance(body, dict) or not isinstance(body.get("book"), int) or not isinstance(body.get("user"), int):
+            return 400, {"error": 'expected {"book": id, "user": id}'}
+        book = self._books.get_book_by_id(body["book"])
+        user = self._users.get_user_by_id(body["user"])
+        if book is None or user is None: return 404, {"error": "no such book" if book is None else "no such user"}
+        error = self._loans.place_hold(book, user)
+        if error: return 409, {"error": error}
+        return 201, {"book": book.get_id(), "user": user.get_id(), "position": self._loans.get_hold_position(book, user)}
+
+    def _cancel_hold(self, bookID, userID, query, body):
+        book = self._books.get_book_by_id(int(bookID))
+        user = self._users.get_user_by_id(int(userID))
+        if book is None or user is None: return 404, {"error": "no such book" if book is None else "no such user"}
+        error = self._loans.cancel_hold(book, user)
+        if error: return 409, {"error": error}
+        return 200, {"cancelled": book.get_id(), "user": user.get_id()}
+
+    def _borrow(self, query, body):
+        if not isinstance(body, dict) or not isinstance(body.get("book"), int) or not isinstance(body.get("user"), int):
+            return 400, {"error": 'expected {"book": id, "user": id}'}
+        book = self._books.get_book_by_id(body["book"])
+        user = self._users.get_user_by_id(body["user"])
+        if book is None or user is None: return 404, {"error": "no such book" if book is None else "no such user"}
+        error = self._loans.borrow(book, user)
+        if error: return 409, {"error": error}
+        return 201, self._loan_record(book, user)
+
+    #Reads {"user": id, "books": [id, ...]} and lends or takes back all the books with change, e.g loans.borrow_many.
+    #When that worked the response is status and respond(user, books)
+    def _batch(self, body, change, status, respond):
+        if not isinstance(body, dict) or not isinstance(body.get("user"), int) or not isinstance(body.get("books"), list) \
+                or not all(isinstance(id, int) for id in body["books"]):
+            return 400, {"error": 'expected {"user": id, "books": [id, ...]}'}
+        user = self._users.get_user_by_id(body["user"])
+        if user is None: return 404, {"error": "no such user"}
+        results = change(body["books"], user)
+        if any(result != Loans.OK for result in results):
+            return 409, {"error": "none of the books were changed", "results": [{"book": id, "result": result} for id, result in zip(body["books"], results)]}
+        return status, respond(user, [self._books.get_book_by_id(id) for id in body["books"]])
+
+    def _borrow_many(self, query, body):
+        return self._batch(body, self._loans.borrow_many, 201, lambda user, books: {"loans": [self._loan_record(book, user) for book in books]})
+
+    def _return_many(self, query, body):
+        return self._batch(body, self._loans.return_many, 200, lambda user, books: {"returned": [book.get_id() for book in books], "user": user.get_id()})
+
+    def _return(self, bookID, userID, query, body):
+        book = self._books.get_book_by_id(int(bookID))
+        user = self._users.get_user_by_id(int(userID))
+        if book is None or user is None: return 404, {"error": "no such book" if book is None else "no such user"}
+        error = self._loans.give_back(book, user)
+        if error: return 409, {"error": error}
+        return 200, {"returned": book.get_id(), "user": user.get_id()}
+
+    def _get_overdue(self, query, body):
+        offset, limit, error = self._page(query)
+        if error: return 400, {"error": error}
+        overdue = islice(self._loans.iter_overdue_loans(), offset, offset + limit)
+        return 200, {"loans": [{"book": book.get_id(), "user": user.get_id(), "title": book.get_title(), "dueAt": timeToText(dueAt)}
+            for dueAt, book, user in overdue]}
+
+    #Without after only the cursor of the latest change is returned, a client reads the books once and then asks for
+    #the changes after that cursor, passing the cursor of each answer to the next request. The feed only keeps the
+    #latest changes, a cursor from before them (or from before a restart) is answered with 410 and
+    #{"status": "resync_required", "oldest": seq of the oldest change kept, "cursor": seq of the latest change}.
+    #The client must then read the books again and carry on from that cursor, the changes in between are lost
+    def _get_changes(self, query, body):
+        cursor, cursorError = checkInput(query.get("after"), int, True)
+        #Only a missing limit is taken as 100, limit=0 asks for an empty page (e.g to check the cursor is still kept)
+        limit, limitError = checkInput(query.get("limit", 100), int)
+        if cursorError or limitError: return 400, {"error": "after and limit must be whole numbers"}
+        if cursor is None: return 200, {"events": [], "cursor": self._changes.sequence}
+        events = self._changes.read(cursor, min(limit, self.MAX_PAGE))
+        if events is None:
+            oldest, latest = self._changes.retained()
+            return 410, {"status": "resync_required", "error": "changes after this cursor are no longer kept", "oldest": oldest, "cursor": latest}
+        return 200, {"events": [changeToRecord(event) for event in events], "cursor": events[-1][0] if events else cursor}
+
+    def _get_metrics(self, query, body):
+        return 200, libraryMetrics.dump()
+
+    def _get_search_cache(self, query, body):
+        return 200, self._books.get_search_cache_stats()
+
+#Load test for a running LibraryServer. Each connection keeps sending pipelined batches of GET requests, picked from
+#paths, until the requests are used up. The latency of a request runs from sending its batch to reading its response.
+#When no paths are given a mix of book lookups and keyword searches is made from the first books the server lists.
+#Returns {"requests", "errors", "seconds", "rps", "p50", "p99"} with the latencies in milliseconds
+def loadTest(host="127.0.0.1", port=8080, connections=50, requests=20000, pipeline=8, paths=None):
+    async def fetch(reader, writer, path):
+        writer.write(("GET " + path + " HTTP/1.1\r\nHost: " + host + "\r\n\r\n").encode())
+        await writer.drain()
+        return await readResponse(reader)
+
+    #Returns (status, body)
+    async def readResponse(reader):
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        length = 0
+        for line in head[1:]:
+            name, colon, value = line.partition(":")
+            if name.strip().lower() == "content-length": length = int(value)
+        return int(head[0].split(" ")[1]), await reader.readexactly(length)
+
+    async def client(paths, count, latencies, errors, seed):
+        generator = random.Random(seed)
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while count > 0:
+                batch = min(pipeline, count)
+                count -= batch
+                request = "".join("GET " + generator.choice(paths) + " HTTP/1.1\r\nHost: " + host + "\r\n\r\n" for _ in range(batch))
+                started = time.perf_counter()
+                writer.write(request.encode())
+                await writer.drain()
+                for _ in range(batch):
+                    status, body = await readResponse(reader)
+                    latencies.append(time.perf_counter() - started)
+                    if status >= 400: errors[0] += 1
+        finally: writer.close()
+
+    async def main(paths):
+        if not paths:
+            reader, writer = await asyncio.open_connection(host, port)
+            status, body = await fetch(reader, writer, "/books?limit=100")
+            writer.close()
+            books = json.loads(body)["books"] if status == 200 else []
+            paths = ["/books/" + str(book["id"]) for book in books]
+            paths += ["/books?q=" + quote(book["title"].split()[0]) for book in books if book["title"].split()]
+            if not paths: paths = ["/books?limit=10"]
+        latencies, errors = [], [0]
+        share, extra = divmod(requests, connections)
+        started = time.perf_counter()
+        await asyncio.gather(*[client(paths, share + (i < extra), latencies, errors, i) for i in range(connections)])
+        return latencies, errors[0], time.perf_counter() - started
+
+    latencies, errors, seconds = asyncio.run(main(paths))
+    latencies.sort()
+    percentile = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 3) if latencies else None
+    return {"requests": len(latencies), "errors": errors, "seconds": round(seconds, 3), "rps": round(len(latencies) / seconds) if seconds else None,
+        "p50": percentile(0.50), "p99": percentile(0.99)}
+
+def handleMenu():
     menu = """
     WELCOME TO LIBRARY
 
@@ -505,11 +4275,20 @@ def handleMenu():
     14. Modify users
 
     Other Tools
+    15. Import books or users from a CSV/JSONL file
+    16. Compact the journal
+    17. Get books due back in the next days
+    18. Show operation metrics
+    19. Profile the next call of an operation
+    20. Show circulation report
+    21. Place a hold on a book
+    22. Cancel a hold on a book
+    23. Get the holds of a user
     99. Exit program
     
     Enter a menu number: """
 
-    return handleInput(input(menu), "Enter a valid number between 1 and 14 or 99: ", list(map(lambda x: str(x), range(1, 15)))+["99"])
+    return handleInput(input(menu), "Enter a valid number between 1 and 23 or 99: ", ChoiceRule(range(1, 24), "99"))
 
 def handleBookSearch():
     menu = """
@@ -517,11 +4296,14 @@ def handleBookSearch():
     2. Search by author
     3. Search by publisher
     4. Search by publication date
+    5. Search by keywords (partial or misspelled words are fine)
+    6. Search by year range
+    7. Search by publication date range
     99. Go Back <<
 
     Enter a menu number: """
 
-    return handleInput(input(menu), "Enter a valid number between 1 and 4 or 99: ", list(map(lambda x: str(x), range(1, 5)))+["99"])
+    return handleInput(input(menu), "Enter a valid number between 1 and 7 or 99: ", ChoiceRule(range(1, 8), "99"))
 
 def handleBookModification():
     menu = """
@@ -535,7 +4317,7 @@ def handleBookModification():
 
     Enter a menu number: """
 
-    return handleInput(input(menu), "Enter a valid number between 1 and 6 or 99: ", list(map(lambda x: str(x), range(1, 7)))+["99"])
+    return handleInput(input(menu), "Enter a valid number between 1 and 6 or 99: ", ChoiceRule(range(1, 7), "99"))
 
 def handleUserModification():
     menu = """
@@ -548,14 +4330,98 @@ def handleUserModification():
 
     Enter a menu number: """
 
-    return handleInput(input(menu), "Enter a valid number between 1 and 5 or 99: ", list(map(lambda x: str(x), range(1, 6)))+["99"])
+    return handleInput(input(menu), "Enter a valid number between 1 and 5 or 99: ", ChoiceRule(range(1, 6), "99"))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Library management system")
+    persistence = parser.add_mutually_exclusive_group()
+    persistence.add_argument("--db", help="SQLite database file the library is kept in between runs")
+    persistence.add_argument("--journal", help="directory of the journal and snapshot the library is kept in between runs")
+    persistence.add_argument("--columns", action="store_true", help="keep the books and users in memory as compact columns, for very large catalogues")
+    persistence.add_argument("--shards", type=int, nargs="?", const=0, metavar="PROCESSES",
+        help="keep the books in worker processes (default one per core) that are searched in parallel, for very large catalogues")
+    persistence.add_argument("--catalog", metavar="PATH", help="memory mapped catalogue file the library is opened from and saved back to, for quick starts of very large catalogues")
+    parser.add_argument("--write-catalog", metavar="PATH", help="write the library (e.g loaded with --db or --journal) to a catalogue file, then exit")
+    parser.add_argument("--stress-test", action="store_true", help="check that concurrent borrowing and returning keeps the copies consistent, then exit")
+    parser.add_argument("--benchmark", nargs="?", const="10k,100k", metavar="SIZES",
+        help="time the library operations on synthetic libraries of these numbers of books (e.g 10k,100k,1M), then exit")
+    parser.add_argument("--benchmark-shards", nargs="?", const="100k", metavar="BOOKS",
+        help="time the searches of a synthetic catalogue of this many books held in memory and in 1, 2 and 4 shards, then exit")
+    parser.add_argument("--benchmark-output", default="benchmark.json", metavar="PATH", help="JSON file the benchmark results are written to")
+    parser.add_argument("--measure-memory", type=int, nargs="?", const=100000, metavar="RECORDS",
+        help="print the bytes per book and user held as objects and as columns, then exit")
+    service = parser.add_mutually_exclusive_group()
+    service.add_argument("--serve", type=int, metavar="PORT", help="serve the library as an HTTP/JSON API instead of showing the menu")
+    service.add_argument("--loadtest", type=int, metavar="PORT", help="load test a library server running on the port, then exit")
+    parser.add_argument("--host", default="127.0.0.1", help="address the server listens on or the load test connects to")
+    parser.add_argument("--connections", type=int, default=50, help="concurrent connections opened by the load test")
+    parser.add_argument("--requests", type=int, default=20000, help="requests made by the load test")
+    parser.add_argument("--pipeline", type=int, default=8, help="requests the load test sends on a connection before reading the responses")
+    parser.add_argument("--no-metrics", action="store_true", help="don't count and time the library operations")
+    args = parser.parse_args()
+    if not args.no_metrics: libraryMetrics.instrument(BookList, UserList, Loans)
+    if args.stress_test: sys.exit(1 if stressTestCirculation() else 0)
+    if args.benchmark:
+        runBenchmarks([parseCount(size) for size in args.benchmark.split(",")], args.benchmark_output, columns=args.columns)
+        sys.exit()
+    if args.benchmark_shards:
+        benchmarkShards(parseCount(args.benchmark_shards), path=args.benchmark_output)
+        sys.exit()
+    if args.measure_memory:
+        for name, size in measureRecordMemory(args.measure_memory).items(): print("Bytes per record,", name + ":", size)
+        sys.exit()
+    if args.loadtest is not None:
+        results = loadTest(args.host, args.loadtest, args.connections, args.requests, args.pipeline)
+        print("Requests:", results["requests"], "Errors:", results["errors"], "Seconds:", results["seconds"])
+        print("Requests/sec:", results["rps"], "p50 ms:", results["p50"], "p99 ms:", results["p99"])
+        sys.exit()
+
     bookList = BookList()
     userList = UserList()
     loans = Loans(bookList, userList)
+    storage = None
+    if args.db:
+        storage = SQLiteStorage(args.db)
+        #exit() may be called on bad input, the queued writes are still flushed then
+        atexit.register(storage.close)
+        bookList.attach_storage(storage)
+        userList.attach_storage(storage)
+        loans.attach_storage(storage)
+    if args.columns:
+        columnStore = ColumnStore()
+        bookList.attach_storage(columnStore)
+        userList.attach_storage(columnStore)
+    if args.shards is not None:
+        shards = ShardedStorage(args.shards)
+        atexit.register(shards.close)
+        bookList.attach_storage(shards)
+    if args.catalog:
+        if not os.path.exists(args.catalog): MappedCatalog.write(args.catalog, ())
+        catalog = MappedCatalog(args.catalog)
+        bookList.attach_storage(catalog)
+        userList.attach_storage(catalog)
+        loans.attach_storage(catalog)
+        #The changes are kept beside the mapped file until they are written back on exit
+        atexit.register(catalog.save)
+    journal = None
+    if args.journal:
+        journal = OperationJournal(args.journal)
+        journal.attach(bookList, userList, loans)
+        atexit.register(journal.close)
+    if args.write_catalog:
+        MappedCatalog.write(args.write_catalog, bookList, userList, loans.iter_loans())
+        sys.exit()
+    if args.serve is not None:
+        maintenance = [function for function in (storage and storage.flush, journal and journal.sync, loans.expire_holds) if function]
+        LibraryServer(bookList, userList, loans, args.host, args.serve, maintenance).run()
+        sys.exit()
+    #Made once the stored loans are loaded back, so they are counted in the report too
+    loanHistory = LoanHistory(loans)
 
     while True:
+        if storage is not None: storage.flush()
+        if journal is not None: journal.sync()
+        loans.expire_holds()
         num = handleMenu()
         if num == "1":
             print()
@@ -594,6 +4460,12 @@ if __name__ == "__main__":
                 bookList.search_by_publisher(handleInput(input("Enter publisher name: "), "Error: re-enter publisher name: "))
             elif num == "4":
                 bookList.search_by_publication_date(handleInput(input("Enter publisher date in format, 2020, 02, 23: "), "", datetime))
+            elif num == "5":
+                bookList.search_by_keywords(handleInput(input("Enter keywords: "), "Error: re-enter keywords: "))
+            elif num == "6":
+                bookList.search_by_year_range(handleInput(input("Enter the first year: "), "Error: re-enter year, Integer: ", int), handleInput(input("Enter the last year: "), "Error: re-enter year, Integer: ", int))
+            elif num == "7":
+                bookList.search_by_publication_date_range(handleInput(input("Enter the first date in format, 2020, 02, 23: "), "", datetime), handleInput(input("Enter the last date in format, 2020, 02, 23: "), "", datetime))
             else: continue
         elif num == "8":
             bookList.delete_book_by_title(handleInput(input("Enter book title: "), "Error: Re-enter title: "))
@@ -615,7 +4487,8 @@ if __name__ == "__main__":
                 if num == "5":
                     book.set_publisher(handleInput(input("Enter publisher name: "), "Error: Re-enter publisher name: "))
                 if num == "6":
-                    book.set_copies(handleInput(input("Enter number of copies: "), "Error: Re-enter number of copies, Integer: ", int))
+                    error = loans.set_copies(book, handleInput(input("Enter number of copies: "), "Error: Re-enter number of copies, Integer: ", int))
+                    if error: print(error)
                 else: continue
         elif num == "11":
             userList.remove_user_by_firstname(handleInput(input("Enter user firstname: "), "Error: re-enter firstname: "))
@@ -640,4 +4513,53 @@ if __name__ == "__main__":
                 if num == "5":
                     user.set_postcode(handleInput(input("Enter postcode: "), "Error: Re-enter postcode: "))
                 else: continue
+        elif num == "15":
+            kind = handleInput(input("Import 1. books or 2. users: "), "Error: Enter 1 or 2: ", ["1", "2"])
+            path = handleInput(input("Enter the file path (.csv or .jsonl): "), "Error: Re-enter the file path: ")
+            try:
+                if kind == "1": report = BulkLoader().load_books(path, bookList)
+                else: report = BulkLoader().load_users(path, userList)
+                report.print_details()
+            except OSError as error: print("Error: could not read the file:", error)
+        elif num == "16":
+            if journal is None: print("The journal is not enabled, start the program with --journal <directory>")
+            else:
+                journal.compact()
+                print("Journal compacted.")
+        elif num == "17":
+            loans.print_loans_due_within(handleInput(input("Enter the number of days: "), "Error: Re-enter the number of days, integer: ", int))
+        elif num == "18":
+            libraryMetrics.print_details()
+            cache = bookList.get_search_cache_stats()
+            print("\nSearch cache: {0} hits, {1} misses, {2} evictions, {3} invalidations, {4} of {5} entries used".format(cache["hits"],
+                cache["misses"], cache["evictions"], cache["invalidations"], cache["entries"], cache["capacity"]))
+            if handleInput(input("\nReset the figures? (y/n): "), "Error: Enter y or n: ", ["y", "n", "Y", "N"]).lower() == "y":
+                libraryMetrics.reset()
+                print("Figures reset.")
+        elif num == "19":
+            operations = libraryMetrics.get_operations()
+            if operations:
+                print()
+                for i, operation in enumerate(operations): print(str(i+1)+". "+operation)
+                index = handleInput(input("\nEnter the index of the operation to profile: "), "Error: Enter between 1 and "+str(len(operations))+": ", range(1, len(operations)+1))
+                libraryMetrics.capture_profile(operations[int(index)-1])
+                print("The next call of", operations[int(index)-1], "will be profiled.")
+            else: print("Metrics are off, start the program without --no-metrics")
+        elif num == "20":
+            try: CirculationAnalytics(bookList, loanHistory).print_report()
+            except ImportError as error: print("Error:", error)
+        elif num == "21" or num == "22":
+            book = bookList.print_and_get_books()
+            if not book is None:
+                user = userList.print_and_get_users()
+                if not user is None:
+                    if num == "21": loans.place_a_hold(book, user)
+                    else: loans.cancel_a_hold(book, user)
+        elif num == "23":
+            user = userList.print_and_get_users()
+            if not user is None:
+                holds = loans.get_holds_of_user(user)
+                if not holds: print("User has no holds")
+                for book, position in holds:
+                    print(book.get_title() + ":", "ready to pick up" if position == 0 else "number " + str(position) + " in the queue")
         else: break
\ No newline at end of file
@@ -0,0 +1,23 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+#The module's file name starts with digits, so it is loaded from its path instead of being imported by name
+PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "219550851_system_source_code.py")
+
+def loadLibrary():
+    spec = importlib.util.spec_from_file_location("library", PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["library"] = module
+    spec.loader.exec_module(module)
+    return module
+
+library = loadLibrary()
+
+@pytest.fixture
+def lms():
+    #Every test starts with ids from 1, like a new run of the program
+    library.recordIDs = library.IDAllocator()
+    return library
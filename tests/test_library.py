@@ -0,0 +1,682 @@
+import json
+import random
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+def makeBook(lms, title, copies=1, authors=None, year=2000, publisher="Publisher", pubdate="2000, 01, 02"):
+    return lms.Book(title, authors or "Author " + title, str(year), publisher, str(copies), pubdate)
+
+def makeUser(lms, username):
+    return lms.User(username, "First", "Last", "1", "Street", "PC1", username + "@example.com", "1990, 03, 04")
+
+def makeLibrary(lms):
+    books = lms.BookList()
+    users = lms.UserList()
+    return books, users, lms.Loans(books, users)
+
+#What a library holds, as plain values that can be compared
+def libraryState(books, users, loans):
+    bookValues = sorted((book.get_id(), book.get_title(), book.get_authors(), book.get_year(), book.get_publisher(), book.get_copies(),
+        book.get_availableCopies(), book.get_publicationDate()) for book in books)
+    userValues = sorted((user.get_id(), user.get_username(), user.get_firstname(), user.get_surname(), user.get_houseNumber(),
+        user.get_streetname(), user.get_postcode(), str(user.get_email()), user.get_dateOfBirth()) for user in users)
+    loanPairs = sorted((bookID, userID) for bookID, userIDs in loans.borrowedBooks.items() for userID in userIDs)
+    return bookValues, userValues, loanPairs
+
+#Fills a library with users, books and a loan, renames a book and deletes the last one made. Returns the ids of the books
+def fillLibrary(lms, books, users, loans):
+    people = [makeUser(lms, "user" + str(i)) for i in range(3)]
+    made = [makeBook(lms, "Title " + str(i), copies=2) for i in range(4)]
+    for book in made: books.add_book(book)
+    for user in people: users.add_user(user)
+    bookIDs = [book.get_id() for book in made]
+    loans.borrow_a_book(books.get_book_by_id(bookIDs[0]), users.get_user_by_id(people[1].get_id()))
+    books.get_book_by_id(bookIDs[1]).set_title("Changed Title")
+    books.delete_book_by_title("Title 3")
+    return bookIDs
+
+#The library is filled and the storage closed, then a new run attaches the same storage and must find the same library
+#and must not give out the id of a book again
+def checkRoundTrip(lms, openStorage, closeStorage):
+    books, users, loans = makeLibrary(lms)
+    storage = openStorage()
+    books.attach_storage(storage)
+    users.attach_storage(storage)
+    loans.attach_storage(storage)
+    bookIDs = fillLibrary(lms, books, users, loans)
+    before = libraryState(books, users, loans)
+    closeStorage(storage)
+
+    lms.recordIDs = lms.IDAllocator()
+    books, users, loans = makeLibrary(lms)
+    storage = openStorage()
+    books.attach_storage(storage)
+    users.attach_storage(storage)
+    loans.attach_storage(storage)
+    assert libraryState(books, users, loans) == before
+    assert books.get_book_by_id(bookIDs[0]).get_availableCopies() == 1
+    assert books.get_book_by_id(bookIDs[1]).get_title() == "Changed Title"
+    assert books.get_book_by_id(bookIDs[3]) is None
+    assert makeBook(lms, "New").get_id() > max(bookIDs)
+    closeStorage(storage)
+
+def test_books_and_users_are_found_by_id(lms):
+    books, users = lms.BookList(), lms.UserList()
+    emma, persuasion = makeBook(lms, "Emma"), makeBook(lms, "Persuasion")
+    reader = makeUser(lms, "reader")
+    books.add_book(emma)
+    books.add_book(persuasion)
+    users.add_user(reader)
+    assert books.get_book_by_id(persuasion.get_id()) is persuasion
+    assert users.get_user_by_id(reader.get_id()) is reader
+    assert books.get_book_by_id(reader.get_id()) is None
+    books.delete_book_by_title("Emma")
+    assert books.get_book_by_id(emma.get_id()) is None
+    assert books.has_book(persuasion) and not books.has_book(emma)
+
+def test_loans_are_indexed_by_book_and_by_user(lms):
+    books, users, loans = makeLibrary(lms)
+    first, second = makeBook(lms, "First", copies=2), makeBook(lms, "Second")
+    reader, other = makeUser(lms, "reader"), makeUser(lms, "other")
+    for book in (first, second): books.add_book(book)
+    for user in (reader, other): users.add_user(user)
+    loans.borrow_a_book(first, reader)
+    loans.borrow_a_book(second, reader)
+    loans.borrow_a_book(first, other)
+    assert sorted(loans.get_books_borrowed_by_user(reader)) == sorted([first.get_id(), second.get_id()])
+    assert sorted(loans.get_borrowers_of_book(first)) == sorted([reader.get_id(), other.get_id()])
+    assert loans.get_number_of_user_borrowed_book(reader) == 2
+
+    loans.return_a_book(first, reader)
+    assert loans.get_books_borrowed_by_user(reader) == [second.get_id()]
+    assert loans.get_borrowers_of_book(first) == [other.get_id()]
+    assert first.get_availableCopies() == 1
+
+def test_field_searches_ignore_case_and_follow_changes(lms):
+    books = lms.BookList()
+    emma = makeBook(lms, "Emma", authors="Jane Austen", publisher="Murray")
+    persuasion = makeBook(lms, "Persuasion", authors="Jane Austen, Someone Else", publisher="Murray")
+    for book in (emma, persuasion): books.add_book(book)
+    assert books._find_by("title", "EMMA") == [emma]
+    assert sorted(book.get_title() for book in books._find_by("authors", "jane austen")) == ["Emma", "Persuasion"]
+    assert books._find_by("authors", "someone else") == [persuasion]
+    assert len(books._find_by("pubdate", datetime(2000, 1, 2))) == 2
+
+    #A changed field is searched by its new value only
+    emma.set_title("Emma Revised")
+    assert books._find_by("title", "emma") == []
+    assert books._find_by("title", "emma revised") == [emma]
+    emma.set_publisher("Penguin")
+    assert books._find_by("publisher", "murray") == [persuasion]
+    emma.clear_authors()
+    emma.add_author("Anonymous")
+    assert books._find_by("authors", "jane austen") == [persuasion]
+
+    books.delete_book_by_title("Persuasion")
+    assert books._find_by("publisher", "murray") == []
+    assert books._find_by("authors", "someone else") == []
+
+def test_keyword_search_matches_prefixes_and_typos(lms):
+    books = lms.BookList()
+    for title, authors in [("The Silent River", "Ann Lee"), ("River Songs", "Bo Chan"), ("Winter Garden", "Ann Lee")]:
+        books.add_book(makeBook(lms, title, authors=authors))
+    titles = lambda query: sorted(book.get_title() for book in books.search(query))
+    assert titles("river") == ["River Songs", "The Silent River"]
+    assert titles("silent river") == ["The Silent River"]
+    assert titles("ann lee") == ["The Silent River", "Winter Garden"]
+    assert titles("wint") == ["Winter Garden"]
+    assert titles("silnet") == ["The Silent River"]
+    assert titles("nothing like it") == []
+
+    #Renamed books are found by their new title only
+    books._find_by("title", "winter garden")[0].set_title("Summer Garden")
+    assert titles("winter") == []
+    assert titles("summer") == ["Summer Garden"]
+
+def test_year_and_publication_date_ranges(lms):
+    books = lms.BookList()
+    for year in (2005, 1990, 2000, 1995):
+        books.add_book(makeBook(lms, "Book " + str(year), year=year, pubdate=str(year) + ", 06, 15"))
+    years = lambda found: [book.get_year() for book in found]
+    assert years(books.get_books_by_year_range(1995, 2000)) == [1995, 2000]
+    assert books.get_books_by_year_range(2006, 2010) == []
+    assert years(books.get_books_by_publication_date_range("1995, 06, 15", "2005, 01, 01")) == [1995, 2000]
+    assert years(books.get_books_by_publication_date_range(datetime(1990, 1, 1), datetime(1990, 12, 31))) == [1990]
+
+    #A changed year moves the book in the range
+    books.get_books_by_year_range(1990, 1990)[0].set_year(2010)
+    assert years(books.get_books_by_year_range(1900, 2020)) == [1995, 2000, 2005, 2010]
+
+def test_sqlite_round_trip(lms, tmp_path):
+    path = str(tmp_path / "library.db")
+    checkRoundTrip(lms, lambda: lms.SQLiteStorage(path), lambda storage: storage.close())
+
+def test_bulk_import_keeps_the_valid_rows(lms, tmp_path):
+    path = tmp_path / "books.csv"
+    path.write_text("title,authors,year,publisher,copies,pubdate\n"
+        "Emma,Jane Austen,1815,Murray,2,\"1815, 12, 23\"\n"
+        "Broken,Someone,not a year,Murray,1,\"1815, 12, 23\"\n"
+        "Persuasion,\"Jane Austen, Someone Else\",1817,Murray,1,\"1817, 12, 20\"\n")
+    books = lms.BookList()
+    report = lms.BulkLoader(batchSize=1).load_books(str(path), books)
+    assert (report.accepted, report.rejected) == (2, 1)
+    assert report.rejects[0][0] == 3 and report.rejects[0][1].startswith("year")
+    assert sorted(book.get_title() for book in books) == ["Emma", "Persuasion"]
+    assert books._find_by("authors", "someone else")[0].get_copies() == 1
+
+    path = tmp_path / "books.json"
+    path.write_text('{"title": "Mansfield Park"}\nnot a record\n')
+    report = lms.BulkLoader().load_books(str(path), books)
+    assert (report.accepted, report.rejected) == (0, 2)
+    assert books.get_total_books() == 2
+
+def test_bulk_users_are_checked_before_they_are_written(lms, tmp_path):
+    storage = lms.SQLiteStorage(str(tmp_path / "library.db"))
+    users = lms.UserList()
+    users.attach_storage(storage)
+    first = makeUser(lms, "first")
+    users.add_users([first])
+    #Counts the writes to the database
+    writes = []
+    flush = storage.flush
+    def countingFlush():
+        if storage._pending: writes.append(len(storage._pending))
+        flush()
+    storage.flush = countingFlush
+
+    batch = [makeUser(lms, "user" + str(i)) for i in range(2000)] + [first, makeUser(lms, "FIRST"), makeUser(lms, "user7")]
+    skipped = []
+    assert users.add_users(batch, skipped) == 2000
+    assert [reason for user, reason in skipped] == ["user already in the user list", "username already taken", "username already taken"]
+    assert users.get_total_users() == 2001
+    assert len(writes) <= 5
+    storage.close()
+
+def test_journal_replay_after_compact(lms, tmp_path):
+    directory = str(tmp_path / "journal")
+    books, users, loans = makeLibrary(lms)
+    journal = lms.OperationJournal(directory)
+    journal.attach(books, users, loans)
+    bookIDs = fillLibrary(lms, books, users, loans)
+    journal.compact()
+    #Changes made after the snapshot are only in the journal
+    later = makeBook(lms, "After Compact")
+    books.add_book(later)
+    loans.borrow_a_book(later, next(iter(users)))
+    assert loans.set_copies(books.get_book_by_id(bookIDs[0]), 5) is None
+    before = libraryState(books, users, loans)
+    journal.close()
+
+    lms.recordIDs = lms.IDAllocator()
+    books, users, loans = makeLibrary(lms)
+    journal = lms.OperationJournal(directory)
+    journal.attach(books, users, loans)
+    assert libraryState(books, users, loans) == before
+    assert books.get_book_by_id(later.get_id()).get_availableCopies() == 0
+    assert books.get_book_by_id(bookIDs[0]).get_availableCopies() == 4
+    assert makeBook(lms, "New").get_id() > max(bookIDs + [later.get_id()])
+    journal.close()
+
+def test_journal_replay_skips_what_the_snapshot_holds(lms, tmp_path):
+    directory = str(tmp_path / "journal")
+    books, users, loans = makeLibrary(lms)
+    journal = lms.OperationJournal(directory)
+    journal.attach(books, users, loans)
+    book, gone = makeBook(lms, "Book"), makeBook(lms, "Gone")
+    reader = makeUser(lms, "reader")
+    books.add_books([book, gone])
+    users.add_users([reader])
+    assert loans.borrow(book, reader) is None
+    books.delete_books([gone.get_id()])
+    journal.compact()
+    #Entries numbered after the snapshot for changes it already holds, as when a change is made while it is written
+    journal._record({"op": "borrow", "book": book.get_id(), "user": reader.get_id(), "borrowedAt": None, "dueAt": None})
+    journal._record({"op": "remove_book", "id": gone.get_id()})
+    journal._record({"op": "set_book", "id": gone.get_id(), "field": "title", "value": "Renamed"})
+    journal._record({"op": "return", "book": book.get_id(), "user": 12345})
+    before = libraryState(books, users, loans)
+    journal.close()
+
+    books, users, loans = makeLibrary(lms)
+    journal = lms.OperationJournal(directory)
+    journal.attach(books, users, loans)
+    assert libraryState(books, users, loans) == before
+    assert books.get_book_by_id(book.get_id()).get_availableCopies() == 0
+    journal.close()
+
+def test_journal_compacts_while_books_are_lent(lms, tmp_path):
+    directory = str(tmp_path / "journal")
+    books, users, loans = makeLibrary(lms)
+    journal = lms.OperationJournal(directory)
+    journal.attach(books, users, loans)
+    made = [makeBook(lms, "Book " + str(i), copies=2) for i in range(4)]
+    people = [makeUser(lms, "user" + str(i)) for i in range(8)]
+    books.add_books(made)
+    users.add_users(people)
+    def terminal(seed):
+        generator = random.Random(seed)
+        for _ in range(300):
+            book, user = generator.choice(made), generator.choice(people)
+            if loans.borrow(book, user) is not None: loans.give_back(book, user)
+    threads = [threading.Thread(target=terminal, args=(seed,)) for seed in range(4)]
+    for thread in threads: thread.start()
+    while any(thread.is_alive() for thread in threads): journal.compact()
+    for thread in threads: thread.join()
+    before = libraryState(books, users, loans)
+    journal.close()
+
+    books, users, loans = makeLibrary(lms)
+    journal = lms.OperationJournal(directory)
+    journal.attach(books, users, loans)
+    assert libraryState(books, users, loans) == before
+    for book in books: assert book.get_copies() - book.get_availableCopies() == len(loans.get_borrowers_of_book(book))
+    journal.close()
+
+def test_overdue_and_due_soon_loans(lms):
+    books, users, loans = makeLibrary(lms)
+    early, late, recent = makeBook(lms, "Early"), makeBook(lms, "Late"), makeBook(lms, "Recent")
+    reader = makeUser(lms, "reader")
+    for book in (early, late, recent): books.add_book(book)
+    users.add_user(reader)
+    now = datetime.now()
+    loans._lend(late, reader, now - timedelta(days=15))
+    loans._lend(early, reader, now - timedelta(days=20))
+    loans._lend(recent, reader, now - timedelta(days=10))
+    assert [book for dueAt, book, user in loans.get_overdue_loans(now)] == [early, late]
+    assert [book for dueAt, book, user in loans.get_loans_due_within(7, now)] == [recent]
+    assert loans.get_loan_dates(recent, reader) == (now - timedelta(days=10), now + timedelta(days=4))
+
+    loans.return_a_book(early, reader)
+    assert [book for dueAt, book, user in loans.get_overdue_loans(now)] == [late]
+    assert loans.get_loan_dates(early, reader) is None
+
+def test_circulation_from_many_threads_keeps_the_counts_right(lms):
+    assert lms.stressTestCirculation(threads=4, books=5, users=10, operations=300, copies=2) == 0
+
+def test_server_handles_books_and_loans(lms):
+    books, users, loans = makeLibrary(lms)
+    server = lms.LibraryServer(books, users, loans, port=0)
+    reader = makeUser(lms, "reader")
+    users.add_user(reader)
+    status, record = server._dispatch("POST", "/books", json.dumps({"title": "Emma", "authors": "Jane Austen", "year": 1815,
+        "publisher": "Murray", "copies": 1, "pubdate": "1815, 12, 23"}))
+    assert status == 201 and record["title"] == "Emma"
+    bookID = record["id"]
+    assert [book["id"] for book in server._dispatch("GET", "/books?title=emma", None)[1]["books"]] == [bookID]
+    loan = json.dumps({"book": bookID, "user": reader.get_id()})
+    assert server._dispatch("POST", "/loans", loan)[0] == 201
+    assert server._dispatch("POST", "/loans", loan)[0] == 409
+    assert server._dispatch("DELETE", "/books/" + str(bookID), None)[0] == 409
+    assert server._dispatch("DELETE", "/loans/" + str(bookID) + "/" + str(reader.get_id()), None)[0] == 200
+    assert server._dispatch("DELETE", "/books/" + str(bookID), None)[0] == 200
+    assert server._dispatch("GET", "/books/" + str(bookID), None)[0] == 404
+
+    assert server._dispatch("GET", "/books?limit=many", None)[0] == 400
+    assert server._dispatch("POST", "/books", "{")[0] == 400
+    assert server._dispatch("PUT", "/books", None)[0] == 405
+    assert server._dispatch("GET", "/shelves", None)[0] == 404
+
+def test_books_and_users_have_no_attribute_dict(lms):
+    assert not hasattr(makeBook(lms, "Book"), "__dict__")
+    assert not hasattr(makeUser(lms, "user"), "__dict__")
+
+def test_column_store_round_trip(lms):
+    store = lms.ColumnStore()
+    books, users, loans = makeLibrary(lms)
+    books.attach_storage(store)
+    users.attach_storage(store)
+    bookIDs = fillLibrary(lms, books, users, loans)
+    bookValues, userValues, _ = libraryState(books, users, loans)
+
+    lms.recordIDs = lms.IDAllocator()
+    books, users, loans = makeLibrary(lms)
+    books.attach_storage(store)
+    users.attach_storage(store)
+    assert libraryState(books, users, loans)[:2] == (bookValues, userValues)
+    assert makeBook(lms, "New").get_id() > max(bookIDs)
+
+def test_benchmark_of_a_small_library(lms):
+    result = lms.benchmarkLibrary(200, calls=3, budget=0.05)
+    assert (result["books"], result["users"]) == (200, 20)
+    assert result["operations"] and all(figures["calls"] > 0 for figures in result["operations"].values())
+    titles = lambda: sorted(book.get_title() for book in lms.buildSyntheticLibrary(50, seed=3)[0])
+    assert titles() == titles()
+
+def test_metrics_count_calls_and_errors(lms):
+    class Shelf:
+        def put(self, full):
+            if full: raise ValueError("the shelf is full")
+        def _check(self): pass
+    metrics = lms.OperationMetrics()
+    metrics.instrument(Shelf)
+    shelf = Shelf()
+    shelf.put(False)
+    shelf.put(False)
+    with pytest.raises(ValueError): shelf.put(True)
+    assert metrics.get_operations() == ["Shelf.put"]
+    figures = metrics.dump()["Shelf.put"]
+    assert (figures["calls"], figures["errors"]) == (3, 1)
+    assert figures["p50_us"] <= figures["p99_us"] <= figures["max_us"]
+
+    metrics.uninstrument()
+    shelf.put(False)
+    assert metrics.dump()["Shelf.put"]["calls"] == 3
+    metrics.reset()
+    assert metrics.dump() == {}
+
+def test_books_by_field_a_page_at_a_time(lms):
+    books = lms.BookList()
+    made = [makeBook(lms, "Book " + str(i), publisher="Murray") for i in range(25)]
+    for book in made + [makeBook(lms, "Other", publisher="Penguin")]: books.add_book(book)
+    everything = list(books.iter_books_by("publisher", "murray"))
+    assert sorted(everything, key=made.index) == made
+    pages = [list(books.iter_books_by("publisher", "MURRAY", offset, 10)) for offset in (0, 10, 20, 30)]
+    assert [len(page) for page in pages] == [10, 10, 5, 0]
+    assert sum(pages, []) == everything
+
+def test_schema_checks_a_batch_of_records(lms):
+    records = [{"title": "Emma", "authors": "Jane Austen", "year": "1815", "publisher": "Murray", "copies": 2, "pubdate": "1815, 12, 23"},
+        {"title": "", "authors": [], "year": "soon", "publisher": "Murray", "copies": 1, "pubdate": "1815, 12, 23"},
+        "not a record"]
+    valid, errors = lms.BOOK_SCHEMA.validate_many(records)
+    assert valid == [(0, ["Emma", ["Jane Austen"], 1815, "Murray", 2, datetime(1815, 12, 23)])]
+    assert [(position, field) for position, field, message in errors] == [(1, "title"), (1, "authors"), (1, "year"), (2, None)]
+
+def test_bulk_delete_keeps_the_books_on_loan(lms):
+    books, users, loans = makeLibrary(lms)
+    made = [makeBook(lms, "Book " + str(i), year=2000 + i) for i in range(5)]
+    for book in made: books.add_book(book)
+    reader = makeUser(lms, "reader")
+    users.add_user(reader)
+    loans.borrow_a_book(made[0], reader)
+    assert books.delete_books(predicate=lambda book: book.get_year() < 2003) == ([made[1], made[2]], [made[0]])
+
+    #Ids that aren't in the list are ignored, the loans of the books deleted are ended
+    assert books.delete_books([made[0].get_id(), made[3].get_id(), 12345], returnLoans=True) == ([made[0], made[3]], [])
+    assert loans.get_books_borrowed_by_user(reader) == []
+    assert [book.get_title() for book in books] == ["Book 4"]
+    assert books._find_by("title", "book 1") == []
+    assert books.get_books_by_year_range(2000, 2010) == [made[4]]
+
+def test_circulation_analytics(lms):
+    pytest.importorskip("numpy")
+    books, users, loans = makeLibrary(lms)
+    history = lms.LoanHistory(loans)
+    popular = makeBook(lms, "Popular", copies=2, publisher="Murray")
+    quiet = makeBook(lms, "Quiet", publisher="Penguin")
+    first, second = makeUser(lms, "first"), makeUser(lms, "second")
+    for book in (popular, quiet): books.add_book(book)
+    for user in (first, second): users.add_user(user)
+    loans.borrow_a_book(popular, first)
+    loans.borrow_a_book(popular, second)
+    loans.return_a_book(popular, first)
+    loans.borrow_a_book(popular, first)
+    analytics = lms.CirculationAnalytics(books, history)
+    assert analytics.most_borrowed() == [(popular, 3)]
+    assert analytics.utilization_by_publisher() == [("Murray", 2, 2, 1.0), ("Penguin", 1, 0, 0.0)]
+    assert analytics.demand_ratios() == [(popular, 2, 3, 1.5)]
+
+def test_cached_searches_follow_changes(lms):
+    books = lms.BookList()
+    emma, other = makeBook(lms, "Emma", publisher="Murray"), makeBook(lms, "Other", publisher="Penguin")
+    for book in (emma, other): books.add_book(book)
+    titles = lambda: sorted(book.get_title() for book in books._find_by("publisher", "murray"))
+    assert titles() == ["Emma"]
+    assert titles() == ["Emma"]
+    assert books.get_search_cache_stats()["hits"] == 1
+
+    #Adding, changing or removing a book the search matches drops the cached result
+    other.set_publisher("Murray")
+    assert titles() == ["Emma", "Other"]
+    books.add_book(makeBook(lms, "Third", publisher="Murray"))
+    assert titles() == ["Emma", "Other", "Third"]
+    books.delete_book_by_title("Emma")
+    assert titles() == ["Other", "Third"]
+    assert books.get_search_cache_stats()["invalidations"] >= 3
+
+def test_ids_count_up_and_usernames_are_unique(lms):
+    assert [makeBook(lms, "Book").get_id(), makeUser(lms, "user").get_id(), makeBook(lms, "Book").get_id()] == [1, 2, 3]
+    users = lms.UserList()
+    reader = makeUser(lms, "reader")
+    users.add_user(reader)
+    users.add_user(makeUser(lms, "READER"))
+    assert users.add_users([makeUser(lms, "Reader"), makeUser(lms, "other")]) == 1
+    assert users.get_total_users() == 2
+    assert users.get_user_by_username("rEaDeR") is reader
+
+    #Books handed to a storage aren't kept, their ids must still not be given to the next books
+    books = lms.BookList()
+    books.attach_storage(lms.ColumnStore())
+    assert books.add_books(makeBook(lms, "Book " + str(i)) for i in range(100)) == 100
+
+def test_sharded_searches_match_the_in_memory_ones(lms):
+    plain, sharded = lms.BookList(), lms.BookList()
+    storage = lms.ShardedStorage(2, batchSize=7)
+    sharded.attach_storage(storage)
+    try:
+        for books in (plain, sharded):
+            lms.recordIDs = lms.IDAllocator()
+            books.add_books(lms.syntheticBooks(300, seed=5))
+        ids = lambda books: sorted(book.get_id() for book in books)
+        sample = plain.get_book_by_id(10)
+        for field, value in [("title", sample.get_title()), ("authors", sample.get_authors()[0]), ("publisher", sample.get_publisher())]:
+            assert ids(sharded._find_by(field, value)) == ids(plain._find_by(field, value))
+        assert ids(sharded.get_books_by_year_range(1950, 1970)) == ids(plain.get_books_by_year_range(1950, 1970))
+        for query in ("river", "silent gard", "histroy"):
+            assert ids(sharded.search(query, 1000)) == ids(plain.search(query, 1000))
+
+        #Changes are sent to the shards before the next search
+        sharded.get_book_by_id(10).set_title("Renamed Book")
+        sharded.delete_books([11])
+        assert ids(sharded._find_by("title", "renamed book")) == [10]
+        assert ids(sharded.search("renamed")) == [10]
+        assert 11 not in ids(sharded.get_books_by_year_range(None, None))
+
+        #A book found by a search is the list's own, so changing it is stored
+        found = sharded._find_by("title", plain.get_book_by_id(20).get_title())[0]
+        assert sharded.get_book_by_id(20) is found
+        found.set_publisher("Found Press")
+        assert ids(sharded._find_by("publisher", "found press")) == [20]
+        assert sharded.get_books_by_year_range(found.get_year(), found.get_year())[0].get_publisher() == "Found Press"
+        assert sharded.search(found.get_title(), 1)[0] is found
+    finally:
+        storage.close()
+
+def test_catalog_round_trip(lms, tmp_path):
+    path = str(tmp_path / "library.cat")
+    lms.MappedCatalog.write(path, ())
+    def close(catalog):
+        catalog.save()
+        catalog.close()
+    checkRoundTrip(lms, lambda: lms.MappedCatalog(path), close)
+
+def test_borrow_many_is_all_or_nothing(lms):
+    books, users, loans = makeLibrary(lms)
+    available, taken = makeBook(lms, "Available"), makeBook(lms, "Taken")
+    books.add_books([available, taken])
+    first, second = makeUser(lms, "first"), makeUser(lms, "second")
+    users.add_users([first, second])
+    assert loans.borrow(taken, first) is None
+
+    assert loans.borrow_many([available, taken], second) == [loans.NOT_DONE, loans.NO_COPIES]
+    assert available.get_availableCopies() == 1
+    assert loans.get_books_borrowed_by_user(second) == []
+
+    assert loans.borrow_many([available.get_id(), 999], second) == [loans.NOT_DONE, loans.NO_SUCH_BOOK]
+    assert loans.borrow_many([available, available], second) == [loans.NOT_DONE, loans.GIVEN_TWICE]
+    assert loans.get_books_borrowed_by_user(second) == []
+
+    assert loans.borrow_many([available], second) == [loans.OK]
+    assert available.get_availableCopies() == 0
+    assert loans.return_many([available, taken], second) == [loans.NOT_DONE, loans.NOT_BORROWED]
+    assert available.get_availableCopies() == 0
+
+def test_holds_are_served_in_order(lms):
+    books, users, loans = makeLibrary(lms)
+    book = makeBook(lms, "Popular")
+    books.add_books([book])
+    borrower, *waiting = [makeUser(lms, "user" + str(i)) for i in range(4)]
+    users.add_users([borrower] + waiting)
+    assert loans.borrow(book, borrower) is None
+    for user in waiting: assert loans.place_hold(book, user) is None
+    assert [loans.get_hold_position(book, user) for user in waiting] == [1, 2, 3]
+
+    #The returned copy is kept for the first in the queue, nobody else can take it
+    assert loans.give_back(book, borrower) is None
+    assert [loans.get_hold_position(book, user) for user in waiting] == [0, 1, 2]
+    assert loans.borrow(book, waiting[1]) is not None
+    #A copy kept and not picked up goes to the next in the queue
+    assert loans.expire_holds(datetime.now() + timedelta(days=30)) == [(book, waiting[0])]
+    assert [loans.get_hold_position(book, user) for user in waiting] == [None, 0, 1]
+    assert loans.borrow(book, waiting[1]) is None
+    assert loans.get_holds_of_user(waiting[2]) == [(book, 1)]
+    #Copies added go to the holds still waiting
+    assert loans.set_copies(book, 2) is None
+    assert loans.get_holds_of_user(waiting[2]) == [(book, 0)]
+    assert loans.cancel_hold(book, waiting[2]) is None
+    assert loans.get_holds_of_user(waiting[2]) == []
+
+def test_deleting_a_book_ends_its_holds(lms):
+    books, users, loans = makeLibrary(lms)
+    book = makeBook(lms, "Popular")
+    books.add_books([book])
+    borrower, ready, waiting = [makeUser(lms, "user" + str(i)) for i in range(3)]
+    users.add_users([borrower, ready, waiting])
+    assert loans.borrow(book, borrower) is None
+    for user in (ready, waiting): assert loans.place_hold(book, user) is None
+    assert loans.give_back(book, borrower) is None
+    assert books.delete_books([book.get_id()]) == ([book], [])
+    assert [loans.get_hold_position(book, user) for user in (ready, waiting)] == [None, None]
+
+def test_deleting_a_user_ends_their_holds(lms):
+    books, users, loans = makeLibrary(lms)
+    book, other = makeBook(lms, "Popular"), makeBook(lms, "Other")
+    books.add_books([book, other])
+    borrower, ready, waiting, last = [makeUser(lms, "user" + str(i)) for i in range(4)]
+    users.add_users([borrower, ready, waiting, last])
+    assert loans.borrow(book, borrower) is None
+    assert loans.borrow(other, borrower) is None
+    for user in (ready, waiting, last): assert loans.place_hold(book, user) is None
+    assert loans.place_hold(other, waiting) is None
+    assert loans.give_back(book, borrower) is None
+
+    #The copy kept for a deleted user goes to the next in the queue
+    assert users.delete_users([ready.get_id()]) == ([ready], [])
+    assert [loans.get_hold_position(book, user) for user in (ready, waiting, last)] == [None, 0, 1]
+    assert users.delete_users([waiting.get_id()]) == ([waiting], [])
+    assert [loans.get_hold_position(book, user) for user in (waiting, last)] == [None, 0]
+    assert loans.get_hold_position(other, waiting) is None
+    assert waiting.get_id() not in loans.userHolds
+    assert users.delete_users([last.get_id()]) == ([last], [])
+    assert loans.setAside == {} and loans.userHolds == {}
+    assert loans.borrow(book, borrower) is None
+
+def test_change_feed_over_http(lms):
+    books, users, loans = makeLibrary(lms)
+    server = lms.LibraryServer(books, users, loans, port=0)
+    assert server._dispatch("GET", "/changes", None) == (200, {"events": [], "cursor": 0})
+    book = makeBook(lms, "Emma", copies=2)
+    books.add_books([book])
+    book.set_title("Emma Revised")
+    reader = makeUser(lms, "reader")
+    users.add_users([reader])
+    assert loans.borrow(book, reader) is None
+
+    status, page = server._dispatch("GET", "/changes?after=0&limit=2", None)
+    assert status == 200 and page["cursor"] == 2
+    assert [(event["seq"], event["type"]) for event in page["events"]] == [(1, "added"), (2, "changed")]
+    assert page["events"][1]["field"] == "title"
+    status, page = server._dispatch("GET", "/changes?after=2", None)
+    assert [(event["type"], event["availableCopies"]) for event in page["events"]] == [("availability", 1)]
+    assert server._dispatch("GET", "/changes?after=3", None)[1] == {"events": [], "cursor": 3}
+    assert server._dispatch("GET", "/changes?after=soon", None)[0] == 400
+    #A cursor from before a restart can't be followed
+    assert server._dispatch("GET", "/changes?after=9", None) == (410, {"status": "resync_required",
+        "error": "changes after this cursor are no longer kept", "oldest": 1, "cursor": 3})
+
+def test_change_feed_over_http_asks_for_a_resync(lms, monkeypatch):
+    monkeypatch.setattr(lms.ChangeFeed, "RETAINED", 4)
+    books, users, loans = makeLibrary(lms)
+    server = lms.LibraryServer(books, users, loans, port=0)
+    books.add_books([makeBook(lms, "Book " + str(i)) for i in range(6)])
+    status, page = server._dispatch("GET", "/changes?after=1", None)
+    assert (status, page["status"], page["oldest"], page["cursor"]) == (410, "resync_required", 3, 6)
+    status, page = server._dispatch("GET", "/changes?after=" + str(page["oldest"] - 1), None)
+    assert status == 200 and [event["seq"] for event in page["events"]] == [3, 4, 5, 6]
+
+def test_change_feed_keeps_the_latest_events(lms):
+    books = lms.BookList()
+    feed = lms.ChangeFeed(books, 4)
+    books.add_books([makeBook(lms, "Book " + str(i)) for i in range(6)])
+    assert feed.read(1) is None
+    assert [event[0] for event in feed.read(2)] == [3, 4, 5, 6]
+    assert feed.read(7) is None
+    subscription = feed.subscribe(4)
+    assert [event[0] for event in subscription.poll()] == [5, 6]
+
+def test_import_rejects_taken_usernames(lms, tmp_path):
+    path = tmp_path / "users.csv"
+    row = lambda username: username + ",First,Last,1,Street,PC1," + username + "@example.com,\"1990, 03, 04\"\n"
+    path.write_text("username,firstname,surname,houseNumber,streetname,postcode,email,dateOfBirth\n" + row("reader") + row("other") + row("READER"))
+    users = lms.UserList()
+    report = lms.BulkLoader().load_users(str(path), users)
+    assert (report.accepted, report.rejected) == (2, 1)
+    assert report.rejects == [(4, "username already taken")]
+
+def test_keyword_search_of_a_reopened_database(lms, tmp_path):
+    path = str(tmp_path / "library.db")
+    books = lms.BookList()
+    storage = lms.SQLiteStorage(path)
+    books.attach_storage(storage)
+    books.add_books([makeBook(lms, title, authors="Ann Lee") for title in ("The Silent River", "River Songs", "Winter Garden")])
+    storage.close()
+
+    books = lms.BookList()
+    storage = lms.SQLiteStorage(path)
+    books.attach_storage(storage)
+    titles = lambda query: sorted(book.get_title() for book in books.search(query))
+    assert titles("river") == ["River Songs", "The Silent River"]
+    books.add_books([makeBook(lms, "River Deep", authors="Bo Chan")])
+    assert titles("river") == ["River Deep", "River Songs", "The Silent River"]
+    books.search("winter")[0].set_title("Summer Garden")
+    assert titles("winter") == []
+    assert titles("summer") == ["Summer Garden"]
+    storage.close()
+
+def test_sharded_search_pages_match_the_in_memory_ones(lms):
+    plain, sharded = lms.BookList(), lms.BookList()
+    storage = lms.ShardedStorage(2)
+    sharded.attach_storage(storage)
+    try:
+        for books in (plain, sharded):
+            lms.recordIDs = lms.IDAllocator()
+            books.add_books(lms.syntheticBooks(500, seed=7))
+        ids = lambda books: [book.get_id() for book in books]
+        for offset in (0, 5, 40):
+            assert ids(sharded.iter_books_by("publisher", "penguin", offset, 5)) == ids(plain.iter_books_by("publisher", "penguin", offset, 5))
+        assert ids(sharded.get_books_by_year_range(1990, 2000))[:5] == ids(plain.get_books_by_year_range(1990, 2000))[:5]
+        assert len(sharded.search("river", 5)) == 5
+    finally:
+        storage.close()
+
+@pytest.mark.parametrize("onLoan, copies, available", [(1, 5, 4), (2, 2, 0), (0, 1, 1)])
+def test_set_copies_keeps_the_copies_on_loan(lms, onLoan, copies, available):
+    books, users, loans = makeLibrary(lms)
+    book = makeBook(lms, "Book", copies=3)
+    books.add_books([book])
+    people = [makeUser(lms, "user" + str(i)) for i in range(onLoan)]
+    users.add_users(people)
+    for user in people: assert loans.borrow(book, user) is None
+    assert loans.set_copies(book, copies) is None
+    assert (book.get_copies(), book.get_availableCopies()) == (copies, available)
+    if onLoan: assert loans.set_copies(book, onLoan - 1) is not None
+    assert (book.get_copies(), book.get_availableCopies()) == (copies, available)
+
+def test_change_feed_page_of_no_events(lms):
+    books, users, loans = makeLibrary(lms)
+    server = lms.LibraryServer(books, users, loans, port=0)
+    books.add_books([makeBook(lms, "Emma")])
+    assert server._dispatch("GET", "/changes?after=0&limit=0", None) == (200, {"events": [], "cursor": 0})
+    assert server._dispatch("GET", "/changes?after=0&limit=-1", None)[0] == 400